@@ -0,0 +1,88 @@
+"""
+Per-item overhead of the SQLAlchemyInstanceAdapter & ScrapyDeclarativeBase
+helpers that run for every scraped item.
+
+    $ python benchmarks/bench_adapter.py
+"""
+
+from datetime import date
+import timeit
+
+from itemadapter import ItemAdapter
+from sqlalchemy import Column, Date, ForeignKey, Integer, String, Table, Text
+from sqlalchemy.orm import DeclarativeBase, relationship
+
+from scrapy_sql import ScrapyDeclarativeBase
+
+
+class BenchBase(DeclarativeBase, ScrapyDeclarativeBase):
+    pass
+
+
+class Author(BenchBase):
+    __tablename__ = 'author'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), unique=True, nullable=False)
+    birthday = Column(Date, nullable=False)
+    bio = Column(Text, nullable=False)
+
+
+class Tag(BenchBase):
+    __tablename__ = 'tag'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(31), unique=True, nullable=False)
+
+
+class Quote(BenchBase):
+    __tablename__ = 'quote'
+
+    id = Column(Integer, primary_key=True)
+    author_id = Column(ForeignKey('author.id'), nullable=False)
+    quote = Column(Text, unique=True, nullable=False)
+
+    author = relationship('Author')
+    tags = relationship('Tag', secondary='quote_tag')
+
+
+quote_tag = Table(
+    'quote_tag', BenchBase.metadata,
+    Column('quote_id', ForeignKey('quote.id'), primary_key=True),
+    Column('tag_id',   ForeignKey('tag.id'),   primary_key=True)
+)
+
+
+def per_item(instance):
+    adapter = ItemAdapter(instance)
+    adapter.asdict()
+    len(adapter)
+    list(adapter)
+    instance.params
+    instance.loaded_columns
+
+
+def main(number=20_000):
+    author = Author(
+        name='John F. Kennedy',
+        birthday=date(1917, 5, 29),
+        bio='35th president of the United States.'
+    )
+    quote = Quote(
+        quote='If not us, who? If not now, when?',
+        author=author,
+        tags=[Tag(name='change'), Tag(name='deep-thoughts')]
+    )
+
+    benchmarks = {
+        'adapter + params per item': lambda: per_item(quote),
+        'Base.sorted_tables': lambda: BenchBase.sorted_tables,
+        'Base.sorted_entities': lambda: BenchBase.sorted_entities,
+    }
+    for name, func in benchmarks.items():
+        seconds = min(timeit.repeat(func, number=number, repeat=5))
+        print(f'{name:<30} {seconds / number * 1e6:8.2f} us')
+
+
+if __name__ == '__main__':
+    main()
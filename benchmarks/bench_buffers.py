@@ -0,0 +1,82 @@
+"""
+Memory held by a batch of exported quotes: instances attached to a
+ScrapyBulkSession (the default `add`) vs. rows copied into the
+column-oriented buffers of scrapy_sql.buffers.buffered_add.
+
+    $ python benchmarks/bench_buffers.py
+"""
+
+from datetime import date
+import gc
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine, insert
+
+from scrapy_sql.buffers import buffered_add
+from scrapy_sql.feedexport import _default_add
+from scrapy_sql.session import ScrapyBulkSession
+
+from bench_adapter import Author, BenchBase, Quote, Tag
+
+
+feed_options = {
+    'orm_stmts': {
+        table: insert for table in BenchBase.sorted_tables
+    },
+    'declarative_base': 'bench_adapter.BenchBase',
+}
+
+
+def export(add, items, trace=True):
+    engine = create_engine('sqlite://')
+    BenchBase.metadata.create_all(engine)
+    session = ScrapyBulkSession(bind=engine, feed_options=feed_options)
+    tags = [Tag(name=f'tag-{i}') for i in range(20)]
+
+    gc.collect()
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+
+    for i in range(items):
+        author = Author(
+            name=f'author-{i}',
+            birthday=date(1917, 5, 29),
+            bio='35th president of the United States.'
+        )
+        quote = Quote(
+            quote=f'quote-{i}',
+            author=author,
+            tags=[tags[i % 20], tags[(i + 1) % 20]]
+        )
+        add(session, quote)
+
+    held, peak = None, None
+    if trace:
+        gc.collect()
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    # buffered_add runs the dependency processors while buffering,
+    # session.add while committing, so both are timed
+    session.bulk_commit()
+    seconds = time.perf_counter() - start
+    engine.dispose()
+    return held, peak, seconds
+
+
+def main(items=20_000):
+    for name, add in (('session.add', _default_add), ('buffered_add', buffered_add)):
+        held, peak, _ = export(add, items)
+        # tracemalloc slows down allocations, time a separate run
+        *_, seconds = export(add, items, trace=False)
+        print(
+            f'{name:<14} held {held / 2**20:7.1f} MiB'
+            f'   peak {peak / 2**20:7.1f} MiB'
+            f'   {seconds / items * 1e6:7.1f} us/item'
+        )
+
+
+if __name__ == '__main__':
+    main()
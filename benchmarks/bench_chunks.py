@@ -0,0 +1,65 @@
+"""
+Throughput of ScrapyBulkSession.bulk_commit against the size of its chunks:
+`max_rows_per_statement` for multi VALUES INSERTs (taken when values contain
+subqueries) and `executemany_page_size` for executemany().
+
+    $ python benchmarks/bench_chunks.py [sqlite URI]
+"""
+
+from datetime import date
+import sys
+import time
+
+from sqlalchemy import create_engine, insert
+
+from scrapy_sql.session import ScrapyBulkSession
+
+from bench_adapter import Author, BenchBase, Quote
+
+
+def commit(uri, items, subqueries, **options):
+    engine = create_engine(uri)
+    BenchBase.metadata.drop_all(engine)
+    BenchBase.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Author), [{
+            'name': 'John F. Kennedy',
+            'birthday': date(1917, 5, 29),
+            'bio': '35th president of the United States.'
+        }])
+
+    session = ScrapyBulkSession(bind=engine, feed_options={
+        'orm_stmts': {table: insert for table in BenchBase.sorted_tables},
+        'declarative_base': 'bench_adapter.BenchBase',
+        **options
+    })
+    for i in range(items):
+        author_id = Author(name='John F. Kennedy').subquery('id') \
+            if subqueries else 1
+        session.add(Quote(quote=f'quote-{i}', author_id=author_id))
+
+    start = time.perf_counter()
+    session.bulk_commit()
+    seconds = time.perf_counter() - start
+
+    session.close()
+    engine.dispose()
+    return items / seconds
+
+
+def main(uri='sqlite:///bench_chunks.db', items=5_000):
+    sizes = (10, 50, 100, 500, 1000, 5000, None)
+
+    print("multi VALUES, max_rows_per_statement (None: the dialect's parameter limit)")
+    for size in sizes:
+        rows = commit(uri, items, True, max_rows_per_statement=size)
+        print(f'  {str(size):>6} {rows:12,.0f} rows/s')
+
+    print('executemany, executemany_page_size')
+    for size in sizes:
+        rows = commit(uri, items, False, executemany_page_size=size)
+        print(f'  {str(size):>6} {rows:12,.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
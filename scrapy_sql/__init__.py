@@ -3,11 +3,13 @@
 from .adapters import ScrapyDeclarativeBase
 from .exporters import SQLAlchemyInstanceExporter
 from .feedexport import SQLAlchemyFeedStorage
+from .pipelines import SQLAlchemyPipeline
 
 __all__ = [
     'ScrapyDeclarativeBase',
     'SQLAlchemyInstanceExporter',
-    'SQLAlchemyFeedStorage'
+    'SQLAlchemyFeedStorage',
+    'SQLAlchemyPipeline'
 ]
 
 # Update scrapy ItemAdapter class to work with SQLAlchemy.
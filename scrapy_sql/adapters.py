@@ -1,5 +1,6 @@
 
 # Project Imports
+from .schema import entity_schema, metadata_schema
 from .utils import (
     classproperty, is_scalar_column,
     column_value_is_subquery, subquery_to_string
@@ -61,10 +62,10 @@ class _MixinColumnSQLAlchemyAdapter:
             )
 
     def __iter__(self) -> Iterator:
-        return iter(self.asdict())
+        return iter(entity_schema(self.item_class).field_names)
 
     def __len__(self) -> int:
-        return len(self.asdict())
+        return len(entity_schema(self.item_class).field_names)
 
 
 class SQLAlchemyInstanceAdapter(_MixinColumnSQLAlchemyAdapter, AdapterInterface):
@@ -95,8 +96,7 @@ class SQLAlchemyInstanceAdapter(_MixinColumnSQLAlchemyAdapter, AdapterInterface)
 
     @classmethod
     def get_field_names_from_class(cls, item_class: type) -> Optional[List[str]]:
-        return list(item_class.column_names) \
-            + list(item_class.relationship_names)
+        return list(entity_schema(item_class).field_names)
 
     def __init__(self, item) -> None:
         super().__init__(item)
@@ -104,9 +104,10 @@ class SQLAlchemyInstanceAdapter(_MixinColumnSQLAlchemyAdapter, AdapterInterface)
         self.item_class_name = self.item_class.__name__
 
     def asdict(self):
-        attrs = self.item.column_names + self.item.relationship_names
+        item = self.item
         return {
-            attr: getattr(self.item, attr) for attr in attrs
+            attr: getattr(item, attr)
+            for attr in entity_schema(self.item_class).field_names
         }
 
     def field_names(self) -> KeysView:
@@ -130,34 +131,16 @@ class ScrapyDeclarativeBase: #(DeclarativeBase):
 
     @classproperty
     def sorted_tables(cls):
-        return cls.metadata.sorted_tables
+        return list(metadata_schema(cls).sorted_tables)
 
     @classproperty
     def sorted_entities(cls):
-        mappers = cls._sa_registry.mappers
-
-        entities = [mapper.entity for mapper in mappers]
-        table_entity_map = {entity.__table__: entity for entity in entities}
-
-        result = []
-        for table in cls.sorted_tables:
-            try:
-                result.append(table_entity_map[table])
-            except KeyError:  # table without entity, most likely a join table
-                pass
-        return result
+        return list(metadata_schema(cls).sorted_entities)
 
     @classproperty
     def tablename_to_entity_map(cls):
         """Used in from_repr classmethod, specifically with subqueries"""
-        entites = [mapper.entity for mapper in cls._sa_registry.mappers]
-        d = {entity.__table__.name: entity for entity in entites}
-
-        for table in cls.sorted_tables:  # Join tables, that don't have an entity
-            if not isinstance(table, ScrapyDeclarativeBase):
-                d.setdefault(table.name, table)
-
-        return d
+        return dict(metadata_schema(cls).tablename_to_entity_map)
 
     @classproperty
     def columns(cls):
@@ -165,7 +148,7 @@ class ScrapyDeclarativeBase: #(DeclarativeBase):
 
     @classproperty
     def column_names(cls):
-        return tuple(c.name for c in cls.columns)
+        return entity_schema(cls).column_names
 
     @classproperty
     def column_name_to_column_obj_map(cls):
@@ -173,10 +156,7 @@ class ScrapyDeclarativeBase: #(DeclarativeBase):
         Used in `subquery` method to allow for column names to be passed
         instead of column objs
         """
-        return {
-            column.name: column
-            for column in cls.columns
-        }
+        return dict(entity_schema(cls).column_name_to_column_obj_map)
 
     @classproperty
     def relationships(cls):
@@ -184,26 +164,23 @@ class ScrapyDeclarativeBase: #(DeclarativeBase):
 
     @classproperty
     def relationship_names(cls):
-        return tuple(r.class_attribute.key for r in cls.relationships)
+        return entity_schema(cls).relationship_names
 
     @classproperty
     def relationship_name_to_relationship_obj_map(cls):
-        return {
-            relationship.class_attribute.key: relationship
-            for relationship in cls.relationships
-        }
+        return dict(entity_schema(cls).relationship_name_to_relationship_obj_map)
 
     @property
     def unloaded_columns(self):
         return tuple(
-            column for column in self.columns
+            column for column in entity_schema(type(self)).columns
             if getattr(self, column.name) is None
         )
 
     @property
     def loaded_columns(self):
         return tuple(
-            column for column in self.columns
+            column for column in entity_schema(type(self)).columns
             if getattr(self, column.name) is not None
         )
 
@@ -212,10 +189,12 @@ class ScrapyDeclarativeBase: #(DeclarativeBase):
         """
         returns a dictionary to be used with session.execute(stmt, params)
         """
-        return {
-            column.name: getattr(self, column.name)
-            for column in self.loaded_columns
-        }
+        params = {}
+        for name in entity_schema(type(self)).column_names:
+            value = getattr(self, name)
+            if value is not None:
+                params[name] = value
+        return params
 
     @classmethod
     def subquery_from_dict(cls, *return_columns, **instance_kwargs):
@@ -229,7 +208,8 @@ class ScrapyDeclarativeBase: #(DeclarativeBase):
         # Allow strings to be passed in as arguments for columns
         for i, column in enumerate(return_columns):
             if isinstance(column, str):
-                return_columns[i] = self.column_name_to_column_obj_map[column]
+                return_columns[i] = entity_schema(type(self)) \
+                    .column_name_to_column_obj_map[column]
 
         if return_columns == []:  # Default to pks
             mapper = object_mapper(self)
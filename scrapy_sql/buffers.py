@@ -0,0 +1,287 @@
+
+# SQLAlchemy Imports
+from sqlalchemy.orm.attributes import instance_state
+
+# Project Imports
+from .utils import column_value_is_subquery
+
+# 3rd 🎉 Imports
+from array import array
+from weakref import WeakKeyDictionary
+
+
+def buffered_add(session, instance):
+    """
+    Alternative to the default `add` function, for use with
+    ScrapyBulkSession. Instead of attaching the instance to the session,
+    its column values (and those of the instances it cascades to) are copied
+    into column-oriented buffers and the instance is released.
+
+    e.g.) FEEDS = {uri: {..., 'add': 'scrapy_sql.buffers.buffered_add'}}
+    """
+    session.buffer(instance)
+
+
+class TableBuffer:
+    """
+    The rows of one table stored column by column, one list per column.
+    A row costs a pointer per column instead of an ORM instance with its
+    InstanceState, attribute history and identity map entry.
+
+    Foreign keys whose parent row is buffered without its primary key are
+    left as None and noted in `deferred`, as a pair of row indexes per
+    value, rather than as pending resolver entries holding objects.
+    """
+
+    __slots__ = (
+        'table',
+        'entity',
+        'column_names',
+        'column_index',
+        'columns',
+        'has_subqueries',
+        'deferred',
+    )
+
+    def __init__(self, table, entity=None):
+        self.table = table
+        self.entity = entity
+        self.column_names = tuple(c.name for c in table.columns)
+        self.column_index = {
+            name: i for i, name in enumerate(self.column_names)
+        }
+        self.columns = tuple([] for _ in self.column_names)
+        self.has_subqueries = False
+        # {(column name, parent column): (row indexes, parent row indexes)}
+        self.deferred = {}
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def append(self, instance):
+        """Copy the column values of an instance, returns a RowReference"""
+        index = len(self)
+        for name, values in zip(self.column_names, self.columns):
+            value = getattr(instance, name)
+            values.append(value)
+            if not self.has_subqueries and column_value_is_subquery(value):
+                self.has_subqueries = True
+        return RowReference(self, index)
+
+    def append_params(self, params):
+        """Copy a row given as a dict, e.g. of a join table, returns its index"""
+        index = len(self)
+        for name, values in zip(self.column_names, self.columns):
+            value = params.get(name)
+            values.append(value)
+            if not self.has_subqueries and column_value_is_subquery(value):
+                self.has_subqueries = True
+        return index
+
+    def defer(self, index, name, parent_column, parent_index):
+        """
+        Note that `name` of row `index` takes the value of `parent_column`
+        of row `parent_index` of the parent table's buffer
+        """
+        key = (name, parent_column)
+        indexes = self.deferred.get(key)
+        if indexes is None:
+            indexes = self.deferred[key] = (array('q'), array('q'))
+        indexes[0].append(index)
+        indexes[1].append(parent_index)
+
+    def rows(self):
+        return [RowReference(self, index) for index in range(len(self))]
+
+
+class RowReference:
+    """
+    Stands in for the released instance of a buffered row. Column values are
+    read and written as attributes, so dependency processors, the
+    NaturalKeyResolver and INSERT ... RETURNING treat it like the instance.
+    """
+
+    __slots__ = ('buffer', 'index')
+
+    def __init__(self, buffer, index):
+        object.__setattr__(self, 'buffer', buffer)
+        object.__setattr__(self, 'index', index)
+
+    @property
+    def __table__(self):
+        return self.buffer.table
+
+    def __getattr__(self, name):
+        buffer = object.__getattribute__(self, 'buffer')
+        try:
+            values = buffer.columns[buffer.column_index[name]]
+        except KeyError:
+            raise AttributeError(name)
+        return values[object.__getattribute__(self, 'index')]
+
+    def __setattr__(self, name, value):
+        try:
+            values = self.buffer.columns[self.buffer.column_index[name]]
+        except KeyError:
+            raise AttributeError(name)
+        values[self.index] = value
+
+    @property
+    def params(self):
+        """Same as ScrapyDeclarativeBase.params"""
+        params = {}
+        for name, values in zip(self.buffer.column_names, self.buffer.columns):
+            value = values[self.index]
+            if value is not None:
+                params[name] = value
+        return params
+
+    def to_instance(self):
+        return self.buffer.entity(**self.params)
+
+    def subquery(self, *return_columns):
+        return self.to_instance().subquery(*return_columns)
+
+    def __repr__(self):
+        return repr(self.to_instance())
+
+    __str__ = __repr__
+
+
+class RowBuffer:
+    """
+    Every buffered row of a batch: a TableBuffer per table, the params of
+    rows loaded as is (see `from_params`) and the resolver their deferred
+    keys are handed to once the batch is committed (see `take_rows`).
+    """
+
+    def __init__(self, sorted_tables, sorted_entities, resolver):
+        table_entity_map = {
+            entity.__table__: entity for entity in sorted_entities
+        }
+        self.tables = {
+            table: TableBuffer(table, table_entity_map.get(table))
+            for table in sorted_tables
+        }
+        self.join_params = {table: [] for table in sorted_tables}
+        self.resolver = resolver
+
+        # Tables with subqueries among their values
+        self.subquery_tables = set()
+
+        # Instances buffered in this batch that are still alive. Keeps an
+        # instance shared between items (e.g. a Tag) from being buffered twice
+        self.refs = WeakKeyDictionary()
+
+    @classmethod
+    def from_params(cls, sorted_tables, sorted_entities, resolver, table_params):
+        """
+        A RowBuffer holding rows given as {table: [params]}, e.g. read back
+        from a spool (see scrapy_sql.spool). They're inserted as is, like
+        the params of join tables.
+        """
+        row_buffer = cls(sorted_tables, sorted_entities, resolver)
+        for table, params in table_params.items():
+            row_buffer.join_params[table].extend(params)
+            if any(
+                column_value_is_subquery(value)
+                for param in params
+                for value in param.values()
+            ):
+                row_buffer.subquery_tables.add(table)
+        return row_buffer
+
+    def __len__(self):
+        return sum(len(buffer) for buffer in self.tables.values()) \
+            + sum(len(params) for params in self.join_params.values())
+
+    def append(self, instance):
+        buffer = self.tables[instance.__table__]
+        ref = buffer.append(instance)
+        if buffer.has_subqueries:
+            self.subquery_tables.add(buffer.table)
+        self.refs[instance] = ref
+        return ref
+
+    def store_pending(self, resolver, join_params):
+        """
+        Append the {table: [params]} of join tables prepared along with the
+        instances just appended, then note every value `resolver` deferred
+        in the row it belongs to (see TableBuffer.defer). Values whose
+        parent wasn't buffered with them are looked up with a subquery.
+        """
+        join_rows = {}  # {id(params): (TableBuffer, row index)}
+        for table, params in join_params.items():
+            buffer = self.tables[table]
+            for param in params:
+                join_rows[id(param)] = (buffer, buffer.append_params(param))
+            if buffer.has_subqueries:
+                self.subquery_tables.add(table)
+
+        for groups in resolver.pending.values():
+            for keys in groups.values():
+                for pendings in keys.values():
+                    for target, name, parent, parent_column in pendings:
+                        if isinstance(target, dict):
+                            buffer, index = join_rows[id(target)]
+                        else:
+                            ref = self.refs[target]
+                            buffer, index = ref.buffer, ref.index
+
+                        parent_ref = self.refs.get(parent)
+                        if parent_ref is None:
+                            buffer.columns[buffer.column_index[name]][index] = \
+                                parent.subquery(parent_column)
+                            self.subquery_tables.add(buffer.table)
+                        else:
+                            buffer.defer(index, name, parent_column, parent_ref.index)
+
+    def take_rows(self):
+        """
+        The rows to insert as ({table: [RowReference]}, {table: [params]}),
+        the rows of join tables (tables without an entity) as params. Their
+        deferred values are handed to the buffer's resolver, looked up by
+        the natural key of the parent row when its table is inserted.
+        """
+        table_instances = {}
+        table_params = {}
+        parents = {}  # A RowReference per parent row
+        for table, buffer in self.tables.items():
+            rows = buffer.rows()
+            if buffer.entity is None:
+                rows = [ref.params for ref in rows]
+                table_instances[table] = []
+                table_params[table] = rows + self.join_params[table]
+            else:
+                table_instances[table] = rows
+                table_params[table] = list(self.join_params[table])
+
+            for (name, parent_column), (indexes, parent_indexes) \
+                    in buffer.deferred.items():
+                parent_buffer = self.tables[parent_column.table]
+                for index, parent_index in zip(indexes, parent_indexes):
+                    parent = parents.get((parent_buffer, parent_index))
+                    if parent is None:
+                        parent = parents[parent_buffer, parent_index] = \
+                            RowReference(parent_buffer, parent_index)
+                    target = rows[index]
+                    if isinstance(target, dict):
+                        target.setdefault(name, None)
+                    if not self.resolver.defer(target, name, parent, parent_column):
+                        value = parent.subquery(parent_column)
+                        if isinstance(target, dict):
+                            target[name] = value
+                        else:
+                            setattr(target, name, value)
+                        self.subquery_tables.add(table)
+            buffer.deferred = {}
+        return table_instances, table_params
+
+    @staticmethod
+    def cascade(instance):
+        """The instance & every instance session.add would cascade it to"""
+        state = instance_state(instance)
+        return [instance] + [
+            obj for obj, *_ in
+            state.manager.mapper.cascade_iterator('save-update', state)
+        ]
@@ -0,0 +1,223 @@
+
+# Project Imports
+from .utils import load_table, unique_key_columns
+
+# SQLAlchemy Imports
+from sqlalchemy import select
+
+# 3rd 🎉 Imports
+from collections import OrderedDict
+import hashlib
+import math
+import struct
+import sys
+import threading
+
+
+class LRUCache:
+    """
+    Least recently used mapping, bounded in entries and/or in approximate
+    bytes of its keys & values. Whichever limit is reached first evicts.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # {key: (value, size)}
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @staticmethod
+    def entry_size(key, value):
+        return sys.getsizeof(key) \
+            + sum(sys.getsizeof(v) for v in key) \
+            + sys.getsizeof(value) \
+            + sum(sys.getsizeof(v) for v in value.values())
+
+    def get(self, key):
+        try:
+            value, _ = self.entries[key]
+        except KeyError:
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self.entries:
+            _, size = self.entries.pop(key)
+            self.size -= size
+
+        size = self.entry_size(key, value)
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while self.entries and (
+            (self.max_entries is not None and len(self.entries) > self.max_entries)
+            or (self.max_bytes is not None and self.size > self.max_bytes)
+        ):
+            _, (_, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+
+class KeyCache:
+    """
+    Remembers the primary keys (and other referenced columns) of parent
+    rows by natural key across the batches of a SQLAlchemyFeedStorage, so
+    the NaturalKeyResolver fills foreign keys without a lookup.
+
+    `max_entries` and `max_bytes` are either a limit for every table, or
+    a {table: limit} dict (tables as Table, model or import path) for the
+    tables listed. Shared by the storage's sessions & writer threads.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = self.limits(max_entries)
+        self.max_bytes = self.limits(max_bytes)
+        self.tables = {}  # {table: LRUCache}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def limits(limit):
+        if isinstance(limit, dict):
+            return {load_table(table): value for table, value in limit.items()}
+        return limit
+
+    @staticmethod
+    def table_limit(limits, table):
+        if isinstance(limits, dict):
+            return limits.get(table)
+        return limits
+
+    def caches(self, table):
+        """Whether the rows of `table` are cached"""
+        return self.table_limit(self.max_entries, table) is not None \
+            or self.table_limit(self.max_bytes, table) is not None
+
+    def table_cache(self, table):
+        cache = self.tables.get(table)
+        if cache is None:
+            cache = self.tables[table] = LRUCache(
+                self.table_limit(self.max_entries, table),
+                self.table_limit(self.max_bytes, table)
+            )
+        return cache
+
+    def get(self, table, column_names, values, column_name):
+        """The value of `column_name` of the row whose natural key is given"""
+        if not self.caches(table):
+            return None
+
+        with self.lock:
+            row = self.table_cache(table).get((column_names, values))
+            value = None if row is None else row.get(column_name)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def update(self, rows):
+        """Store rows of (table, key column names, key values, {column: value})"""
+        with self.lock:
+            for table, column_names, values, remote_values in rows:
+                if not self.caches(table):
+                    continue
+                cache = self.table_cache(table)
+                key = (column_names, values)
+                cached = cache.get(key)
+                cache.put(
+                    key,
+                    remote_values if cached is None else {**cached, **remote_values}
+                )
+
+
+class BloomFilter:
+    """
+    Set membership in `capacity` * ~10 bits (for a 1% error rate): a key
+    that was added is always found, a key that wasn't is found with a
+    probability of `error_rate` as long as `capacity` isn't exceeded.
+    """
+
+    header = struct.Struct('<4sQI')
+    magic = b'SQLB'
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.num_bits = max(
+            8,
+            math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(
+            1,
+            round(self.num_bits / capacity * math.log(2))
+        )
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.lock = threading.Lock()
+
+    def indexes(self, key):
+        digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        bits = self.bits
+        return all(
+            bits[index >> 3] & (1 << (index & 7))
+            for index in self.indexes(key)
+        )
+
+    def add(self, key):
+        for index in self.indexes(key):
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def update(self, keys):
+        with self.lock:
+            for key in keys:
+                self.add(key)
+
+    def save(self, path):
+        with self.lock, open(path, 'wb') as file:
+            file.write(self.header.pack(self.magic, self.num_bits, self.num_hashes))
+            file.write(self.bits)
+
+    def load(self, path):
+        """
+        Read the bits saved at `path`. Returns False, leaving the filter
+        empty, when the file doesn't exist or was saved with another size.
+        """
+        try:
+            with open(path, 'rb') as file:
+                header = file.read(self.header.size)
+                bits = file.read()
+        except FileNotFoundError:
+            return False
+
+        if len(header) != self.header.size:
+            return False
+        if self.header.unpack(header) != (self.magic, self.num_bits, self.num_hashes) \
+                or len(bits) != len(self.bits):
+            return False
+        self.bits[:] = bits
+        return True
+
+
+def seed_bloom_filter(bloom_filter, connection, table, yield_per=10_000):
+    """
+    Add the primary key & unique keys (see scrapy_sql.utils.unique_key_columns)
+    of every row of `table` to the filter, streamed from the database
+    """
+    for columns in unique_key_columns(table):
+        column_names = tuple(c.name for c in columns)
+        rows = connection.execution_options(yield_per=yield_per).execute(
+            select(*columns)
+        )
+        bloom_filter.update(
+            (column_names, tuple(row)) for row in rows
+        )
@@ -0,0 +1,81 @@
+
+# Project Imports
+from scrapy_sql.feedexport import SQLAlchemyFeedStorage
+from scrapy_sql.spool import consolidate
+
+# Scrapy / Twisted Imports
+from scrapy.commands import ScrapyCommand
+from scrapy.crawler import Crawler
+from scrapy.exceptions import UsageError
+from scrapy.spiders import Spider
+
+# 3rd 🎉 Imports
+import time
+
+
+class Command(ScrapyCommand):
+    """
+    `scrapy consolidate <uri>` merges the batches that spiders with a
+    `staging_dir` spooled into the database at <uri>. The FEEDS entry of the
+    URI, if there's one, and the SQLALCHEMY_* settings configure it.
+    """
+
+    requires_project = False
+    default_settings = {'LOG_LEVEL': 'INFO'}
+
+    def syntax(self):
+        return '[options] <uri>'
+
+    def short_desc(self):
+        return 'Merge the batches staged by scrapy-sql feeds into a database'
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            '--staging-dir',
+            help='staging directory, defaults to the staging_dir feed option'
+        )
+        parser.add_argument(
+            '--segments-per-batch',
+            type=int,
+            default=10,
+            help='staged segments committed together (default: 10)'
+        )
+        parser.add_argument(
+            '--watch',
+            type=float,
+            metavar='SECONDS',
+            help='keep consolidating, looking for new segments every SECONDS'
+        )
+
+    def run(self, args, opts):
+        if len(args) != 1:
+            raise UsageError()
+        uri = args[0]
+
+        feed_options = dict(self.settings.getdict('FEEDS').get(uri) or {})
+        staging_dir = opts.staging_dir \
+            or feed_options.pop('staging_dir', None) \
+            or self.settings.get('SQLALCHEMY_STAGING_DIR')
+        if staging_dir is None:
+            raise UsageError('No staging directory, use --staging-dir')
+
+        # The consolidator writes to the database itself
+        feed_options['staging_dir'] = None
+        feed_options['writer_threads'] = 0
+
+        storage = SQLAlchemyFeedStorage.from_crawler(
+            Crawler(Spider, self.settings),
+            uri,
+            feed_options=feed_options
+        )
+        try:
+            while True:
+                consolidate(storage, staging_dir, opts.segments_per_batch)
+                if opts.watch is None:
+                    break
+                time.sleep(opts.watch)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            storage.close_spider(None)
@@ -0,0 +1,119 @@
+
+# SQLAlchemy Imports
+from sqlalchemy import Engine, MetaData, inspect
+from sqlalchemy.exc import DBAPIError, NoSuchTableError
+
+# 3rd 🎉 Imports
+import threading
+from weakref import WeakKeyDictionary
+
+
+# create: create the tables that don't exist yet
+# verify_once: raise NoSuchTableError if any of them doesn't exist
+# skip: assume they exist, no DDL nor catalog query
+schema_modes = ('create', 'verify_once', 'skip')
+
+# {engine: tables already created or verified}, for the whole process
+_checked = WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def existing_tables(connection, tables):
+    """(schema, name) of the `tables` found in the database, one query per schema"""
+    inspector = inspect(connection)
+    existing = set()
+    for schema in {table.schema for table in tables}:
+        existing.update(
+            (schema, name) for name in inspector.get_table_names(schema=schema)
+        )
+    return existing
+
+
+def without_indexes(tables):
+    """
+    Copies of the tables without their non unique indexes. Unique indexes
+    are kept, since ON CONFLICT / INSERT IGNORE statements rely on them.
+    Every table of their MetaData is copied, so foreign keys still resolve.
+    """
+    metadata = MetaData()
+    copies = {}
+    for table in tables[0].metadata.sorted_tables:
+        copies[table] = table.to_metadata(metadata)
+    for table in tables:
+        copy = copies[table]
+        copy.indexes = {index for index in copy.indexes if index.unique}
+    return [copies[table] for table in tables]
+
+
+def create_indexes(connection, indexes):
+    for index in indexes:
+        index.create(connection, checkfirst=True)
+
+
+def ensure_tables(bind, tables, mode='create', defer_indexes=False):
+    """
+    Make sure the tables exist, at most once per engine & table for the
+    whole process. `bind` is an Engine, whose DDL then runs in a single
+    transaction, or a Connection.
+
+    Another process may create the same tables concurrently, e.g. those
+    sharing a `staging_dir`. Tables are created with `checkfirst` and, with
+    an Engine, a CREATE TABLE that still fails is checked & retried once.
+
+    With `defer_indexes` the tables that are created get their non unique
+    indexes later, which are returned for `create_indexes` to build once
+    the initial load is done. Returns [] otherwise.
+    """
+    if mode not in schema_modes:
+        raise ValueError(f'schema_mode must be one of {schema_modes}, not {mode!r}')
+    if mode == 'skip':
+        return []
+
+    engine = bind if isinstance(bind, Engine) else bind.engine
+    with _lock:
+        checked = _checked.setdefault(engine, set())
+        tables = [table for table in tables if table not in checked]
+    if not tables:
+        return []
+
+    if isinstance(bind, Engine):
+        try:
+            with bind.begin() as connection:
+                deferred = create_tables(connection, tables, mode, defer_indexes)
+        except DBAPIError:
+            # e.g. "table already exists", created by another process
+            # since the catalog was checked. Tables that now exist are left out
+            with bind.begin() as connection:
+                deferred = create_tables(connection, tables, mode, defer_indexes)
+    else:
+        deferred = create_tables(bind, tables, mode, defer_indexes)
+
+    with _lock:
+        _checked.setdefault(engine, set()).update(tables)
+    return deferred
+
+
+def create_tables(connection, tables, mode='create', defer_indexes=False):
+    """The uncached part of `ensure_tables`"""
+    existing = existing_tables(connection, tables)
+    missing = [
+        table for table in tables
+        if (table.schema, table.name) not in existing
+    ]
+    if not missing:
+        return []
+    if mode == 'verify_once':
+        raise NoSuchTableError(', '.join(table.fullname for table in missing))
+
+    deferred = []
+    # Grouped by MetaData, e.g. the dead letter table has its own
+    for metadata in dict.fromkeys(table.metadata for table in missing):
+        group = [table for table in missing if table.metadata is metadata]
+        if defer_indexes:
+            deferred.extend(
+                index for table in group for index in table.indexes
+                if not index.unique
+            )
+            group = without_indexes(group)
+        group[0].metadata.create_all(connection, tables=group, checkfirst=True)
+    return deferred
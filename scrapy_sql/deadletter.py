@@ -0,0 +1,65 @@
+
+# Project Imports
+from .utils import column_value_is_subquery, subquery_to_string
+
+# SQLAlchemy Imports
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, Text
+
+# 3rd 🎉 Imports
+from datetime import datetime, timezone
+import json
+import threading
+
+
+# Dead letter tables live outside of the declarative base's metadata
+metadata = MetaData()
+
+# Writer threads append to the same files
+_file_lock = threading.Lock()
+
+
+def dead_letter_table(name):
+    """The table rows rejected by ScrapyBulkSession are inserted into"""
+    if name in metadata.tables:
+        return metadata.tables[name]
+
+    return Table(
+        name,
+        metadata,
+        Column('id', Integer, primary_key=True),
+        Column('table_name', String(255), nullable=False),
+        Column('row', Text, nullable=False),
+        Column('error', Text, nullable=False),
+        Column('rejected_at', DateTime, nullable=False)
+    )
+
+
+def dead_letter(table, params, error):
+    """
+    A rejected row as the params of a dead letter table row. The row itself
+    is JSON, subqueries as SQL and values JSON can't represent as strings.
+    """
+    row = {
+        name: subquery_to_string(value)
+        if column_value_is_subquery(value) else value
+        for name, value in params.items()
+    }
+    return {
+        'table_name': table.name,
+        'row': json.dumps(row, default=str),
+        'error': str(getattr(error, 'orig', None) or error),
+        'rejected_at': datetime.now(timezone.utc).replace(tzinfo=None)
+    }
+
+
+def write_dead_letters(path, dead_letters):
+    """Append dead letters to a JSON lines file, one object per row"""
+    lines = [
+        json.dumps(
+            {**dead_letter, 'row': json.loads(dead_letter['row'])},
+            default=str
+        )
+        for dead_letter in dead_letters
+    ]
+    with _file_lock, open(path, 'a', encoding='utf-8') as file:
+        file.writelines(line + '\n' for line in lines)
@@ -0,0 +1,88 @@
+
+# SQLAlchemy Imports
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# 3rd 🎉 Imports
+import atexit
+from collections import Counter
+import threading
+
+
+def freeze(value):
+    """A hashable equivalent of an option value, e.g. of connect_args"""
+    if isinstance(value, dict):
+        return tuple(sorted(
+            ((key, freeze(v)) for key, v in value.items()),
+            key=repr
+        ))
+    if isinstance(value, (list, tuple, set)):
+        return tuple(freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
+
+
+class EngineRegistry:
+    """
+    The engines of a process, one per URI & options, so feeds, feed
+    batches and the spiders of a CrawlerProcess writing to the same
+    database share a pool of warm connections.
+
+    `acquire` creates the engine the first time and counts the storages
+    using it. An engine no storage uses anymore keeps its pool, until
+    `dispose` is called, at the latest when the process exits.
+    """
+
+    def __init__(self):
+        self.engines = {}  # {key: engine}
+        self.references = Counter()  # {key: storages using the engine}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.engines)
+
+    @staticmethod
+    def key(uri, options):
+        return str(uri), freeze(options)
+
+    def acquire(self, uri, create, **options):
+        """
+        The engine of `uri` & `options`, created with
+        `create(uri, **options)` unless one already is
+        """
+        key = self.key(uri, options)
+        with self.lock:
+            engine = self.engines.get(key)
+            if engine is None:
+                engine = self.engines[key] = create(uri, **options)
+            self.references[key] += 1
+            return engine
+
+    def release(self, engine):
+        """A storage is done with an engine it acquired"""
+        with self.lock:
+            for key, registered in self.engines.items():
+                if registered is engine and self.references[key]:
+                    self.references[key] -= 1
+                    return
+
+    def dispose(self):
+        """
+        Close the pooled connections of the engines no storage uses and
+        forget them. Async engines have to be disposed of on their event
+        loop, their connections close with the process.
+        """
+        with self.lock:
+            for key, engine in list(self.engines.items()):
+                if self.references[key]:
+                    continue
+                del self.engines[key]
+                del self.references[key]
+                if not isinstance(engine, AsyncEngine):
+                    engine.dispose()
+
+
+engines = EngineRegistry()
+atexit.register(engines.dispose)
@@ -12,3 +12,8 @@ class SQLAlchemyInstanceExporter(BaseItemExporter):
 
     def export_item(self, instance):
         self.add(self.session, instance)
+
+        # Set by SQLAlchemyFeedStorage.open to flush incrementally
+        storage = self.session.info.get('storage')
+        if storage is not None:
+            storage.item_exported(instance)
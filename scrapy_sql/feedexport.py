@@ -5,27 +5,168 @@ from scrapy_sql._defaults import (
     _default_commit,
     _default_insert
 )
-from scrapy_sql.session import ScrapyBulkSession
-from scrapy_sql.utils import load_table, load_stmt
+from scrapy_sql.buffers import RowBuffer
+from scrapy_sql.caches import BloomFilter, KeyCache, seed_bloom_filter
+from scrapy_sql.ddl import create_indexes, ensure_tables
+from scrapy_sql.deadletter import dead_letter_table
+from scrapy_sql.engines import engines
+from scrapy_sql.session import ORMStatementCache, ScrapyBulkSession
+from scrapy_sql.spool import (
+    Spool,
+    load_segments,
+    orphaned_segments,
+    remove_segments
+)
+from scrapy_sql.stmts import ignores_conflicts
+from scrapy_sql.utils import (
+    instance_size,
+    load_stmt,
+    load_table,
+    unique_key_columns
+)
+from scrapy_sql.writer import SQLAlchemyWriter
 
 # Scrapy / Twisted Imports
 from scrapy import signals
 from scrapy.extensions.feedexport import IFeedStorage, build_storage
 from scrapy.exceptions import NotConfigured
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.log import failure_to_exc_info
 from scrapy.utils.misc import load_object
 from scrapy.utils.python import get_func_args
+from scrapy.utils.reactor import is_asyncio_reactor_installed
 
-from twisted.internet import threads
+from twisted.internet import defer, task, threads
 
 # SQLAlchemy Imports
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import Session, sessionmaker
 
 # 3rd 🎉 Imports
+import asyncio
+import logging
+import os
+import threading
 from urllib.parse import urlparse
+from weakref import WeakSet
 from zope.interface import implementer
 
 
+logger = logging.getLogger(__name__)
+
+
+# Feed options that fall back to a crawler setting when they aren't given.
+# Their default values live with the objects that consume them.
+_feed_option_settings = {
+    'resolve_chunk_size': 'SQLALCHEMY_RESOLVE_CHUNK_SIZE',
+    'returning': 'SQLALCHEMY_RETURNING',
+    'flush_every_items': 'SQLALCHEMY_FLUSH_EVERY_ITEMS',
+    'flush_every_bytes': 'SQLALCHEMY_FLUSH_EVERY_BYTES',
+    'flush_interval_seconds': 'SQLALCHEMY_FLUSH_INTERVAL_SECONDS',
+    'writer_threads': 'SQLALCHEMY_WRITER_THREADS',
+    'writer_queue_size': 'SQLALCHEMY_WRITER_QUEUE_SIZE',
+    'sqlite_journal_mode': 'SQLALCHEMY_SQLITE_JOURNAL_MODE',
+    'sqlite_synchronous': 'SQLALCHEMY_SQLITE_SYNCHRONOUS',
+    'max_rows_per_statement': 'SQLALCHEMY_MAX_ROWS_PER_STATEMENT',
+    'max_params_per_statement': 'SQLALCHEMY_MAX_PARAMS_PER_STATEMENT',
+    'executemany_page_size': 'SQLALCHEMY_EXECUTEMANY_PAGE_SIZE',
+    'transaction_scope': 'SQLALCHEMY_TRANSACTION_SCOPE',
+    'log_rows_sample': 'SQLALCHEMY_LOG_ROWS_SAMPLE',
+    'change_detection': 'SQLALCHEMY_CHANGE_DETECTION',
+    'dedup': 'SQLALCHEMY_DEDUP',
+    'key_cache_size': 'SQLALCHEMY_KEY_CACHE_SIZE',
+    'key_cache_bytes': 'SQLALCHEMY_KEY_CACHE_BYTES',
+    'bloom_filters': 'SQLALCHEMY_BLOOM_FILTERS',
+    'bloom_filter_error_rate': 'SQLALCHEMY_BLOOM_FILTER_ERROR_RATE',
+    'bloom_filter_dir': 'SQLALCHEMY_BLOOM_FILTER_DIR',
+    'staging_dir': 'SQLALCHEMY_STAGING_DIR',
+    'spool_dir': 'SQLALCHEMY_SPOOL_DIR',
+    'spool_fsync_every': 'SQLALCHEMY_SPOOL_FSYNC_EVERY',
+    'max_retries': 'SQLALCHEMY_MAX_RETRIES',
+    'retry_backoff': 'SQLALCHEMY_RETRY_BACKOFF',
+    'bisect': 'SQLALCHEMY_BISECT',
+    'dead_letter_path': 'SQLALCHEMY_DEAD_LETTER_PATH',
+    'dead_letter_table': 'SQLALCHEMY_DEAD_LETTER_TABLE',
+    'pool_size': 'SQLALCHEMY_POOL_SIZE',
+    'max_overflow': 'SQLALCHEMY_MAX_OVERFLOW',
+    'pool_pre_ping': 'SQLALCHEMY_POOL_PRE_PING',
+    'pool_recycle': 'SQLALCHEMY_POOL_RECYCLE',
+    'connect_args': 'SQLALCHEMY_CONNECT_ARGS',
+    'share_engine': 'SQLALCHEMY_SHARE_ENGINE',
+    'schema_mode': 'SQLALCHEMY_SCHEMA_MODE',
+    'defer_indexes': 'SQLALCHEMY_DEFER_INDEXES',
+}
+
+
+def set_sqlite_pragmas(engine, journal_mode=None, synchronous=None):
+    """
+    Run `PRAGMA journal_mode` & `PRAGMA synchronous` on every new
+    connection of a SQLite engine. Pragmas that are None are left alone.
+    """
+    pragmas = {
+        'journal_mode': journal_mode,
+        'synchronous': synchronous
+    }
+    pragmas = {
+        pragma: value for pragma, value in pragmas.items()
+        if value is not None
+    }
+    if not pragmas:
+        return
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f'PRAGMA {pragma}={value}')
+        cursor.close()
+
+
+def begin_sqlite_transactions(engine):
+    """
+    SQLAlchemy's recipe for savepoints with pysqlite & aiosqlite: the driver
+    doesn't BEGIN before a SAVEPOINT, so the first one would open the
+    transaction and its RELEASE commit it. The driver's own transaction
+    handling is disabled and BEGIN emitted when a transaction begins.
+    """
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
+def new_engine(uri, sqlite_pragmas=None, **kwargs):
+    """
+    `create_async_engine` for the URI of an async driver, `create_engine`
+    otherwise. `sqlite_pragmas` are the kwargs of `set_sqlite_pragmas`.
+    SQLite engines BEGIN their transactions, see `begin_sqlite_transactions`.
+    """
+    if make_url(uri).get_dialect().is_async:
+        engine = create_async_engine(uri, **kwargs)
+        sync_engine = engine.sync_engine
+    else:
+        engine = sync_engine = create_engine(uri, **kwargs)
+    if sync_engine.dialect.name == 'sqlite':
+        begin_sqlite_transactions(sync_engine)
+    if sqlite_pragmas:
+        set_sqlite_pragmas(sync_engine, **sqlite_pragmas)
+    return engine
+
+
+# Engine options given as feed options, passed on when they're set
+_engine_options = (
+    'pool_size',
+    'max_overflow',
+    'pool_pre_ping',
+    'pool_recycle',
+)
+
+
 class SQLAlchemyInstanceFilter:
 
     def __init__(self, feed_options):
@@ -117,12 +258,19 @@ class SQLAlchemyFeedStorage:
             )
         )
 
+        for option, setting in _feed_option_settings.items():
+            if setting in crawler.settings:
+                feed_options.setdefault(option, crawler.settings.get(setting))
+
         obj = build_storage(
             cls,
             uri,
             feed_options=feed_options,
         )
 
+        # Used by the writer to pause the engine when it falls behind
+        obj.crawler = crawler
+
         # Set signals for cls
         # crawler.signals.connect(obj.close_spider, signals.spider_closed)
 
@@ -142,7 +290,53 @@ class SQLAlchemyFeedStorage:
         # sessionmaker_kwargs keys: bind, class_, autoflush, expire_on_commit, info
         self.sessionmaker_kwargs = feed_options.get('sessionmaker_kwargs')
 
-        self.engine = create_engine(self.uri, echo=feed_options.get('echo'))
+        self.is_sqlite = urlparse(self.uri).scheme.startswith('sqlite')
+        # Async drivers (asyncpg, aiosqlite, asyncmy...) are written on the
+        # asyncio event loop of the reactor, see `commit_async`
+        self.is_async = make_url(self.uri).get_dialect().is_async
+
+        engine_options = {
+            option: feed_options[option]
+            for option in _engine_options
+            if feed_options.get(option) is not None
+        }
+        engine_options['echo'] = feed_options.get('echo')
+        connect_args = dict(feed_options.get('connect_args') or {})
+        if self.is_sqlite:
+            engine_options['sqlite_pragmas'] = {
+                'journal_mode': feed_options.get('sqlite_journal_mode', 'WAL'),
+                'synchronous': feed_options.get('sqlite_synchronous', 'NORMAL')
+            }
+            if not self.is_async:
+                # The connection is created on one thread & used by the writer
+                connect_args.setdefault('check_same_thread', False)
+        if connect_args:
+            engine_options['connect_args'] = connect_args
+
+        # Engines are shared by every storage of the process with the same
+        # URI & options (see scrapy_sql.engines), except in-memory SQLite
+        # databases, which would be shared along with them
+        self.shared_engine = feed_options.get('share_engine', True) and not (
+            self.is_sqlite
+            and make_url(self.uri).database in (None, '', ':memory:')
+        )
+        if self.shared_engine:
+            engine = engines.acquire(self.uri, new_engine, **engine_options)
+        else:
+            engine = new_engine(self.uri, **engine_options)
+        self.engine_released = False
+
+        self.async_engine = engine if self.is_async else None
+        self.engine = engine.sync_engine if self.is_async else engine
+
+        # Bloom filters drop stored rows, see `check_bloom_filters`
+        if feed_options.get('bloom_filters') and not feed_options.get('staging_dir'):
+            try:
+                self.check_bloom_filters()
+            except ValueError:
+                self._dispose(None)
+                raise
+
         self.sessionmaker_kwargs['bind'] = self.engine
 
         session_cls = load_object(self.sessionmaker_kwargs['class_'])
@@ -150,22 +344,494 @@ class SQLAlchemyFeedStorage:
         if 'feed_options' in get_func_args(session_cls):
             self.sessionmaker_kwargs['feed_options'] = feed_options
 
+        # Natural key -> primary key of parent rows, kept across batches
+        self.key_cache = None
+        if feed_options.get('key_cache_size') or feed_options.get('key_cache_bytes'):
+            self.key_cache = KeyCache(
+                max_entries=feed_options.get('key_cache_size'),
+                max_bytes=feed_options.get('key_cache_bytes')
+            )
+
+        # {table: BloomFilter} of the tables in `bloom_filters`, seeded on open
+        self.bloom_filters = {}
+
         self.Session = sessionmaker(**self.sessionmaker_kwargs)
-        self.session = self.Session()
+        if 'feed_options' in get_func_args(session_cls):
+            # Statements are built & compiled once for every session of
+            # the storage, writer threads' included
+            self.Session.configure(info={
+                **(self.sessionmaker_kwargs.get('info') or {}),
+                'orm_stmt_cache': ORMStatementCache(feed_options['orm_stmts']),
+                'key_cache': self.key_cache,
+                'bloom_filters': self.bloom_filters
+            })
+        # Distributed ingestion: batches are spooled to a staging directory
+        # shared by every process, `scrapy consolidate` writes them
+        self.staging = None
+        if feed_options.get('staging_dir'):
+            self.staging = Spool(feed_options['staging_dir'])
+
+        # Write-ahead spool: the rows of each exported item are appended to
+        # a segment of `spool_dir`, removed once its batch is committed
+        self.spool = None
+        self.spooled = WeakSet()  # Instances in the current segment
+        self.replayed = []  # Segments of a previous run, see `open`
+        if feed_options.get('spool_dir') and self.staging is None:
+            if not hasattr(session_cls, 'spool_params'):
+                raise NotConfigured('spool_dir requires a ScrapyBulkSession')
+            self.spool = Spool(
+                feed_options['spool_dir'],
+                fsync_every=feed_options.get('spool_fsync_every', 1000)
+            )
 
-        # Create database/tables if they don't already exist
-        self.Base.metadata.create_all(self.engine)
+        # Non unique indexes of the tables this storage created, built once
+        # its first load is stored when `defer_indexes` is set
+        self.deferred_indexes = []
+
+        if self.is_async:
+            # The exporter adds to the sync session an AsyncSession proxies
+            self.async_session = self.new_async_session()
+            self.session = self.async_session.sync_session
+            self.opening = None  # Task creating the tables, see `open`
+            self.write_lock = asyncio.Lock()  # Batches are written in order
+        else:
+            self.session = self.Session()
+
+            # Create database/tables if they don't already exist, once per
+            # engine & process (see scrapy_sql.ddl)
+            if self.staging is None:
+                self.create_tables(self.engine)
+
+        # Incremental flushing, all disabled by default
+        self.flush_every_items = feed_options.get('flush_every_items')
+        self.flush_every_bytes = feed_options.get('flush_every_bytes')
+        self.flush_interval_seconds = feed_options.get('flush_interval_seconds')
+        self.buffered_items = 0
+        self.buffered_bytes = 0
+        self.flush_loop = None
+
+        # Commits happen on dedicated writer threads, each with its own
+        # session. SQLite allows a single writer, and in-memory databases
+        # only exist on the connection of the thread that created them, so
+        # those are written synchronously. So are sessions that can't take
+        # their batch out as rows (see ScrapyBulkSession.take_batch), as a
+        # writer thread mustn't share instances with the exporter's session
+        self.crawler = None
+        self.stats_lock = threading.Lock()  # Writer threads publish stats
+        self.writer = None
+        self.writes = []  # Deferreds of the batches handed to the writer
+        writer_threads = feed_options.get('writer_threads', 1)
+        if self.is_async or self.staging is not None \
+                or not hasattr(session_cls, 'take_batch'):
+            writer_threads = 0
+        elif self.is_sqlite:
+            in_memory = self.engine.url.database in (None, '', ':memory:')
+            writer_threads = 0 if in_memory else min(writer_threads, 1)
+        if writer_threads:
+            self.writer = SQLAlchemyWriter(
+                self.Session,
+                self.commit_batch,
+                threads=writer_threads,
+                queue_size=feed_options.get('writer_queue_size', 2)
+            )
 
     def open(self, spider):
         self.session.rollback()
+        # Lets the exporter report each exported item back to the storage
+        self.session.info['storage'] = self
+
+        if self.staging is not None:
+            pass  # The database isn't used
+        elif self.is_async:
+            if not is_asyncio_reactor_installed():
+                raise NotConfigured(
+                    f'{self.engine.dialect.driver} is an async driver, set '
+                    'TWISTED_REACTOR to '
+                    'twisted.internet.asyncioreactor.AsyncioSelectorReactor'
+                )
+            self.opening = asyncio.ensure_future(self.open_async())
+        elif self.feed_options.get('bloom_filters'):
+            if self.writer is None and self.is_sqlite:
+                # Written on this thread anyway
+                self.load_bloom_filters()
+            else:
+                # Seeding scans whole tables; rows are written without a
+                # filter until theirs is seeded
+                self.writes.append(threads.deferToThread(self.load_bloom_filters))
+
+        if self.spool is not None:
+            self.replay_spool()
+
+        if self.writer is not None:
+            self.writer.crawler = self.crawler
+            self.writer.start()
+
+        if self.flush_interval_seconds:
+            self.start_flush_loop()
+
         return self.session
 
+    def start_flush_loop(self):
+        self.flush_loop = task.LoopingCall(self.flush)
+        d = self.flush_loop.start(self.flush_interval_seconds, now=False)
+        d.addErrback(self.flush_loop_failed, self.flush_loop)
+
+    def flush_loop_failed(self, failure, flush_loop):
+        """
+        A flush of `flush_interval_seconds` raised, which stops its loop:
+        log the error & start flushing again, unless `store` stopped it.
+        """
+        logger.error(
+            'Periodic flush of %s failed',
+            self.engine.url,
+            exc_info=failure_to_exc_info(failure)
+        )
+        if flush_loop is self.flush_loop:
+            self.start_flush_loop()
+
+    def create_tables(self, bind):
+        """
+        Create or verify the tables, the dead letter table's too, according
+        to `schema_mode`
+        """
+        tables = list(self.Base.metadata.sorted_tables)
+        if self.feed_options.get('dead_letter_table'):
+            tables.append(dead_letter_table(self.feed_options['dead_letter_table']))
+
+        self.deferred_indexes = ensure_tables(
+            bind,
+            tables,
+            mode=self.feed_options.get('schema_mode', 'create'),
+            defer_indexes=self.feed_options.get('defer_indexes', False)
+        )
+
+    def create_deferred_indexes(self, result=None):
+        """Build the indexes `defer_indexes` held back, once the load is stored"""
+        indexes, self.deferred_indexes = self.deferred_indexes, []
+        if not indexes:
+            return result
+
+        if self.is_async:
+            async def create():
+                async with self.async_engine.begin() as connection:
+                    await connection.run_sync(create_indexes, indexes)
+            return deferred_from_coro(create()).addCallback(lambda _: result)
+
+        with self.engine.begin() as connection:
+            create_indexes(connection, indexes)
+        return result
+
+    def bloom_filter_path(self, table):
+        directory = self.feed_options.get('bloom_filter_dir')
+        if directory is None:
+            return None
+        return os.path.join(directory, f'{table.name}.bloom')
+
+    def new_async_session(self):
+        return AsyncSession(self.async_engine, sync_session_class=self.Session)
+
+    async def open_async(self):
+        """Create the tables & open the Bloom filters on the event loop"""
+        async with self.async_engine.begin() as connection:
+            await connection.run_sync(self.create_tables)
+            if self.feed_options.get('bloom_filters'):
+                await connection.run_sync(self.open_bloom_filters)
+
+    async def commit_async(self, batch):
+        """
+        Commit a batch with a new AsyncSession. The commit hook runs on its
+        sync session through `run_sync`, which awaits every database call on
+        the event loop instead of handing the batch to a thread.
+        """
+        await self.opening
+        async with self.write_lock:
+            async with self.new_async_session() as session:
+                SQLAlchemyWriter.attach_batch(session.sync_session, batch)
+                await session.run_sync(self.commit_batch)
+
+    def check_bloom_filters(self):
+        """
+        Rows found in a Bloom filter are dropped, so its table must be
+        written by a statement skipping conflicting rows, see
+        scrapy_sql.stmts.ignores_conflicts.
+        """
+        orm_stmts = self.feed_options['orm_stmts']
+        stmt_cache = ORMStatementCache(orm_stmts)
+        session = Session(bind=self.engine)
+        for table in self.feed_options['bloom_filters']:
+            table = load_table(table)
+            stmt = stmt_cache.get(table, session)
+            if not ignores_conflicts(stmt, self.engine.dialect):
+                func = orm_stmts[table]
+                raise ValueError(
+                    f'bloom_filters: {table.name} is written with '
+                    f'{getattr(func, "__name__", func)}, its stored rows '
+                    'would be dropped rather than updated or rejected; use '
+                    'insert_ignore or an ignoring loader'
+                )
+
+    def load_bloom_filters(self):
+        with self.engine.connect() as connection:
+            self.open_bloom_filters(connection)
+
+    def open_bloom_filters(self, connection):
+        """
+        Load the filter of each table of `bloom_filters` from
+        `bloom_filter_dir`, or seed it with the keys stored in the database.
+        Each row adds its primary key & every unique key to the filter, so
+        it's sized for `capacity` times as many keys. A filter is only used
+        once seeded.
+        """
+        for table, capacity in (self.feed_options.get('bloom_filters') or {}).items():
+            table = load_table(table)
+            if table in self.bloom_filters:
+                continue
+
+            bloom_filter = BloomFilter(
+                capacity * len(unique_key_columns(table)),
+                self.feed_options.get('bloom_filter_error_rate', 0.01)
+            )
+            path = self.bloom_filter_path(table)
+            if path is None or not bloom_filter.load(path):
+                seed_bloom_filter(bloom_filter, connection, table)
+            self.bloom_filters[table] = bloom_filter
+
+    def save_bloom_filters(self, result=None):
+        for table, bloom_filter in self.bloom_filters.items():
+            path = self.bloom_filter_path(table)
+            if path is not None:
+                os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+                bloom_filter.save(path)
+        return result
+
+    def replay_spool(self):
+        """
+        Add the rows of the segments a previous run left in `spool_dir`,
+        its uncommitted batches, to the first batch of this one
+        """
+        paths = orphaned_segments(self.spool.directory)
+        if not paths:
+            return
+
+        table_params = load_segments(paths, self.Base.sorted_tables)
+        self.session.row_buffers.append(RowBuffer.from_params(
+            self.Base.sorted_tables,
+            self.Base.sorted_entities,
+            self.session.new_resolver(),
+            table_params
+        ))
+        self.replayed = paths
+
+        rows = sum(map(len, table_params.values()))
+        self.buffered_items += rows
+        stats = getattr(self.crawler, 'stats', None)
+        if stats is not None:
+            stats.inc_value('scrapy_sql/spool/replayed_rows', rows)
+
+    def seal_spool(self):
+        """
+        Seal the write-ahead segment of the batch being taken. Returns the
+        segments to remove once the batch is committed.
+        """
+        if self.spool is None:
+            return []
+
+        path = self.spool.seal()
+        paths = self.replayed + ([] if path is None else [path])
+        self.replayed = []
+        self.spooled = WeakSet()
+        return paths
+
+    @staticmethod
+    def remove_segments(result, paths):
+        remove_segments(paths)
+        return result
+
+    def close_spool(self, result=None):
+        """
+        Once every batch was written, or failed to be. The segments of the
+        batches that failed are replayed by the next storage to open.
+        """
+        if self.spool is not None:
+            self.spool.close()
+        return result
+
+    def item_exported(self, instance):
+        """
+        Called by the exporter after an instance was added to the session.
+        Flushes the buffered instances once a size threshold is reached.
+        """
+        if self.spool is not None:
+            instances = [
+                obj for obj in RowBuffer.cascade(instance)
+                if obj not in self.spooled
+            ]
+            self.spooled.update(instances)
+            self.spool.append(self.session.spool_params(instances))
+
+        self.buffered_items += 1
+        if self.flush_every_bytes:
+            self.buffered_bytes += instance_size(instance)
+
+        if (
+            (
+                self.flush_every_items
+                and self.buffered_items >= self.flush_every_items
+            )
+            or (
+                self.flush_every_bytes
+                and self.buffered_bytes >= self.flush_every_bytes
+            )
+        ):
+            self.flush()
+
+    def flush(self):
+        """
+        Commit what has been buffered so far with the commit hook and
+        expunge it, so the session only ever holds the current increment.
+        The remainder is committed when the feed slot calls `store`.
+        """
+        if self.buffered_items == 0:
+            return
+
+        segments = self.seal_spool()
+        if self.staging is not None:
+            self.stage(self.session)
+        elif self.is_async:
+            batch = SQLAlchemyWriter.take_batch(self.session)
+            d = deferred_from_coro(self.commit_async(batch))
+            self.writes.append(d.addCallback(self.remove_segments, segments))
+        elif self.writer is not None:
+            batch = self.writer.take_batch(self.session)
+            d = self.writer.submit(batch)
+            self.writes.append(d.addCallback(self.remove_segments, segments))
+        else:
+            self.commit_batch(self.session)
+            self.session.expunge_all()
+            remove_segments(segments)
+
+        self.buffered_items = 0
+        self.buffered_bytes = 0
+
     def store(self, session):
-        if urlparse(self.uri).scheme == 'sqlite':  # SQLite is not thread safe
+        if self.flush_loop is not None and self.flush_loop.running:
+            self.flush_loop.stop()
+        self.flush_loop = None
+
+        segments = self.seal_spool()
+        if self.staging is not None:
+            try:
+                self.stage(session)
+            finally:
+                self._dispose(None)
+        elif self.is_async:
+            batch = SQLAlchemyWriter.take_batch(session)
+            d = deferred_from_coro(self.commit_async(batch))
+            self.writes.append(d.addCallback(self.remove_segments, segments))
+            d = defer.gatherResults(self.writes, consumeErrors=True)
+            d.addCallback(self.save_bloom_filters)
+            d.addCallback(self.create_deferred_indexes)
+            d.addBoth(self.close_spool)
+            d.addBoth(self._dispose)
+            return d
+        elif self.writer is not None:
+            batch = self.writer.take_batch(session)
+            d = self.writer.submit(batch)
+            self.writes.append(d.addCallback(self.remove_segments, segments))
+            self.writes.append(self.writer.close())
+            d = defer.gatherResults(self.writes, consumeErrors=True)
+            d.addCallback(self.save_bloom_filters)
+            if self.deferred_indexes:
+                d.addCallback(
+                    lambda result: threads.deferToThread(
+                        self.create_deferred_indexes, result
+                    )
+                )
+            d.addBoth(self.close_spool)
+            # Hands the engine back once the writers are done with it
+            d.addBoth(self._dispose)
+            return d
+        elif self.is_sqlite:  # In-memory SQLite lives on one thread
+            try:
+                self.commit_batch(session)
+                remove_segments(segments)
+                self.save_bloom_filters()
+                self.create_deferred_indexes()
+            finally:
+                self.close_spool()
+                self._dispose(None)
+        else:
+            # Waits for the Bloom filters being seeded
+            d = defer.gatherResults(self.writes, consumeErrors=True)
+            d.addCallback(
+                lambda result: threads.deferToThread(self.commit_batch, session)
+            )
+            d.addCallback(self.remove_segments, segments)
+            d.addCallback(self.save_bloom_filters)
+            d.addCallback(
+                lambda result: threads.deferToThread(
+                    self.create_deferred_indexes, result
+                )
+            )
+            d.addBoth(self.close_spool)
+            return d.addBoth(self._dispose)
+
+    def stage(self, session):
+        """Spool the session's batch to a sealed segment of `staging_dir`"""
+        rows = self.staging.append(session.take_spool_params())
+        self.staging.seal()
+
+        stats = getattr(self.crawler, 'stats', None)
+        if stats is not None:
+            stats.inc_value('scrapy_sql/staging/rows', rows)
+
+    def commit_batch(self, session):
+        """Run the commit hook, then publish the session's stats"""
+        try:
             self.commit(session)
+        finally:
+            self.publish_stats(session)
+
+    def publish_stats(self, session):
+        """
+        Add the counters a ScrapyBulkSession keeps (e.g. rows dropped as
+        duplicates) and those of the key cache to the crawler stats,
+        prefixed with "scrapy_sql/"
+        """
+        counters = getattr(session, 'stats', None)
+        stats = getattr(self.crawler, 'stats', None)
+        with self.stats_lock:
+            if stats is not None and self.key_cache is not None:
+                stats.set_value('scrapy_sql/key_cache/hits', self.key_cache.hits)
+                stats.set_value('scrapy_sql/key_cache/misses', self.key_cache.misses)
+            if not counters:
+                return
+            if stats is not None:
+                for key, count in counters.items():
+                    stats.inc_value(f'scrapy_sql/{key}', count)
+            counters.clear()
+
+    def _dispose(self, result):
+        """
+        Hand a shared engine back to the registry, keeping its connections
+        for the next storage, or dispose of the storage's own engine
+        """
+        if self.engine_released:
+            return result
+        self.engine_released = True
+
+        if self.shared_engine:
+            engines.release(self.async_engine or self.engine)
+        elif self.is_async:
+            d = deferred_from_coro(self.async_engine.dispose())
+            return d.addCallback(lambda _: result)
         else:
-            return threads.deferToThread(self.commit, session)
+            self.engine.dispose()
+        return result
 
     def close_spider(self, spider):
+        self.close_spool()
         self.session.close()
-        self.engine.dispose()
+        # Own async engines are disposed of on the event loop by `store`
+        if self.shared_engine or not self.is_async:
+            self._dispose(None)
@@ -0,0 +1,386 @@
+
+# Project Imports
+from .utils import unique_key_columns
+
+# SQLAlchemy Imports
+from sqlalchemy import Column, MetaData, Table, select
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateTable
+
+# 3rd 🎉 Imports
+from decimal import Decimal
+import io
+import logging
+import os
+import tempfile
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+
+def group_rows(columns, params):
+    """
+    Group params by the columns they hold, as a COPY (or LOAD DATA) loads
+    the same columns for every row. Columns a param doesn't hold are left
+    to their server default instead of being loaded as NULL.
+
+    Returns {column names: [row tuples]}, columns in table order.
+    """
+    groups = {}
+    for param in params:
+        names = tuple(name for name in columns if name in param)
+        groups.setdefault(names, []).append(
+            tuple(param[name] for name in names)
+        )
+    return groups
+
+
+def csv_value(value):
+    """
+    Encode a value for PostgreSQL's CSV COPY format. An unquoted empty
+    value is NULL, every other value is quoted unless it's a number.
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float, Decimal)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = '\\x' + bytes(value).hex()
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def csv_buffer(rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(','.join(csv_value(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+_tsv_escapes = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+    '\0': '\\0',
+})
+
+
+def tsv_value(value):
+    """
+    Encode a value for MySQL's default LOAD DATA format: tab separated,
+    special characters escaped with a backslash and NULL written as \\N.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value).decode('latin-1')
+    return str(value).translate(_tsv_escapes)
+
+
+class BulkLoader:
+    """
+    Base class of the loaders `orm_stmts` functions may return instead of
+    a statement. ScrapyBulkSession.bulk_commit calls `load(session, params)`
+    with the params of every row of the table, and INSERTs rows whose values
+    contain subqueries with the loader's equivalent `insert` statement.
+
+    `on_conflict` is None, 'ignore' or 'replace', the semantics of
+    scrapy_sql.stmts.insert, insert_ignore and replace.
+    """
+
+    on_conflicts = (None, 'ignore', 'replace')
+
+    def __init__(self, table, on_conflict=None):
+        if on_conflict not in self.on_conflicts:
+            raise ValueError(
+                f'on_conflict must be one of {self.on_conflicts}, '
+                f'not {on_conflict!r}'
+            )
+        self.table = table
+        self.on_conflict = on_conflict
+        self.column_names = tuple(c.name for c in table.columns)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.table.name}, on_conflict={self.on_conflict!r})'
+
+    def conflict_columns(self, column_names):
+        """
+        The first unique key (see scrapy_sql.utils.unique_key_columns) whose
+        columns are all loaded, the conflict target of ON CONFLICT DO UPDATE
+        """
+        for columns in unique_key_columns(self.table):
+            if all(c.name in column_names for c in columns):
+                return columns
+        return None
+
+    def staging_table(self):
+        """A temporary table of the table's columns, without constraints"""
+        return Table(
+            f'scrapy_sql_staging_{self.table.name}_{uuid.uuid4().hex[:8]}',
+            MetaData(),
+            *[Column(c.name, c.type) for c in self.table.columns],
+            prefixes=['TEMPORARY'],
+        )
+
+    @property
+    def insert(self):
+        raise NotImplementedError()
+
+    def compile(self, dialect=None):
+        """The loading statement, used when logging"""
+        raise NotImplementedError()
+
+    def load(self, session, params):
+        raise NotImplementedError()
+
+
+class CopyFrom(BulkLoader):
+    """
+    Loads a table's rows with PostgreSQL's `COPY ... FROM STDIN` through the
+    copy API of the driver: psycopg 3 `cursor.copy`, psycopg2
+    `cursor.copy_expert` or asyncpg `copy_records_to_table`.
+
+    COPY can't skip or update rows that conflict with existing ones. With
+    `on_conflict` set to 'ignore' or 'replace' the rows are copied into a
+    temporary staging table first and merged with
+    `INSERT ... SELECT ... ON CONFLICT DO NOTHING / DO UPDATE`.
+    """
+
+    @property
+    def insert(self):
+        """The INSERT equivalent to this COPY"""
+        return self.merge_insert(self.table, self.column_names)
+
+    def compile(self, dialect=None):
+        return self.copy_sql(self.table, self.column_names)
+
+    @staticmethod
+    def copy_sql(table, column_names, csv=False):
+        name = f'{table.schema}.{table.name}' if table.schema else table.name
+        sql = f'COPY {name} ({", ".join(column_names)}) FROM STDIN'
+        return sql + ' WITH (FORMAT csv)' if csv else sql
+
+    def merge_insert(self, table, column_names):
+        stmt = postgresql.insert(table)
+
+        if self.on_conflict == 'ignore':
+            return stmt.on_conflict_do_nothing()
+
+        if self.on_conflict == 'replace':
+            conflict_columns = self.conflict_columns(column_names)
+            if conflict_columns is None:
+                return stmt
+            conflict_names = {c.name for c in conflict_columns}
+            update = {
+                name: stmt.excluded[name] for name in column_names
+                if name not in conflict_names
+            }
+            if not update:
+                return stmt.on_conflict_do_nothing()
+            return stmt.on_conflict_do_update(
+                index_elements=conflict_columns,
+                set_=update
+            )
+
+        return stmt
+
+    def load(self, session, params):
+        """COPY the params into the table, within the session's transaction"""
+        connection = session.connection()
+
+        for column_names, rows in group_rows(self.column_names, params).items():
+            if self.on_conflict is None:
+                self.copy(connection, self.table, column_names, rows)
+                continue
+
+            # A failure aborts the transaction, rolling back the staging
+            # table's creation along with it
+            staging = self.staging_table()
+            staging.create(connection)
+            self.copy(connection, staging, column_names, rows)
+            connection.execute(
+                self.merge_insert(self.table, column_names).from_select(
+                    column_names,
+                    select(*[staging.columns[name] for name in column_names])
+                )
+            )
+            staging.drop(connection)
+
+    def copy(self, connection, table, column_names, rows):
+        """Stream the rows with the copy API of the connection's driver"""
+        driver = connection.dialect.driver
+        dbapi_connection = connection.connection.dbapi_connection
+
+        if driver == 'psycopg':
+            with dbapi_connection.cursor() as cursor:
+                with cursor.copy(self.copy_sql(table, column_names)) as copy:
+                    for row in rows:
+                        copy.write_row(row)
+
+        elif driver == 'psycopg2':
+            with dbapi_connection.cursor() as cursor:
+                cursor.copy_expert(
+                    self.copy_sql(table, column_names, csv=True),
+                    csv_buffer(rows)
+                )
+
+        elif driver == 'asyncpg':
+            # SQLAlchemy's adapter around the asyncpg connection begins its
+            # transaction with the first statement it executes
+            if not connection.connection.driver_connection.is_in_transaction():
+                connection.exec_driver_sql('SELECT 1')
+            dbapi_connection.run_async(
+                lambda driver_connection: driver_connection.copy_records_to_table(
+                    table.name,
+                    records=rows,
+                    columns=column_names,
+                    schema_name=table.schema
+                )
+            )
+
+        else:
+            raise NotImplementedError(
+                f'COPY is not supported with the {driver} driver'
+            )
+
+
+class LoadDataInfile(BulkLoader):
+    """
+    Loads a table's rows with MySQL's `LOAD DATA LOCAL INFILE`. Rows are
+    written to a temporary tab separated file that the driver streams to
+    the server.
+
+    With LOCAL, LOAD DATA turns duplicate key errors into warnings and its
+    REPLACE deletes & reinserts conflicting rows, neither of which matches
+    scrapy_sql.stmts.insert or replace. So the rows are loaded into a
+    temporary staging table and merged with `INSERT ... SELECT`, `INSERT
+    IGNORE ... SELECT` or `INSERT ... SELECT ... ON DUPLICATE KEY UPDATE`.
+
+    Local infile has to be allowed by the server (`local_infile=ON`) and the
+    client, e.g. `mysql+pymysql://...?local_infile=1`. When it isn't, the
+    rows are INSERTed instead, for this & every later batch of the loader.
+    """
+
+    # ER_NOT_ALLOWED_COMMAND, ER_CLIENT_LOCAL_FILES_DISABLED &
+    # CR_LOAD_DATA_LOCAL_INFILE_REJECTED
+    local_infile_disabled_errors = (1148, 3948, 2068)
+
+    def __init__(self, table, on_conflict=None):
+        super().__init__(table, on_conflict)
+        self.local_infile = True
+
+    @property
+    def insert(self):
+        """The INSERT equivalent to this LOAD DATA"""
+        return self.merge_insert(self.table, self.column_names)
+
+    def merge_insert(self, table, column_names):
+        stmt = mysql.insert(table)
+
+        if self.on_conflict == 'ignore':
+            return stmt.prefix_with('IGNORE')
+
+        if self.on_conflict == 'replace':
+            primary_key = {c.name for c in table.primary_key.columns}
+            update = {
+                name: stmt.inserted[name] for name in column_names
+                if name not in primary_key
+            }
+            if not update:
+                return stmt.prefix_with('IGNORE')
+            return stmt.on_duplicate_key_update(update)
+
+        return stmt
+
+    def compile(self, dialect=None):
+        return self.load_sql('<file>', self.table, self.column_names)
+
+    @staticmethod
+    def load_sql(path, table, column_names):
+        path = path.replace('\\', '\\\\').replace("'", "\\'")
+        name = f'{table.schema}.{table.name}' if table.schema else table.name
+        return (
+            f"LOAD DATA LOCAL INFILE '{path}' "
+            f"INTO TABLE {name} CHARACTER SET utf8mb4 "
+            f"({', '.join(column_names)})"
+        )
+
+    @staticmethod
+    def write_file(file, rows):
+        for row in rows:
+            file.write('\t'.join(tsv_value(value) for value in row))
+            file.write('\n')
+        file.flush()
+
+    def load(self, session, params):
+        if not self.local_infile:
+            session.execute(self.insert, params)
+            return
+
+        connection = session.connection()
+
+        for column_names, rows in group_rows(self.column_names, params).items():
+            if not self.local_infile:
+                # Disabled while loading an earlier group
+                session.execute(
+                    self.merge_insert(self.table, column_names),
+                    [dict(zip(column_names, row)) for row in rows]
+                )
+                continue
+
+            # The driver opens the file by name, so it can't stay in memory
+            with tempfile.NamedTemporaryFile(
+                'w',
+                encoding='utf-8',
+                newline='',
+                prefix=f'scrapy_sql_{self.table.name}_',
+                suffix='.tsv',
+                delete=False
+            ) as file:
+                self.write_file(file, rows)
+
+            try:
+                self.load_file(session, connection, file.name, column_names, rows)
+            finally:
+                os.unlink(file.name)
+
+    def load_file(self, session, connection, path, column_names, rows):
+        """LOAD DATA the file into a staging table & merge it into the table"""
+        staging = self.staging_table()
+        connection.execute(CreateTable(staging))
+        # MySQL doesn't roll back DDL, the staging table is dropped whatever
+        # happens
+        try:
+            connection.exec_driver_sql(
+                self.load_sql(path, staging, column_names)
+            )
+        except DBAPIError as e:
+            code = e.orig.args[0] if e.orig is not None and e.orig.args else None
+            if code not in self.local_infile_disabled_errors:
+                raise
+            logger.warning(
+                f'LOAD DATA LOCAL INFILE is disabled ({e.orig}), '
+                f'INSERTing into {self.table.name} instead'
+            )
+            self.local_infile = False
+            session.execute(
+                self.merge_insert(self.table, column_names),
+                [dict(zip(column_names, row)) for row in rows]
+            )
+        else:
+            connection.execute(
+                self.merge_insert(self.table, column_names).from_select(
+                    column_names,
+                    select(*[staging.columns[name] for name in column_names])
+                )
+            )
+        finally:
+            connection.exec_driver_sql(f'DROP TEMPORARY TABLE {staging.name}')
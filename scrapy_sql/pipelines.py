@@ -0,0 +1,84 @@
+
+# Project Imports
+from scrapy_sql.exporters import SQLAlchemyInstanceExporter
+from scrapy_sql.feedexport import (
+    SQLAlchemyFeedStorage,
+    SQLAlchemyInstanceFilter,
+    _feed_option_settings
+)
+
+# Scrapy / Twisted Imports
+from scrapy.exceptions import NotConfigured
+from twisted.internet import defer
+
+
+class SQLAlchemyPipeline:
+    """
+    Item pipeline alternative to the FEEDS entry point. Instances are
+    written in micro-batches while the spider runs rather than when the
+    feed slot is closed, so a crash only loses the current batch.
+
+    Configured with SQLALCHEMY_PIPELINE_URI and SQLALCHEMY_PIPELINE_OPTIONS,
+    a dict of the same options as a FEEDS entry, falling back to the same
+    SQLALCHEMY_* settings. The writing is done by a SQLAlchemyFeedStorage.
+    Items that aren't instances of the declarative base pass through.
+
+    e.g.) ITEM_PIPELINES = {'scrapy_sql.pipelines.SQLAlchemyPipeline': 300}
+    """
+
+    # Used unless given as an option or a setting, as nothing would be
+    # written until the spider closes otherwise
+    default_options = {
+        'flush_every_items': 1000,
+        'flush_interval_seconds': 5,
+    }
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.feed_options = storage.feed_options
+        self.item_filter = SQLAlchemyInstanceFilter(self.feed_options)
+        self.session = None
+        self.exporter = None
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        uri = crawler.settings.get('SQLALCHEMY_PIPELINE_URI')
+        if uri is None:
+            raise NotConfigured('SQLALCHEMY_PIPELINE_URI is not set')
+
+        feed_options = dict(
+            crawler.settings.getdict('SQLALCHEMY_PIPELINE_OPTIONS')
+        )
+        for option, value in cls.default_options.items():
+            if _feed_option_settings[option] not in crawler.settings:
+                feed_options.setdefault(option, value)
+
+        return cls(
+            SQLAlchemyFeedStorage.from_crawler(
+                crawler,
+                uri,
+                feed_options=feed_options
+            )
+        )
+
+    def open_spider(self, spider):
+        self.session = self.storage.open(spider)
+        self.exporter = SQLAlchemyInstanceExporter(
+            self.session,
+            **self.feed_options['item_export_kwargs']
+        )
+
+    def process_item(self, item, spider):
+        if self.item_filter.accepts(item):
+            self.exporter.export_item(item)
+        return item
+
+    def close_spider(self, spider):
+        """Write what's left, returns a Deferred fired once it's written"""
+        d = defer.maybeDeferred(self.storage.store, self.session)
+        d.addBoth(self._close, spider)
+        return d
+
+    def _close(self, result, spider):
+        self.storage.close_spider(spider)
+        return result
@@ -0,0 +1,117 @@
+
+# SQLAlchemy Imports
+from sqlalchemy import Table, event
+from sqlalchemy.inspection import inspect
+from sqlalchemy.orm import Mapper
+
+# 3rd 🎉 Imports
+from types import MappingProxyType
+from weakref import WeakKeyDictionary
+
+
+class EntitySchema:
+    """
+    Everything ScrapyDeclarativeBase derives from a mapped class' table and
+    mapper, computed once instead of on every access. Shared by every
+    lookup, so it's read-only: tuples & MappingProxyType views.
+    """
+
+    __slots__ = (
+        'columns',
+        'column_names',
+        'column_name_to_column_obj_map',
+        'relationships',
+        'relationship_names',
+        'relationship_name_to_relationship_obj_map',
+        'field_names',
+    )
+
+    def __init__(self, cls):
+        self.columns = tuple(cls.__table__.columns)
+        self.column_names = tuple(c.name for c in self.columns)
+        self.column_name_to_column_obj_map = MappingProxyType({
+            column.name: column
+            for column in self.columns
+        })
+
+        self.relationships = tuple(inspect(cls).relationships)
+        self.relationship_names = tuple(
+            r.class_attribute.key for r in self.relationships
+        )
+        self.relationship_name_to_relationship_obj_map = MappingProxyType({
+            relationship.class_attribute.key: relationship
+            for relationship in self.relationships
+        })
+
+        self.field_names = self.column_names + self.relationship_names
+
+
+class MetaDataSchema:
+    """
+    The sorted tables of a MetaData & the entities of a registry mapped to
+    them, in insert order.
+    """
+
+    __slots__ = (
+        'sorted_tables',
+        'sorted_entities',
+        'tablename_to_entity_map',
+    )
+
+    def __init__(self, cls):
+        self.sorted_tables = tuple(cls.metadata.sorted_tables)
+
+        entities = [mapper.entity for mapper in cls._sa_registry.mappers]
+        table_entity_map = {entity.__table__: entity for entity in entities}
+
+        self.sorted_entities = tuple(
+            table_entity_map[table] for table in self.sorted_tables
+            if table in table_entity_map  # else table without entity, most likely a join table
+        )
+
+        d = {entity.__table__.name: entity for entity in entities}
+        for table in self.sorted_tables:  # Join tables, that don't have an entity
+            d.setdefault(table.name, table)
+        self.tablename_to_entity_map = MappingProxyType(d)
+
+
+_entity_schemas = WeakKeyDictionary()
+_metadata_schemas = WeakKeyDictionary()
+
+
+def entity_schema(cls):
+    try:
+        return _entity_schemas[cls]
+    except KeyError:
+        schema = _entity_schemas[cls] = EntitySchema(cls)
+        return schema
+
+
+def metadata_schema(cls):
+    """Cached per declarative base (or any of its subclasses)"""
+    registry = cls._sa_registry
+    try:
+        return _metadata_schemas[registry]
+    except KeyError:
+        schema = _metadata_schemas[registry] = MetaDataSchema(cls)
+        return schema
+
+
+def clear_schemas(*args, **kwargs):
+    """Mappers being (re)configured invalidates the cached schemas"""
+    _entity_schemas.clear()
+    _metadata_schemas.clear()
+
+
+def clear_metadata_schemas(table, metadata):
+    """
+    A table being added to a MetaData invalidates the schemas of the
+    registries using that MetaData, the others are kept
+    """
+    for registry in list(_metadata_schemas.keys()):
+        if registry.metadata is metadata:
+            del _metadata_schemas[registry]
+
+
+event.listen(Mapper, 'after_configured', clear_schemas)
+event.listen(Table, 'after_parent_attach', clear_metadata_schemas)
@@ -1,20 +1,267 @@
 
 # Project Imports
-from .utils import column_value_is_subquery, subquery_to_string, load_table, load_stmt
+from .buffers import RowBuffer
+from .deadletter import dead_letter, dead_letter_table, write_dead_letters
+from .spool import SpooledKey
+from .utils import (
+    column_value_is_subquery, subquery_to_string,
+    load_table, load_stmt, unique_key_columns,
+    chunk_rows, max_bind_params, params_size, row_hash
+)
 
 # Scrapy / Twisted Imports
 from scrapy.utils.misc import load_object
 from scrapy.utils.python import flatten, get_func_args
 
 # SQLAlchemy Imports
+from sqlalchemy import event, insert, select, tuple_
+from sqlalchemy.exc import (
+    DataError,
+    DBAPIError,
+    IntegrityError,
+    OperationalError,
+    SQLAlchemyError,
+    StatementError
+)
 from sqlalchemy.orm import Session
 from sqlalchemy.orm.attributes import instance_state
 from sqlalchemy.orm.base import ONETOMANY, MANYTOONE, MANYTOMANY  # ONETOONE not listed
+from sqlalchemy.util.concurrency import await_only, in_greenlet
 
 
 # 3rd 🎉 Imports
-from copy import deepcopy
+import asyncio
+from collections import Counter, defaultdict
 import logging
+import random
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+def _assign(target, name, value):
+    """Targets are either instances or param dicts of join tables"""
+    if isinstance(target, dict):
+        target[name] = value
+    else:
+        setattr(target, name, value)
+
+
+class NaturalKeyResolver:
+    """
+    Fills foreign key values whose parent primary key isn't known when the
+    batch is prepared.
+
+    Instead of generating one correlated subquery per row, the natural key
+    (a fully loaded primary key, unique constraint or unique index) of each
+    parent is collected. Once the parent table has been inserted the remote
+    values are fetched in bulk, with one
+    `SELECT ... WHERE (key columns) IN (...)` per chunk of distinct keys.
+    """
+
+    def __init__(self, chunk_size=500, returning=False, key_cache=None):
+        self.chunk_size = chunk_size
+        # When parent tables are inserted with RETURNING their instances
+        # receive primary keys, so parents without a natural key are
+        # deferred as well. Pending values are stored under a key of None.
+        self.returning = returning
+        # {parent_table: {key_column_names: {key_values: [pending, ...]}}}
+        self.pending = {}
+        # Set once a value was resolved to a subquery, see `resolve`
+        self.assigned_subqueries = False
+        # scrapy_sql.caches.KeyCache consulted before deferring a value, and
+        # the (table, key column names, key values, {column: value}) rows
+        # resolved since, stored in it once the batch is committed
+        self.key_cache = key_cache
+        self.resolved = []
+
+    @staticmethod
+    def natural_key(instance):
+        """
+        Returns the (column names, values) of the first unique key of the
+        instance that's fully loaded, or None if there isn't one.
+        """
+        for columns in unique_key_columns(instance.__table__):
+            values = tuple(getattr(instance, c.name) for c in columns)
+            if any(
+                value is None or column_value_is_subquery(value)
+                for value in values
+            ):
+                continue
+            return tuple(c.name for c in columns), values
+        return None
+
+    def defer(self, target, name, parent_instance, parent_column):
+        """
+        Register `target.name` to be filled with the value of `parent_column`
+        once the parent's table has been inserted.
+
+        Returns False when the parent has no usable natural key, in which case
+        the caller should fall back to a subquery.
+        """
+        natural_key = self.natural_key(parent_instance)
+        if natural_key is None and not self.returning:
+            return False
+
+        if natural_key is not None and self.key_cache is not None:
+            remote_value = self.key_cache.get(
+                parent_instance.__table__,
+                *natural_key,
+                parent_column.name
+            )
+            if remote_value is not None:
+                _assign(target, name, remote_value)
+                return True
+
+        column_names, values = natural_key or (None, id(parent_instance))
+        self.pending \
+            .setdefault(parent_instance.__table__, {}) \
+            .setdefault(column_names, {}) \
+            .setdefault(values, []) \
+            .append((target, name, parent_instance, parent_column))
+        return True
+
+    def resolve(self, session, table):
+        """
+        Fill every pending target whose parent lives in `table`.
+        Must be called after `table` has been inserted.
+        """
+        for column_names, keys in self.pending.pop(table, {}).items():
+            if column_names is not None and self.key_cache is not None:
+                for values, pendings in keys.items():
+                    remote_values = {
+                        parent_column.name: getattr(parent_instance, parent_column.name)
+                        for _, _, parent_instance, parent_column in pendings
+                    }
+                    if None not in remote_values.values():
+                        self.resolved.append(
+                            (table, column_names, values, remote_values)
+                        )
+
+            keys = self.resolve_from_instances(keys)
+
+            if column_names is None:  # Parents without a natural key
+                self.assigned_subqueries = self.assigned_subqueries or bool(keys)
+                for pendings in keys.values():
+                    for target, name, parent_instance, parent_column in pendings:
+                        _assign(
+                            target,
+                            name,
+                            parent_instance.subquery(parent_column)
+                        )
+                continue
+
+            key_columns = tuple(table.columns[name] for name in column_names)
+            return_columns = tuple({
+                parent_column.name: table.columns[parent_column.name]
+                for pendings in keys.values()
+                for _, _, _, parent_column in pendings
+            }.values())
+
+            distinct_keys = list(keys)
+            for start in range(0, len(distinct_keys), self.chunk_size):
+                chunk = distinct_keys[start:start + self.chunk_size]
+
+                if len(key_columns) == 1:
+                    where = key_columns[0].in_([key[0] for key in chunk])
+                else:
+                    where = tuple_(*key_columns).in_(chunk)
+
+                rows = session.execute(
+                    select(*key_columns, *return_columns).where(where)
+                )
+
+                for row in rows:
+                    key = tuple(row[:len(key_columns)])
+                    remote_values = dict(zip(
+                        (c.name for c in return_columns),
+                        row[len(key_columns):]
+                    ))
+
+                    for target, name, _, parent_column in keys.get(key, ()):
+                        _assign(target, name, remote_values[parent_column.name])
+
+                    if self.key_cache is not None:
+                        self.resolved.append(
+                            (table, column_names, key, remote_values)
+                        )
+
+
+    def assign_subqueries(self):
+        """
+        Fill every pending target with a subquery on its parent's natural
+        key instead of resolving it, e.g. for rows written to a spool
+        """
+        for groups in self.pending.values():
+            for keys in groups.values():
+                for pendings in keys.values():
+                    for target, name, parent_instance, parent_column in pendings:
+                        _assign(
+                            target,
+                            name,
+                            parent_instance.subquery(parent_column)
+                        )
+        self.pending = {}
+
+    def checkpoint(self):
+        """The state `restore` rolls back to, when a transaction is retried"""
+        pending = {
+            table: {
+                column_names: {
+                    values: list(pendings)
+                    for values, pendings in keys.items()
+                }
+                for column_names, keys in groups.items()
+            }
+            for table, groups in self.pending.items()
+        }
+        return pending, len(self.resolved), self.assigned_subqueries
+
+    def restore(self, checkpoint):
+        """
+        Undo the `resolve` calls since `checkpoint`. Targets are assigned
+        again when their parent's table is resolved anew.
+        """
+        pending, resolved, self.assigned_subqueries = checkpoint
+        self.pending = pending
+        del self.resolved[resolved:]
+
+    @staticmethod
+    def resolve_from_instances(keys):
+        """
+        Assign values the parent instances already hold, e.g. primary keys
+        back-filled by INSERT ... RETURNING. Returns the keys left to look up.
+        """
+        unresolved = {}
+        for values, pendings in keys.items():
+            for pending in pendings:
+                target, name, parent_instance, parent_column = pending
+                remote_value = getattr(parent_instance, parent_column.name)
+                if remote_value is None:
+                    unresolved.setdefault(values, []).append(pending)
+                else:
+                    _assign(target, name, remote_value)
+        return unresolved
+
+
+class SpoolingResolver:
+    """
+    Stands in for a NaturalKeyResolver when rows are spooled: values that
+    aren't known are set to the SpooledKey of their parent's natural key
+    right away. Parents without one are left to a subquery.
+    """
+
+    def defer(self, target, name, parent_instance, parent_column):
+        natural_key = NaturalKeyResolver.natural_key(parent_instance)
+        if natural_key is None:
+            return False
+        _assign(target, name, SpooledKey(
+            parent_instance.__table__.name,
+            *natural_key,
+            parent_column.name
+        ))
+        return True
 
 
 class ManyToOneBulkDP:
@@ -27,7 +274,7 @@ class ManyToOneBulkDP:
             self.relationship.class_attribute.key
         )
 
-    def prepare(self):
+    def prepare(self, resolver=None):
         """
         Prepare an instance with a ManyToOne relationship for bulk insert.
 
@@ -36,7 +283,10 @@ class ManyToOneBulkDP:
         If the foreign key column is None and the remote column has a value,
         assign the local column the value of the remote column
 
-        If both the local and remote columns have values of None,
+        If both the local and remote columns have values of None, defer the
+        column to the resolver, which looks up the value by the related
+        instance's natural key after its table is inserted.
+        Without a resolver, or when the related instance has no natural key,
         generate a subquery to populate the value while inserting.
         """
         
@@ -58,6 +308,14 @@ class ManyToOneBulkDP:
                 setattr(self.instance, local_column.name, remote_value)
                 continue
 
+            if resolver is not None and resolver.defer(
+                self.instance,
+                local_column.name,
+                self.related_instance,
+                remote_column
+            ):
+                continue
+
             setattr(
                 self.instance,
                 local_column.name,
@@ -87,10 +345,43 @@ class ManyToManyBulkDP:
             or parent_instance.subquery(parent_column)   # else subquery
         }
 
-    def prepare_secondary(self):
+    def determine_join_table_params(
+        self,
+        parent_instance,
+        pairs,
+        param,
+        resolver=None
+    ):
+        for parent_column, join_table_column in pairs:
+            if (
+                resolver is not None
+                and getattr(parent_instance, parent_column.name) is None
+                and resolver.defer(
+                    param,
+                    join_table_column.name,
+                    parent_instance,
+                    parent_column
+                )
+            ):
+                # Placeholder keeps the keys of every param identical,
+                # unless the value was known to the resolver's key cache
+                param.setdefault(join_table_column.name, None)
+                continue
+
+            param.update(
+                self.determine_join_table_column_value(
+                    parent_instance,
+                    parent_column,
+                    join_table_column
+                )
+            )
+
+    def prepare_secondary(self, resolver=None):
         """
-        Determine the subqueries necessary to insert the columns
-        of a join table
+        Determine the values necessary to insert the columns of a join table.
+
+        Parent values that aren't known yet are deferred to the resolver
+        when one is given, otherwise they're populated with subqueries.
         """
         
         if len(self.related_instances) == 0:
@@ -98,135 +389,1078 @@ class ManyToManyBulkDP:
         
         params = []
 
-        param = {}
-        for pair in self.relationship.synchronize_pairs:
-            parent_column, join_table_column = pair
-            param.update(
-                self.determine_join_table_column_value(
-                    self.instance,
-                    parent_column,
-                    join_table_column
-                )
+        for related_instance in self.related_instances:
+            param = {}
+
+            self.determine_join_table_params(
+                self.instance,
+                self.relationship.synchronize_pairs,
+                param,
+                resolver
+            )
+            self.determine_join_table_params(
+                related_instance,
+                self.relationship.secondary_synchronize_pairs,
+                param,
+                resolver
             )
 
-        for related_instance in self.related_instances:
+            params.append(param)
+
+        return params
 
-            secondary_param = deepcopy(param)
 
-            for pair in self.relationship.secondary_synchronize_pairs:
-                parent_column, join_table_column = pair
-                secondary_param.update(
-                    self.determine_join_table_column_value(
-                        related_instance,
-                        parent_column,
-                        join_table_column
-                    )
-                )
+def has_subqueries(values):
+    return any(column_value_is_subquery(value) for value in values)
 
-            params.append(secondary_param)
 
-        return params
+def row_keys(key_names, row, get_value):
+    """
+    The (column names, values) of every key in `key_names` the row holds,
+    leaving out keys with a NULL or a subquery, which can't be compared.
+    `get_value(row, column name)` is getattr for instances & RowReferences,
+    dict.get for the params of join tables.
+    """
+    keys = []
+    for names in key_names:
+        values = tuple(get_value(row, name) for name in names)
+        if not any(
+            value is None or column_value_is_subquery(value)
+            for value in values
+        ):
+            keys.append((names, values))
+    return keys
+
+
+class ORMStatementCache:
+    """
+    The statements of `orm_stmts`, built once per table & dialect instead of
+    on every commit, along with their compiled SQL for logging.
+
+    Whether a statement function is called as `func(table)` or
+    `func(table, session)` is detected from its signature up front.
+    """
+
+    def __init__(self, orm_stmts):
+        self.orm_stmts = orm_stmts
+        self.takes_session = {
+            table: len(get_func_args(func)) > 1
+            for table, func in orm_stmts.items()
+        }
+        self.stmts = {}  # {(table, dialect name): stmt}
+        self.sql = {}    # {(table, dialect name): compiled SQL}
+
+    def get(self, table, session):
+        dialect = session.get_bind().dialect
+        key = (table, dialect.name)
+        try:
+            return self.stmts[key]
+        except KeyError:
+            func = self.orm_stmts[table]
+            if self.takes_session[table]:
+                stmt = func(table, session)
+            else:
+                stmt = func(table)
+            self.stmts[key] = stmt
+            return stmt
+
+    def compiled(self, table, session):
+        dialect = session.get_bind().dialect
+        key = (table, dialect.name)
+        try:
+            return self.sql[key]
+        except KeyError:
+            stmt = self.get(table, session)
+            sql = self.sql[key] = str(stmt.compile(dialect=dialect))
+            return sql
 
 
 class ScrapyBulkSession(Session):
 
+    resolve_chunk_size = 500
+    returning = False
+    # Rows & bound parameters of a multi VALUES INSERT, the latter
+    # defaults to the dialect's limit (see scrapy_sql.utils.max_bind_params)
+    max_rows_per_statement = None
+    max_params_per_statement = None
+    # Rows per executemany() & per INSERT of insertmanyvalues
+    executemany_page_size = None
+    # per_batch: a single transaction per bulk_commit
+    # per_table: commit after each table
+    # savepoint_per_table: a single transaction, a savepoint per table
+    transaction_scope = 'per_batch'
+    transaction_scopes = ('per_batch', 'per_table', 'savepoint_per_table')
+    # Rows logged per table at DEBUG level, a random sample of this many,
+    # None logs every row. Rows are only formatted when it's set
+    log_rows_sample = 0
+    # Rows the approximate size of a table's rows is estimated from
+    log_size_sample = 100
+    # Which of the rows of a batch sharing a primary key or unique key is
+    # written: 'last' (last write wins), 'first' or None to write them all
+    dedup = 'last'
+    dedups = ('last', 'first', None)
+    # Transactions failing with a transient error (see `is_transient`) are
+    # retried up to `max_retries` times, after a random delay of up to
+    # `retry_backoff` * 2 ** retry seconds
+    max_retries = 3
+    retry_backoff = 0.5
+    # Transient errors by dialect: SQLSTATEs on PostgreSQL (class 08,
+    # connection exceptions, as well), error numbers on MySQL & messages on
+    # SQLite, whose driver exposes neither. Lost connections always are
+    transient_sqlstates = (
+        '40001',  # serialization_failure
+        '40P01',  # deadlock_detected
+        '55P03',  # lock_not_available
+        '57P01',  # admin_shutdown
+        '57P02',  # crash_shutdown
+        '57P03',  # cannot_connect_now
+    )
+    transient_errnos = (
+        1205,  # ER_LOCK_WAIT_TIMEOUT
+        1213,  # ER_LOCK_DEADLOCK
+        2003,  # CR_CONN_HOST_ERROR
+        2006,  # CR_SERVER_GONE_ERROR
+        2013,  # CR_SERVER_LOST
+        4031,  # ER_CLIENT_INTERACTION_TIMEOUT
+    )
+    transient_messages = (
+        'database is locked',
+        'database table is locked',
+    )
+    # With `bisect` a table whose INSERT fails with a data error (see
+    # `is_data_error`) is inserted in halves, down to the rows failing on
+    # their own. Those are rejected to `dead_letter_path` (JSON lines)
+    # and/or the table named `dead_letter_table`. bisect defaults to
+    # whether either is set
+    bisect = None
+    data_errors = (IntegrityError, DataError)
+    dead_letter_path = None
+    dead_letter_table = None
+
     def __init__(self, autoflush=False, *args, feed_options=None, **kwargs):
 
         self.Base = load_object(feed_options['declarative_base'])
         self.sorted_tables = self.Base.sorted_tables
 
         self.orm_stmts = feed_options['orm_stmts']
+        self.resolve_chunk_size = feed_options.get(
+            'resolve_chunk_size',
+            self.resolve_chunk_size
+        )
+        self.returning = feed_options.get('returning', self.returning)
+        for option in (
+            'max_rows_per_statement',
+            'max_params_per_statement',
+            'executemany_page_size',
+            'transaction_scope',
+            'log_rows_sample',
+            'dedup',
+            'max_retries',
+            'retry_backoff',
+            'bisect',
+            'dead_letter_path',
+            'dead_letter_table'
+        ):
+            setattr(self, option, feed_options.get(option, getattr(self, option)))
+
+        # {table: name of its content hash column}
+        self.change_detection = {
+            load_table(table): column_name
+            for table, column_name in (
+                feed_options.get('change_detection') or {}
+            ).items()
+        }
+
+        if self.transaction_scope not in self.transaction_scopes:
+            raise ValueError(
+                f'transaction_scope must be one of {self.transaction_scopes}, '
+                f'not {self.transaction_scope!r}'
+            )
+        if self.dedup not in self.dedups:
+            raise ValueError(
+                f'dedup must be one of {self.dedups}, not {self.dedup!r}'
+            )
+        if self.bisect is None:
+            self.bisect = bool(self.dead_letter_path or self.dead_letter_table)
+        if self.dead_letter_table is not None:
+            self.dead_letter_table = dead_letter_table(self.dead_letter_table)
 
         super().__init__(autoflush=autoflush, *args, **kwargs)
-    
+
+        # Shared by every session of a SQLAlchemyFeedStorage
+        self.orm_stmt_cache = self.info.get('orm_stmt_cache') \
+            or ORMStatementCache(self.orm_stmts)
+        self.key_cache = self.info.get('key_cache')
+        # {table: scrapy_sql.caches.BloomFilter}, the storage's dict is
+        # filled once it's opened
+        self.bloom_filters = self.info.get('bloom_filters')
+        if self.bloom_filters is None:
+            self.bloom_filters = {}
+        # (table, keys) of the rows written, added to the filters on commit
+        self.bloom_filter_keys = []
+        # Dead letters of the rows rejected by `insert_rows`
+        self.rejected = []
+        # (instance, column name, previous value) of the primary keys set
+        # by `insert_returning`, undone when a transaction is retried
+        self.backfilled = []
+
+        # Rows of instances exported with scrapy_sql.buffers.buffered_add
+        self.row_buffers = []
+
+        # Tables with subqueries among their values, noted as instances
+        # are attached & prepared rather than by scanning every value
+        self.subquery_tables = set()
+        event.listen(self, 'before_attach', self.note_subqueries)
+
+        # Counters of bulk_commit, published to the crawler stats by
+        # SQLAlchemyFeedStorage (prefixed with "scrapy_sql/")
+        self.stats = Counter()
+
+    @property
+    def returning_supported(self):
+        return self.returning and self.get_bind().dialect \
+            .insert_executemany_returning_sort_by_parameter_order
+
+    def new_row_buffer(self):
+        return RowBuffer(
+            self.sorted_tables,
+            self.Base.sorted_entities,
+            self.new_resolver()
+        )
+
+    def new_resolver(self):
+        return NaturalKeyResolver(
+            self.resolve_chunk_size,
+            self.returning_supported,
+            self.key_cache
+        )
+
+    def note_subqueries(self, session, instance):
+        table = instance.__table__
+        if table not in self.subquery_tables and has_subqueries(
+            getattr(instance, name) for name in instance.column_names
+        ):
+            self.subquery_tables.add(table)
+
+    def prepare_instance(
+        self,
+        instance,
+        resolver,
+        join_params,
+        subquery_tables
+    ):
+        """
+        Run the dependency processors of an instance. Foreign keys are set
+        on the instance, join table params are appended to `join_params`.
+        Tables that received a subquery are added to `subquery_tables`.
+        """
+        mapper = instance_state(instance).mapper
+
+        for r in mapper.relationships:
+
+            # TODO add ONETOONE & ONETOMANY
+
+            if r.direction is MANYTOONE:
+                ManyToOneBulkDP(instance, r).prepare(resolver)
+                if has_subqueries(
+                    getattr(instance, local_column.name)
+                    for local_column, _ in r.local_remote_pairs
+                ):
+                    subquery_tables.add(instance.__table__)
+
+            elif r.direction is MANYTOMANY:
+                dependency_processor = ManyToManyBulkDP(instance, r)
+                secondary_table = dependency_processor.secondary
+                join_columns = dependency_processor.prepare_secondary(
+                    resolver
+                )
+                
+                if join_columns is None:
+                    continue
+
+                join_params[secondary_table].extend(join_columns)
+                if has_subqueries(flatten(
+                    [param.values() for param in join_columns]
+                )):
+                    subquery_tables.add(secondary_table)
+
+    def buffer(self, instance):
+        """
+        Copy the column values of an instance, and of the instances it
+        cascades to, into the row buffer instead of adding them to the
+        session. See scrapy_sql.buffers.buffered_add
+        """
+        if not self.row_buffers:
+            self.row_buffers.append(self.new_row_buffer())
+        row_buffer = self.row_buffers[-1]
+
+        instances = [
+            i for i in RowBuffer.cascade(instance)
+            if i not in row_buffer.refs  # Already buffered in this batch
+        ]
+
+        # Dependency processors work on the instances, so they run first.
+        # Their deferred keys are then noted in the buffered rows, and only
+        # looked up in the key cache once the batch is committed
+        resolver = NaturalKeyResolver(
+            row_buffer.resolver.chunk_size,
+            row_buffer.resolver.returning
+        )
+        join_params = defaultdict(list)
+        for i in instances:
+            self.prepare_instance(
+                i,
+                resolver,
+                join_params,
+                row_buffer.subquery_tables
+            )
+        for i in instances:
+            row_buffer.append(i)
+        row_buffer.store_pending(resolver, join_params)
+
+    def take_batch(self):
+        """
+        Remove the batch from the session as row buffers, to be committed
+        by another session, e.g. on a writer thread (see `attach_batch`).
+        Instances are buffered first, so the batch holds column values
+        only and no instance the exporter's session can still reach.
+        """
+        for instance in list(self):
+            self.buffer(instance)
+        self.expunge_all()
+
+        batch = self.row_buffers
+        for row_buffer in batch:
+            row_buffer.refs.clear()
+        self.row_buffers = []
+        self.subquery_tables = set()
+        return batch
+
+    def attach_batch(self, batch):
+        for obj in batch:
+            if isinstance(obj, RowBuffer):
+                self.row_buffers.append(obj)
+            else:
+                self.add(obj)
+
+    def take_instances(self):
+        """
+        Remove every instance & row buffer from the session as they are,
+        for batches that don't leave the reactor thread
+        """
+        batch = list(self) + self.row_buffers
+        self.expunge_all()
+        self.row_buffers = []
+        self.subquery_tables = set()
+        return batch
+
+    def spool_params(self, instances):
+        """
+        The rows of the instances as {table: [params]}, join tables
+        included. Foreign keys that aren't known yet are SpooledKeys on the
+        parent's natural key (subqueries for parents without one), so the
+        rows can be inserted on their own in sorted_tables order. Unlike
+        `prepare_instance`, the instances aren't modified.
+        """
+        resolver = SpoolingResolver()
+        table_params = {}
+        for instance in instances:
+            params = instance.params
+            mapper = instance_state(instance).mapper
+
+            for r in mapper.relationships:
+                if r.direction is MANYTOONE:
+                    related_instance = getattr(instance, r.key)
+                    if related_instance is None:
+                        continue
+                    for local_column, remote_column in r.local_remote_pairs:
+                        if params.get(local_column.name) is not None:
+                            continue
+                        remote_value = getattr(related_instance, remote_column.name)
+                        if remote_value is not None:
+                            params[local_column.name] = remote_value
+                        elif not resolver.defer(
+                            params,
+                            local_column.name,
+                            related_instance,
+                            remote_column
+                        ):
+                            params[local_column.name] = \
+                                related_instance.subquery(remote_column)
+
+                elif r.direction is MANYTOMANY:
+                    join_params = ManyToManyBulkDP(instance, r) \
+                        .prepare_secondary(resolver)
+                    if join_params:
+                        table_params.setdefault(r.secondary, []).extend(join_params)
+
+            table_params.setdefault(instance.__table__, []).append(params)
+        return table_params
+
+    def take_spool_params(self):
+        """
+        Take the batch out of the session (see `take_instances`) as the
+        {table: [params]} of `spool_params`, buffered rows included
+        """
+        table_params = {}
+        instances = []
+        for obj in self.take_instances():
+            if not isinstance(obj, RowBuffer):
+                instances.append(obj)
+                continue
+
+            table_instances, buffered_params = obj.take_rows()
+            obj.resolver.assign_subqueries()
+            for table, refs in table_instances.items():
+                if refs:
+                    table_params.setdefault(table, []).extend(
+                        ref.params for ref in refs
+                    )
+            for table, params in buffered_params.items():
+                if params:
+                    table_params.setdefault(table, []).extend(params)
+
+        for table, params in self.spool_params(instances).items():
+            table_params.setdefault(table, []).extend(params)
+        return table_params
 
     def bulk_commit(self):
 
+        resolver = self.new_resolver()
+        returning = resolver.returning
+
+        row_buffers = self.row_buffers
+        self.row_buffers = []
+        resolvers = [resolver] + [b.resolver for b in row_buffers]
+
+        # Join table params
         table_params = {
             table: []
             for table in self.sorted_tables
         }
 
-        # Best for logging
+        # Instance params are built right before their table is inserted,
+        # after the resolver has filled in the foreign keys of their parents.
+        # Buffered rows are represented by RowReferences
         table_instances = {
             table: []
             for table in self.sorted_tables
         }
 
+        for row_buffer in row_buffers:
+            buffered_instances, buffered_params = row_buffer.take_rows()
+            for table in self.sorted_tables:
+                table_instances[table].extend(buffered_instances[table])
+                table_params[table].extend(buffered_params[table])
+
+        subquery_tables = self.subquery_tables
+        self.subquery_tables = set()
+        for row_buffer in row_buffers:
+            subquery_tables |= row_buffer.subquery_tables
+
         for instance in self:
-            mapper = instance_state(instance).mapper
+            self.prepare_instance(
+                instance,
+                resolver,
+                table_params,
+                subquery_tables
+            )
+            table_instances[instance.__table__].append(instance)
 
-            for r in mapper.relationships:
+        # UOW INSERTs / UPSERTs occur on self.commit()
+        # We're only interested in BULK INSERTs / UPSERTs here
+        self.expunge_all()
 
-                # TODO add ONETOONE & ONETOMANY
+        # Tables committed by the per_table scope aren't inserted again
+        # when a transaction is retried
+        committed = 0
+        retries = 0
+        checkpoint = self.checkpoint(resolvers)
+        while True:
+            try:
+                for index in range(committed, len(self.sorted_tables)):
+                    table = self.sorted_tables[index]
+                    inserted = self.write_table(
+                        table,
+                        table_instances[table],
+                        table_params,
+                        subquery_tables,
+                        resolvers,
+                        returning
+                    )
 
-                if r.direction is MANYTOONE:
-                    ManyToOneBulkDP(instance, r).prepare()
+                    # Children of this table can now look up its primary keys
+                    for r in resolvers:
+                        r.resolve(self, table)
 
-                elif r.direction is MANYTOMANY:
-                    dependency_processor = ManyToManyBulkDP(instance, r)
-                    secondary_table = dependency_processor.secondary
-                    join_columns = dependency_processor.prepare_secondary()
-                    
-                    if join_columns is None:
-                        continue
+                    if self.transaction_scope == 'per_table':
+                        if inserted:
+                            self.commit() # INSERT rows table by table in sorted order
+                        committed = index + 1
+                        checkpoint = self.checkpoint(resolvers)
 
-                    table_params[secondary_table].extend(join_columns)
-                    table_instances[secondary_table].extend([tuple(d.values()) for d in join_columns])
+                if self.rejected and self.dead_letter_table is not None:
+                    self.execute(insert(self.dead_letter_table), self.rejected)
+                self.commit()
+                break
+            except BaseException as error:
+                self.rollback()
+                if retries < self.max_retries and self.is_transient(error):
+                    retries += 1
+                    self.restore(checkpoint, resolvers)
+                    self.stats['failures/retries'] += 1
+                    delay = random.uniform(0, self.retry_backoff * 2 ** retries)
+                    logger.warning(
+                        f'Retrying the transaction ({retries}/{self.max_retries}) '
+                        f'in {delay:.2f} seconds after {error!r}'
+                    )
+                    self.backoff(delay)
+                    continue
 
-            table_params[instance.__table__].append(instance.params)
-            table_instances[instance.__table__].append(str(instance))
-        
-        # Logging
-        for table in self.sorted_tables:
-            try:
-                stmt = self.orm_stmts[table](table)
-            except TypeError:
-                stmt = self.orm_stmts[table](table, self)
-            instances = table_instances[table]
-            
-            if len(instances) == 0:
-                continue
+                self.bloom_filter_keys = []
+                self.rejected = []
+                self.backfilled = []
+                raise
 
-            try:
-                instances_string = '\n'.join(instances)
-            except: # Join Table
-
-                def tuple_of_subqeurires(tup):
-                    my_list = []
-                    for value in tup:
-                        value = subquery_to_string(value) if column_value_is_subquery(value) else value
-                        my_list.append(value)
-                    return str(tuple(my_list))
-                
-                instances_string = '\n'.join([tuple_of_subqeurires(tup) for tup in instances])
+        bloom_filter_keys = self.bloom_filter_keys
+        self.bloom_filter_keys = []
+        for table, keys in bloom_filter_keys:
+            self.bloom_filters[table].update(keys)
 
-            logging.info(f"{stmt}\n{instances_string}")
-   
-        # UOW INSERTs / UPSERTs occur on self.commit()
-        # We're only interested in BULK INSERTs / UPSERTs here
-        # Possibly start a new transaction and commit it instead
-        # of self.commit()
-        self.expunge_all()
+        # Only keys of committed rows are cached
+        if self.key_cache is not None:
+            for r in resolvers:
+                self.key_cache.update(r.resolved)
 
-        for table in self.sorted_tables:
-            try:
-                stmt = self.orm_stmts[table](table)
-            except TypeError:
-                stmt = self.orm_stmts[table](table, self)
-            
-            params = table_params[table]
-            if not params:
+        rejected = self.rejected
+        self.rejected = []
+        self.backfilled = []
+        if rejected and self.dead_letter_path is not None:
+            write_dead_letters(self.dead_letter_path, rejected)
+
+    def write_table(
+        self,
+        table,
+        instances,
+        table_params,
+        subquery_tables,
+        resolvers,
+        returning
+    ):
+        """
+        INSERT the instances & params of a table, once duplicates and rows
+        that are already stored are dropped. Returns whether there were
+        rows left to insert.
+        """
+        stmt = self.orm_stmt_cache.get(table, self)
+
+        if self.dedup is not None:
+            instances = self.deduplicate(table, instances, getattr)
+            table_params[table] = self.deduplicate(
+                table, table_params[table], dict.get
+            )
+        if table in self.change_detection:
+            instances = self.drop_unchanged(table, instances, getattr, setattr)
+            table_params[table] = self.drop_unchanged(
+                table, table_params[table], dict.get, dict.__setitem__
+            )
+        if table in self.bloom_filters:
+            instances = self.drop_stored(table, instances, getattr)
+            table_params[table] = self.drop_stored(
+                table, table_params[table], dict.get
+            )
+
+        params = [instance.params for instance in instances] \
+            + table_params[table]
+        if not params:
+            return False
+
+        contains_subqueries = table in subquery_tables or (
+            # A parent without a natural key was resolved to a
+            # subquery, rare enough to scan for
+            any(r.assigned_subqueries for r in resolvers)
+            and has_subqueries(flatten([x.values() for x in params]))
+        )
+
+        insert = (
+            stmt,
+            table,
+            instances,
+            params,
+            contains_subqueries,
+            returning and not table_params[table]
+        )
+        start = time.perf_counter()
+        if self.transaction_scope == 'savepoint_per_table':
+            self.insert_table_in_savepoint(*insert)
+        else:
+            self.insert_rows(*insert)
+        self.log_table(
+            table,
+            instances,
+            table_params[table],
+            params,
+            time.perf_counter() - start
+        )
+        return True
+
+    def checkpoint(self, resolvers):
+        """What `restore` rolls back to when a transaction is retried"""
+        return (
+            [r.checkpoint() for r in resolvers],
+            len(self.bloom_filter_keys),
+            len(self.rejected),
+            len(self.backfilled),
+            self.stats.copy()
+        )
+
+    def restore(self, checkpoint, resolvers):
+        """
+        Undo what the rolled back transaction left behind: resolved
+        foreign keys, primary keys set by RETURNING, keys bound for the
+        Bloom filters, rejected rows & counters other than retries.
+        """
+        resolver_checkpoints, bloom_filter_keys, rejected, backfilled, stats \
+            = checkpoint
+        for r, resolver_checkpoint in zip(resolvers, resolver_checkpoints):
+            r.restore(resolver_checkpoint)
+        del self.bloom_filter_keys[bloom_filter_keys:]
+        del self.rejected[rejected:]
+        for instance, name, value in reversed(self.backfilled[backfilled:]):
+            setattr(instance, name, value)
+        del self.backfilled[backfilled:]
+        # Retries are counted across transactions
+        retries = self.stats['failures/retries']
+        self.stats.clear()
+        self.stats.update(stats)
+        if retries:
+            self.stats['failures/retries'] = retries
+
+    def is_transient(self, error):
+        """
+        Whether a transaction failing with `error` may succeed when retried:
+        lost connections, deadlocks, serialization failures, lock timeouts
+        or a locked SQLite database. See `transient_sqlstates`,
+        `transient_errnos` & `transient_messages`.
+        """
+        if not isinstance(error, DBAPIError):
+            return False
+        if error.connection_invalidated:
+            return True
+
+        orig = error.orig
+        dialect = self.get_bind().dialect.name
+        if dialect == 'postgresql':
+            # psycopg & asyncpg, psycopg2
+            sqlstate = getattr(orig, 'sqlstate', None) \
+                or getattr(orig, 'pgcode', None)
+            return sqlstate is not None and (
+                sqlstate in self.transient_sqlstates
+                or sqlstate.startswith('08')
+            )
+        if dialect in ('mysql', 'mariadb'):
+            # mysql-connector, PyMySQL & mysqlclient
+            errno = getattr(orig, 'errno', None)
+            if errno is None and orig.args and isinstance(orig.args[0], int):
+                errno = orig.args[0]
+            return errno in self.transient_errnos
+        if dialect == 'sqlite':
+            return isinstance(error, OperationalError) \
+                and str(orig).startswith(self.transient_messages)
+        return False
+
+    @staticmethod
+    def backoff(delay):
+        """
+        Wait before a retry. On the event loop of an async engine, where
+        bulk_commit runs through `run_sync`, the wait is awaited instead of
+        blocking the loop.
+        """
+        if in_greenlet():
+            await_only(asyncio.sleep(delay))
+        else:
+            time.sleep(delay)
+
+    def deduplicate(self, table, rows, get_value):
+        """
+        Collapse the rows sharing a value for any of the table's primary key
+        or unique keys (see scrapy_sql.utils.unique_key_columns), keeping
+        the first or the last of them depending on `dedup`.
+        See `row_keys` for `get_value`.
+        """
+        if len(rows) < 2:
+            return rows
+
+        key_names = [
+            tuple(c.name for c in columns)
+            for columns in unique_key_columns(table)
+        ]
+
+        kept = []
+        positions = {}  # {(key names, key values): position in kept}
+        for row in rows:
+            keys = row_keys(key_names, row, get_value)
+
+            position = next(
+                (positions[key] for key in keys if key in positions),
+                None
+            )
+            if position is None:
+                position = len(kept)
+                kept.append(row)
+            elif self.dedup == 'last':
+                kept[position] = row
+            else:
                 continue
+            for key in keys:
+                positions[key] = position
 
-            contains_subqueries = any([
-                column_value_is_subquery(value)
-                for value in flatten([x.values() for x in params])
-            ])
+        duplicates = len(rows) - len(kept)
+        if duplicates:
+            self.stats['dedup/duplicates'] += duplicates
+            self.stats[f'dedup/duplicates/{table.name}'] += duplicates
+        return kept
 
-            if contains_subqueries:
-                self.execute(stmt.values(params))
+    def select_keys(self, table, column_names, keys, *columns):
+        """
+        Yields (key, *values of `columns`) of the stored rows whose
+        `column_names` are among `keys`, `resolve_chunk_size` keys per SELECT
+        """
+        key_columns = tuple(table.columns[name] for name in column_names)
+        distinct_keys = list(keys)
+
+        for start in range(0, len(distinct_keys), self.resolve_chunk_size):
+            chunk = distinct_keys[start:start + self.resolve_chunk_size]
+
+            if len(key_columns) == 1:
+                where = key_columns[0].in_([key[0] for key in chunk])
             else:
-                self.execute(stmt, params)
+                where = tuple_(*key_columns).in_(chunk)
+
+            for row in self.execute(select(*key_columns, *columns).where(where)):
+                yield (tuple(row[:len(key_columns)]), *row[len(key_columns):])
+
+    def drop_stored(self, table, rows, get_value):
+        """
+        Bloom filter pre-check of tables inserted with insert_ignore: rows
+        none of whose keys are in the table's filter are new and kept.
+        Rows whose keys might be are looked up in bulk, by the first key
+        found in the filter, and dropped if they are stored already.
+
+        The keys of the rows kept are added to the filter once the batch
+        is committed. See `row_keys` for `get_value`.
+        """
+        bloom_filter = self.bloom_filters[table]
+        key_names = [
+            tuple(c.name for c in columns)
+            for columns in unique_key_columns(table)
+        ]
+
+        # {key column names: {key values: [row, ...]}}
+        possibly_stored = {}
+        for row in rows:
+            keys = row_keys(key_names, row, get_value)
+            for names, values in keys:
+                if (names, values) in bloom_filter:
+                    possibly_stored.setdefault(names, {}) \
+                        .setdefault(values, []).append(row)
+                    break
+            self.bloom_filter_keys.append((table, keys))
+
+        if not possibly_stored:
+            return rows
+
+        stored = set()
+        for column_names, keys in possibly_stored.items():
+            for key, in self.select_keys(table, column_names, keys):
+                stored.update(id(row) for row in keys.get(key, ()))
+
+        possibly = sum(
+            len(rows) for keys in possibly_stored.values()
+            for rows in keys.values()
+        )
+        self.stats['bloom_filter/stored'] += len(stored)
+        self.stats['bloom_filter/false_positives'] += possibly - len(stored)
+        return [row for row in rows if id(row) not in stored]
+
+    def drop_unchanged(self, table, rows, get_value, set_value):
+        """
+        Change detection: set the content hash column of each row, fetch
+        the stored hashes of the rows' natural keys in bulk and return the
+        rows whose hash differs, or that don't exist yet.
+
+        Runs right before the table is inserted, once the foreign keys of
+        its rows have been resolved. Rows holding subqueries or without a
+        natural key are always written. `get_value` & `set_value` are
+        getattr & setattr for instances, dict.get & dict.__setitem__ for
+        params (see `row_keys`).
+        """
+        hash_column = self.change_detection[table]
+        primary_key = {c.name for c in table.primary_key.columns}
+        hashed_names = [
+            c.name for c in table.columns
+            if c.name not in primary_key and c.name != hash_column
+        ]
+        key_names = [
+            tuple(c.name for c in columns)
+            for columns in unique_key_columns(table)
+        ]
+
+        # {key column names: {key values: [row, ...]}}
+        keyed = {}
+        for row in rows:
+            values = [get_value(row, name) for name in hashed_names]
+            if has_subqueries(values):
+                continue
+            set_value(row, hash_column, row_hash(values))
+
+            # The first key that's fully loaded, see NaturalKeyResolver
+            keys = row_keys(key_names, row, get_value)
+            if keys:
+                column_names, key = keys[0]
+                keyed.setdefault(column_names, {}) \
+                    .setdefault(key, []).append(row)
+
+        unchanged = set()
+        for column_names, keys in keyed.items():
+            stored = self.select_keys(
+                table, column_names, keys, table.columns[hash_column]
+            )
+            for key, stored_hash in stored:
+                for row in keys.get(key, ()):
+                    if get_value(row, hash_column) == stored_hash:
+                        unchanged.add(id(row))
+
+        if unchanged:
+            logger.info(
+                '%s: %d unchanged rows skipped',
+                table.name,
+                len(unchanged)
+            )
+        return [row for row in rows if id(row) not in unchanged]
+
+    def insert_table(
+        self,
+        stmt,
+        table,
+        instances,
+        params,
+        contains_subqueries,
+        returning
+    ):
+        if hasattr(stmt, 'load'):  # e.g. scrapy_sql.loaders.CopyFrom
+            if not contains_subqueries:
+                stmt.load(self, params)
+                return
+            stmt = stmt.insert
+
+        if contains_subqueries:
+            self.execute_values(stmt, params)
+        elif returning and instances:
+            self.insert_returning(stmt, table, instances, params)
+        else:
+            self.execute_many(stmt, params)
+
+    def insert_rows(
+        self,
+        stmt,
+        table,
+        instances,
+        params,
+        contains_subqueries,
+        returning
+    ):
+        """
+        `insert_table`, unless `bisect` is set. The INSERT is then made in a
+        savepoint and, if it fails with a data error, repeated for
+        each half of the rows, down to the rows that fail on their own.
+        Those are rejected, the others are inserted.
+        """
+        if not self.bisect:
+            self.insert_table(
+                stmt, table, instances, params, contains_subqueries, returning
+            )
+            return
+
+        try:
+            with self.begin_savepoint():
+                self.insert_table(
+                    stmt, table, instances, params, contains_subqueries, returning
+                )
+        except StatementError as error:
+            if not self.is_data_error(error):
+                raise
+            if len(params) == 1:
+                self.reject(table, params[0], error)
+                return
+
+            self.stats['failures/bisections'] += 1
+            half = len(params) // 2
+            for rows in (slice(None, half), slice(half, None)):
+                self.insert_rows(
+                    stmt,
+                    table,
+                    # Instances & params only line up with RETURNING
+                    instances[rows] if returning else instances,
+                    params[rows],
+                    contains_subqueries,
+                    returning
+                )
+
+    def is_data_error(self, error):
+        """
+        Whether rows may be the cause of `error`: one of `data_errors`, e.g.
+        a constraint violation, or a value that couldn't be bound
+        """
+        if isinstance(error, DBAPIError):
+            return isinstance(error, self.data_errors)
+        return True
+
+    def reject(self, table, params, error):
+        """Route a row that can't be inserted to the dead letters"""
+        logger.warning(
+            f'Rejected a row of {table.name}: {getattr(error, "orig", error)!r}'
+        )
+        self.rejected.append(dead_letter(table, params, error))
+        self.stats['failures/rejected'] += 1
+        self.stats[f'failures/rejected/{table.name}'] += 1
+
+    def insert_table_in_savepoint(self, stmt, table, *args):
+        """
+        A table that fails is rolled back to its savepoint and logged, the
+        rest of the batch is still committed. Children of its rows most
+        likely fail in turn, as their foreign keys can't be resolved.
+        """
+        try:
+            with self.begin_savepoint():
+                self.insert_rows(stmt, table, *args)
+        except SQLAlchemyError as error:
+            if self.is_transient(error):
+                raise
+            logger.exception(f'Rolled back the INSERTs into {table.name}')
+
+    def begin_savepoint(self):
+        """
+        `begin_nested`, once the transaction was begun on the database.
+        pysqlite & aiosqlite don't BEGIN before a SAVEPOINT, so its RELEASE
+        would commit the rows written so far. Engines of a
+        SQLAlchemyFeedStorage BEGIN on their own, others are handled here.
+        """
+        connection = self.connection()
+        if connection.dialect.name == 'sqlite' \
+                and not connection.connection.driver_connection.in_transaction:
+            connection.exec_driver_sql('BEGIN')
+        return self.begin_nested()
+
+    @property
+    def executemany_options(self):
+        if self.executemany_page_size:
+            return {'insertmanyvalues_page_size': self.executemany_page_size}
+        return {}
+
+    def execute_values(self, stmt, params):
+        """
+        INSERT with one VALUES tuple per row, which subqueries require.
+        Rows are split across statements so none of them exceeds the
+        dialect's bound parameter limit or `max_rows_per_statement`.
+        """
+        max_params = self.max_params_per_statement \
+            or max_bind_params(self.get_bind().dialect)
+
+        for chunk in chunk_rows(params, self.max_rows_per_statement, max_params):
+            self.execute(stmt.values(chunk))
+
+    def execute_many(self, stmt, params):
+        for page in chunk_rows(params, self.executemany_page_size):
+            self.execute(stmt, page, execution_options=self.executemany_options)
+
+    def insert_returning(self, stmt, table, instances, params):
+        """
+        INSERT the instances of a table with RETURNING (insertmanyvalues)
+        and back-fill the generated primary keys onto the instances.
+
+        Rows are matched by parameter order. When fewer rows come back than
+        were sent (e.g. INSERT OR IGNORE skipped some) rows are matched by
+        their unique columns instead; instances that can't be matched are
+        left to the NaturalKeyResolver.
+        """
+        unique_keys = unique_key_columns(table)
+        primary_key = tuple(table.primary_key.columns)
+        returning_columns = tuple({
+            column.name: column
+            for columns in unique_keys
+            for column in columns
+        }.values())
+
+        rows = self.execute(
+            stmt.returning(*returning_columns, sort_by_parameter_order=True),
+            params,
+            execution_options=self.executemany_options
+        ).all()
+
+        if len(rows) == len(instances):
+            matches = zip(instances, rows)
+        else:
+            rows_by_key = {}
+            for row in rows:
+                for columns in unique_keys[1:]:
+                    key = tuple(row._mapping[c] for c in columns)
+                    rows_by_key[(columns, key)] = row
+
+            matches = []
+            for instance in instances:
+                for columns in unique_keys[1:]:
+                    key = tuple(getattr(instance, c.name) for c in columns)
+                    row = rows_by_key.get((columns, key))
+                    if row is not None:
+                        matches.append((instance, row))
+                        break
+
+        for instance, row in matches:
+            for column in primary_key:
+                self.backfilled.append(
+                    (instance, column.name, getattr(instance, column.name))
+                )
+                setattr(instance, column.name, row._mapping[column])
+
+    def log_table(self, table, instances, join_params, params, seconds):
+        """
+        A summary of each table at INFO level, whose size is estimated from
+        its first rows. The rows themselves are only formatted at DEBUG
+        level when `log_rows_sample` is set, all of them if it's None or a
+        random sample of `log_rows_sample` rows.
+        """
+        if not logger.isEnabledFor(logging.INFO):
+            return
+
+        sample = params[:self.log_size_sample]
+        logger.info(
+            '%s: %d rows, ~%d bytes in %.1f ms',
+            table.name,
+            len(params),
+            params_size(sample) * len(params) // len(sample),
+            seconds * 1000
+        )
+
+        if self.log_rows_sample == 0 or not logger.isEnabledFor(logging.DEBUG):
+            return
+
+        sql = self.orm_stmt_cache.compiled(table, self)
+        rows = list(instances) + list(join_params)
+        if self.log_rows_sample is not None and len(rows) > self.log_rows_sample:
+            rows = random.sample(rows, self.log_rows_sample)
+
+        def tuple_of_subqeurires(tup):
+            my_list = []
+            for value in tup:
+                value = subquery_to_string(value) if column_value_is_subquery(value) else value
+                my_list.append(value)
+            return str(tuple(my_list))
+
+        instances_string = '\n'.join(
+            tuple_of_subqeurires(row.values()) if isinstance(row, dict)
+            else str(row)
+            for row in rows
+        )
 
-            self.commit() # INSERT rows table by table in sorted order
+        logger.debug(f"{sql}\n{instances_string}")
@@ -0,0 +1,336 @@
+
+# Project Imports
+from .buffers import RowBuffer
+from .utils import column_value_is_subquery
+
+# SQLAlchemy Imports
+from sqlalchemy import bindparam, select, text
+
+# 3rd 🎉 Imports
+import glob
+import logging
+import os
+import pickle
+import socket
+import struct
+import uuid
+
+
+logger = logging.getLogger(__name__)
+
+_record_length = struct.Struct('<I')
+
+# Prefixes of the spools of this process that haven't been closed
+_open_prefixes = set()
+
+
+class SpooledSubquery:
+    """
+    A subquery value of a spooled row, kept as its SQL & bound parameters.
+    Its parameters are bound as unique parameters when it's loaded, so the
+    subqueries of many rows can share a multi VALUES INSERT.
+    """
+
+    __slots__ = ('sql', 'params')
+
+    def __init__(self, sql, params):
+        self.sql = sql
+        self.params = params
+
+    @classmethod
+    def from_clause(cls, clause):
+        compiled = clause.compile()
+        return cls(str(compiled), dict(compiled.params))
+
+    def to_clause(self):
+        return text(self.sql).bindparams(*[
+            bindparam(key, value, unique=True)
+            for key, value in self.params.items()
+        ])
+
+    def __repr__(self):
+        return f'SpooledSubquery({self.sql!r}, {self.params!r})'
+
+
+class SpooledKey:
+    """
+    A foreign key value of a spooled row that wasn't known yet, kept as the
+    natural key of its parent row & the name of the parent column. Nothing
+    is compiled when it's spooled; it's loaded as a subquery on the
+    parent's table (see `load_segments`).
+    """
+
+    __slots__ = ('table_name', 'column_names', 'values', 'column_name')
+
+    def __init__(self, table_name, column_names, values, column_name):
+        self.table_name = table_name
+        self.column_names = column_names
+        self.values = values
+        self.column_name = column_name
+
+    def to_clause(self, table):
+        return select(table.columns[self.column_name]).where(*(
+            table.columns[name] == value
+            for name, value in zip(self.column_names, self.values)
+        )).scalar_subquery()
+
+    def __repr__(self):
+        return (
+            f'SpooledKey({self.table_name!r}, {self.column_names!r}, '
+            f'{self.values!r}, {self.column_name!r})'
+        )
+
+
+def dump_params(params):
+    return [
+        {
+            name: SpooledSubquery.from_clause(value)
+            if column_value_is_subquery(value) else value
+            for name, value in param.items()
+        }
+        for param in params
+    ]
+
+
+def load_params(params, tables=None):
+    """The inverse of `dump_params`, `tables` maps the names of SpooledKeys"""
+    return [
+        {
+            name: load_value(value, tables)
+            for name, value in param.items()
+        }
+        for param in params
+    ]
+
+
+def load_value(value, tables):
+    if isinstance(value, SpooledSubquery):
+        return value.to_clause()
+    if isinstance(value, SpooledKey):
+        return value.to_clause(tables[value.table_name])
+    return value
+
+
+def write_record(file, table_name, params):
+    """Append the params of a table as a length prefixed pickle"""
+    data = pickle.dumps(
+        (table_name, dump_params(params)),
+        protocol=pickle.HIGHEST_PROTOCOL
+    )
+    file.write(_record_length.pack(len(data)))
+    file.write(data)
+
+
+def read_segment(path, tables=None):
+    """
+    Yields the (table name, params) records of a segment file. A record cut
+    short, by a crash while it was written, ends the segment. `tables`
+    ({name: table}) is needed by segments holding SpooledKeys.
+    """
+    with open(path, 'rb') as file:
+        while True:
+            header = file.read(_record_length.size)
+            if not header:
+                return
+            data = b''
+            if len(header) == _record_length.size:
+                length, = _record_length.unpack(header)
+                data = file.read(length)
+            if len(header) < _record_length.size or len(data) < length:
+                logger.warning(f'Ignoring the truncated end of {path}')
+                return
+
+            table_name, params = pickle.loads(data)
+            yield table_name, load_params(params, tables)
+
+
+def segment_paths(directory, unsealed=False):
+    """
+    The sealed segments of a spool directory, oldest first. With `unsealed`
+    the segments that were being written when their process died as well.
+    """
+    paths = glob.glob(os.path.join(directory, '*.seg'))
+    if unsealed:
+        paths += glob.glob(os.path.join(directory, '*.part'))
+    return sorted(paths, key=lambda path: (os.path.getmtime(path), path))
+
+
+def process_is_running(pid):
+    """Whether a process of this host has the id `pid`"""
+    if os.name == 'nt':
+        # os.kill would terminate it, assume it's running
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Someone else's
+    return True
+
+
+def segment_is_orphaned(path):
+    """
+    Whether the spool that wrote a segment is gone: a Spool of this process
+    that was closed, or one of a process of this host that isn't running
+    anymore. The segments of other hosts are never orphaned, and those
+    whose prefix isn't the default `<host>-<pid>-<id>` are as soon as no
+    Spool of this process is writing them.
+    """
+    prefix = os.path.basename(path).rsplit('-', 1)[0]
+    if prefix in _open_prefixes:
+        return False
+
+    parts = prefix.rsplit('-', 2)
+    if len(parts) < 3 or not parts[1].isdigit():
+        return True
+    host, pid = parts[0], int(parts[1])
+    if host != socket.gethostname():
+        return False
+    return pid == os.getpid() or not process_is_running(pid)
+
+
+def orphaned_segments(directory):
+    """
+    The segments of a spool directory, sealed or not, left behind by a
+    crash or a failed commit (see segment_is_orphaned), oldest first.
+    """
+    return [
+        path for path in segment_paths(directory, unsealed=True)
+        if segment_is_orphaned(path)
+    ]
+
+
+def remove_segments(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def load_segments(paths, sorted_tables):
+    """The records of the segments merged into {table: [params]}"""
+    tables = {table.name: table for table in sorted_tables}
+    table_params = {}
+    for path in paths:
+        for table_name, params in read_segment(path, tables):
+            table_params.setdefault(tables[table_name], []).extend(params)
+    return table_params
+
+
+class Spool:
+    """
+    Rows appended to segment files of a directory as length prefixed
+    pickles of (table name, [params]), one record per table and append.
+    Subqueries are kept as SQL (see SpooledSubquery), the parents' natural
+    keys as SpooledKeys.
+
+    The segment being written is named `<prefix>-<n>.part`, handed to the OS
+    on every append and fsynced every `fsync_every` rows. `seal` fsyncs it
+    and renames it `<prefix>-<n>.seg`, the rename being atomic, a sealed
+    segment is always complete. The prefix defaults to the host name,
+    process id & a random id, so processes can share the directory: the
+    segments of a running process aren't orphaned (see orphaned_segments).
+    """
+
+    def __init__(self, directory, prefix=None, fsync_every=1000):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.prefix = prefix or \
+            f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        _open_prefixes.add(self.prefix)
+        self.fsync_every = fsync_every
+
+        self.file = None
+        self.path = None
+        self.sequence = 0
+        self.unsynced = 0
+
+    def append(self, table_params):
+        """Append {table: [params]}, returns the number of rows appended"""
+        rows = 0
+        for table, params in table_params.items():
+            if not params:
+                continue
+            if self.file is None:
+                self.sequence += 1
+                self.path = os.path.join(
+                    self.directory,
+                    f'{self.prefix}-{self.sequence:06d}.part'
+                )
+                self.file = open(self.path, 'wb')
+            write_record(self.file, table.name, params)
+            rows += len(params)
+        if rows:
+            # Survives the process, fsync also survives the machine
+            self.file.flush()
+
+        self.unsynced += rows
+        if self.fsync_every is not None and self.unsynced >= self.fsync_every:
+            self.sync()
+        return rows
+
+    def sync(self):
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def seal(self):
+        """
+        Close the segment being written. Returns the path of the sealed
+        segment, or None when nothing was appended since the last seal.
+        """
+        if self.file is None:
+            return None
+
+        self.sync()
+        self.file.close()
+        sealed = self.path[:-len('.part')] + '.seg'
+        os.replace(self.path, sealed)
+        self.file = None
+        self.path = None
+        return sealed
+
+    def close(self):
+        """
+        Seal the segment being written. What's left of the spool's segments
+        is orphaned from then on.
+        """
+        sealed = self.seal()
+        _open_prefixes.discard(self.prefix)
+        return sealed
+
+
+def consolidate(storage, directory, segments_per_batch=10):
+    """
+    Merge the sealed segments of a staging directory into the database of
+    a SQLAlchemyFeedStorage, `segments_per_batch` segments per commit. The
+    rows of a batch are inserted table by table in sorted_tables order with
+    the storage's commit hook, its segments are removed once committed.
+
+    Returns the number of segments merged.
+    """
+    session = storage.session
+    paths = segment_paths(directory)
+
+    for start in range(0, len(paths), segments_per_batch):
+        batch_paths = paths[start:start + segments_per_batch]
+        table_params = load_segments(batch_paths, storage.Base.sorted_tables)
+
+        session.row_buffers.append(RowBuffer.from_params(
+            storage.Base.sorted_tables,
+            storage.Base.sorted_entities,
+            session.new_resolver(),
+            table_params
+        ))
+        storage.commit_batch(session)
+
+        remove_segments(batch_paths)
+        logger.info(
+            f'Consolidated {len(batch_paths)} segments, '
+            f'{sum(map(len, table_params.values()))} rows'
+        )
+
+    return len(paths)
@@ -4,12 +4,17 @@ from scrapy.utils.misc import load_object
 
 # SQLAlchemy Imports
 import sqlalchemy
-from sqlalchemy import Table
+from sqlalchemy import Table, UniqueConstraint
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import BindParameter
 from sqlalchemy.orm.decl_api import DeclarativeAttributeIntercept
 
 # 3rd 🎉 Imports
+import hashlib
 from inspect import isclass, isfunction
 import re
+import sqlite3
+import sys
 # here to be imported via: from scrapy_sql.utils import classproperty
 # used in models.py to add a stmt property to a DeclarativeBase subclass
 #from descriptors import classproperty
@@ -45,6 +50,121 @@ def is_scalar_column(column):
         )
     )
 
+def instance_size(instance):
+    """
+    Approximate size in bytes of the column values held by an instance.
+    Related instances aren't included.
+    """
+    return sum(
+        sys.getsizeof(getattr(instance, column.name))
+        for column in instance.__table__.columns
+    )
+
+
+def params_size(params):
+    """Approximate size in bytes of the values of a list of params"""
+    return sum(
+        sys.getsizeof(value)
+        for param in params
+        for value in param.values()
+    )
+
+
+def row_hash(values):
+    """Content hash of a row's column values, used for change detection"""
+    return hashlib.blake2b(
+        repr(tuple(values)).encode('utf-8'),
+        digest_size=16
+    ).hexdigest()
+
+
+def unique_key_columns(table):
+    """
+    Returns the column groups that uniquely identify a row of `table`.
+    The primary key comes first, followed by unique constraints and
+    unique indexes (sorted by column names, so the order is stable).
+    """
+    primary_key = tuple(table.primary_key.columns)
+
+    unique_keys = [
+        tuple(constraint.columns)
+        for constraint in table.constraints
+        if isinstance(constraint, UniqueConstraint)
+    ] + [
+        tuple(index.columns)
+        for index in table.indexes
+        if index.unique
+    ]
+    unique_keys = sorted(
+        set(unique_keys),
+        key=lambda columns: tuple(c.name for c in columns)
+    )
+
+    return tuple(
+        columns for columns in [primary_key] + unique_keys
+        if columns
+    )
+
+
+def max_bind_params(dialect):
+    """
+    Bound parameters a single statement may hold on a dialect,
+    or None when there's no practical limit.
+    """
+    if dialect.name == 'sqlite':
+        # SQLITE_MAX_VARIABLE_NUMBER, raised from 999 in SQLite 3.32.0
+        return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+    return {
+        'postgresql': 32767,  # asyncpg & psycopg 3 bind server side
+        'mysql': 65535,
+        'mssql': 2099,
+        'oracle': 65535,
+    }.get(dialect.name)
+
+
+def count_bind_params(value):
+    """Bound parameters a column value adds to a statement"""
+    if not column_value_is_subquery(value):
+        return 1
+    return sum(
+        isinstance(element, BindParameter)
+        for element in visitors.iterate(value)
+    )
+
+
+def chunk_rows(rows, max_rows=None, max_params=None):
+    """
+    Split the params of a multi VALUES statement in chunks of at most
+    `max_rows` rows holding at most `max_params` bound parameters.
+    A row that exceeds `max_params` on its own gets a chunk of its own.
+    """
+    if max_rows is None and max_params is None:
+        if rows:
+            yield rows
+        return
+
+    chunk, chunk_params = [], 0
+    for row in rows:
+        row_params = sum(count_bind_params(v) for v in row.values()) \
+            if max_params is not None else 0
+
+        if chunk and (
+            (max_rows is not None and len(chunk) >= max_rows)
+            or (
+                max_params is not None
+                and chunk_params + row_params > max_params
+            )
+        ):
+            yield chunk
+            chunk, chunk_params = [], 0
+
+        chunk.append(row)
+        chunk_params += row_params
+
+    if chunk:
+        yield chunk
+
+
 # TODO string builder
 def subquery_to_string(subquery):
     string_subquery = normalize_whitespace(subquery)
@@ -0,0 +1,170 @@
+
+# Scrapy / Twisted Imports
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+# 3rd 🎉 Imports
+from collections import deque
+import logging
+import queue
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class SQLAlchemyWriter:
+    """
+    Commits batches of instances on dedicated threads, so the reactor never
+    waits on the database and a Session is never shared between threads.
+
+    Batches are built on the reactor thread by taking them out of the
+    exporter's session (see `take_batch`). Each writer thread owns a
+    session of its own, adds the batch to it and runs the commit hook.
+
+    The queue between the reactor and the writers is bounded. Batches that
+    don't fit wait on the reactor side and the crawler's engine is paused
+    until the writers catch up, which applies backpressure to the crawl
+    instead of letting memory grow without bound.
+    """
+
+    def __init__(
+        self,
+        Session,
+        commit,
+        threads=1,
+        queue_size=2,
+        crawler=None,
+        reactor=None,
+        name='scrapy-sql-writer'
+    ):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.Session = Session
+        self.commit = commit
+        self.crawler = crawler
+        self.reactor = reactor
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow = deque()  # (batch, deferred) waiting for the queue
+        self.paused = False
+
+        self.threads = [
+            threading.Thread(
+                target=self._run,
+                name=f'{name}-{i}',
+                daemon=True
+            )
+            for i in range(threads)
+        ]
+        self.running = 0
+        self.closed = None
+
+    @staticmethod
+    def take_batch(session):
+        """
+        Removes every instance from the session and returns them as a batch.
+        Called on the reactor thread. Sessions that take it themselves
+        (e.g. ScrapyBulkSession, as row buffers) hand over no instance the
+        session could still reach, which is what SQLAlchemyFeedStorage
+        requires of writer threads.
+        """
+        if hasattr(session, 'take_batch'):
+            return session.take_batch()
+        batch = list(session)
+        session.expunge_all()
+        return batch
+
+    @staticmethod
+    def attach_batch(session, batch):
+        """Counterpart of `take_batch`, called on a writer thread"""
+        if hasattr(session, 'attach_batch'):
+            session.attach_batch(batch)
+        else:
+            session.add_all(batch)
+
+    def start(self):
+        self.running = len(self.threads)
+        self.closed = defer.Deferred()
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, batch):
+        """
+        Queue a batch for writing. Returns a Deferred fired on the reactor
+        thread once the batch was committed.
+        """
+        d = defer.Deferred()
+        self._put((batch, d))
+        return d
+
+    def close(self):
+        """
+        Stop the writer threads once every queued batch is written.
+        Returns a Deferred fired when all of them have finished.
+        """
+        for _ in self.threads:
+            self._put(_STOP)
+        return self.closed
+
+    def _put(self, item):
+        if self.overflow or self.queue.full():
+            self.overflow.append(item)
+            self._pause()
+        else:
+            self.queue.put_nowait(item)
+
+    @property
+    def engine(self):
+        return getattr(self.crawler, 'engine', None)
+
+    def _pause(self):
+        if not self.paused and self.engine is not None:
+            logger.debug('Writer queue is full, pausing the engine')
+            self.engine.pause()
+        self.paused = True
+
+    def _drain(self):
+        """Called on the reactor thread each time a writer frees a slot"""
+        while self.overflow and not self.queue.full():
+            self.queue.put_nowait(self.overflow.popleft())
+
+        if self.paused and not self.overflow:
+            if self.engine is not None:
+                logger.debug('Writer queue has room, unpausing the engine')
+                self.engine.unpause()
+            self.paused = False
+
+    def _finished(self):
+        self.running -= 1
+        if self.running == 0:
+            self.closed.callback(None)
+
+    def _run(self):
+        session = self.Session()
+
+        while True:
+            item = self.queue.get()
+            self.reactor.callFromThread(self._drain)
+
+            if item is _STOP:
+                break
+
+            batch, d = item
+            try:
+                self.attach_batch(session, batch)
+                self.commit(session)
+                session.expunge_all()
+            except BaseException:
+                result = Failure()
+                session.rollback()
+                session.expunge_all()
+                self.reactor.callFromThread(d.errback, result)
+            else:
+                self.reactor.callFromThread(d.callback, None)
+
+        session.close()
+        self.reactor.callFromThread(self._finished)
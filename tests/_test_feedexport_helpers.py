@@ -1,14 +1,21 @@
 
 from copy import copy, deepcopy
 
+from integration_test_project.quotes.items.models import QuotesBase
+
 from scrapy_sql import ScrapyDeclarativeBase
 from scrapy_sql._defaults import (
     _default_add,
     _default_commit,
     _default_insert
 )
+from scrapy_sql.exporters import SQLAlchemyInstanceExporter
+from scrapy_sql.feedexport import SQLAlchemyFeedStorage
 from scrapy_sql.session import ScrapyBulkSession
 
+from scrapy.crawler import Crawler
+from scrapy.spiders import Spider
+
 from sqlalchemy.orm import Session, DeclarativeBase
 from sqlalchemy import Column, Integer, Table
 
@@ -149,3 +156,21 @@ item_export_kwargs_expected_feed_options = copy(
 item_export_kwargs_expected_feed_options['add'] = item_export_kwargs_add
 
 
+
+
+# Storages of the quotes models
+def get_storage(uri, crawler=None, **feed_options):
+    """A storage of the quotes models, `feed_options` override the defaults"""
+    return SQLAlchemyFeedStorage.from_crawler(
+        crawler=crawler or Crawler(Spider, default_settings_dict),
+        uri=uri,
+        feed_options={'declarative_base': QuotesBase, **feed_options}
+    )
+
+
+def get_exporter(storage):
+    """The exporter of the session `storage.open` returns"""
+    return SQLAlchemyInstanceExporter(
+        storage.session,
+        **storage.feed_options['item_export_kwargs']
+    )
@@ -0,0 +1,169 @@
+
+import pytest
+
+from integration_test_project.quotes.items.models import (
+    QuotesBase, Author, Tag, Quote, t_quote_tag
+)
+
+from scrapy_sql.buffers import *
+from scrapy_sql.session import NaturalKeyResolver, ScrapyBulkSession
+from scrapy_sql.writer import SQLAlchemyWriter
+
+from sqlalchemy import create_engine, insert, text
+
+
+feed_options = {
+    'orm_stmts': {
+        Author.__table__: insert,
+        Tag.__table__:    insert,
+        Quote.__table__:  insert,
+        t_quote_tag:      insert,
+    },
+    'declarative_base': QuotesBase
+}
+
+
+@pytest.fixture(scope='function')
+def bulk_engine(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    QuotesBase.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+class TestTableBuffer:
+
+    def test_append(self):
+        buffer = TableBuffer(Tag.__table__, Tag)
+        ref = buffer.append(Tag(name='change'))
+
+        assert len(buffer) == 1
+        assert buffer.columns == ([None], ['change'])
+        assert ref.name == 'change'
+        assert ref.params == {'name': 'change'}
+
+        ref.id = 3
+        assert buffer.columns[0] == [3]
+        assert [r.id for r in buffer.rows()] == [3]
+
+        with pytest.raises(AttributeError):
+            ref.unknown_column
+
+        with pytest.raises(AttributeError):
+            ref.unknown_column = 1
+
+    def test_to_instance(self):
+        buffer = TableBuffer(Tag.__table__, Tag)
+        instance = buffer.append(Tag(id=1, name='change')).to_instance()
+
+        assert isinstance(instance, Tag)
+        assert (instance.id, instance.name) == (1, 'change')
+
+
+class TestRowBuffer:
+
+    def test_cascade(self, transient_quote):
+        instances = RowBuffer.cascade(transient_quote)
+
+        assert instances[0] is transient_quote
+        assert set(map(type, instances)) == {Quote, Author, Tag}
+        assert len(instances) == 4
+
+    def test_append(self, transient_quote):
+        row_buffer = RowBuffer(
+            QuotesBase.sorted_tables,
+            QuotesBase.sorted_entities,
+            NaturalKeyResolver()
+        )
+        for instance in RowBuffer.cascade(transient_quote):
+            row_buffer.append(instance)
+
+        assert len(row_buffer) == 4
+        assert len(row_buffer.tables[Tag.__table__]) == 2
+        assert row_buffer.tables[t_quote_tag].entity is None
+        assert transient_quote in row_buffer.refs
+
+
+class TestBufferedAdd:
+
+    def test_deferred_keys(self, transient_quote, bulk_engine):
+        session = ScrapyBulkSession(bind=bulk_engine, feed_options=feed_options)
+        buffered_add(session, transient_quote)
+        row_buffer = session.row_buffers[0]
+
+        # Foreign keys are noted as row indexes, no resolver entry is held
+        assert row_buffer.resolver.pending == {}
+        quotes = row_buffer.tables[Quote.__table__]
+        assert quotes.columns[quotes.column_index['author_id']] == [None]
+        assert {
+            name: (list(indexes), list(parent_indexes))
+            for (name, _), (indexes, parent_indexes) in quotes.deferred.items()
+        } == {'author_id': ([0], [0])}
+        assert len(row_buffer.tables[t_quote_tag].deferred) == 2
+
+        table_instances, table_params = row_buffer.take_rows()
+        assert [ref.quote for ref in table_instances[Quote.__table__]] == [
+            transient_quote.quote
+        ]
+        # Join rows keep a placeholder until they're resolved
+        assert table_params[t_quote_tag] == [
+            {'quote_id': None, 'tag_id': None},
+            {'quote_id': None, 'tag_id': None}
+        ]
+        assert set(row_buffer.resolver.pending) == {
+            Author.__table__, Quote.__table__, Tag.__table__
+        }
+
+    @pytest.mark.parametrize("returning", [False, True])
+    def test_bulk_commit(self, transient_quote, bulk_engine, returning):
+        session = ScrapyBulkSession(
+            bind=bulk_engine,
+            feed_options={**feed_options, 'returning': returning}
+        )
+
+        # The tags are shared, so only buffered once
+        other_quote = Quote(
+            quote='Another one',
+            author=transient_quote.author,
+            tags=transient_quote.tags
+        )
+        buffered_add(session, transient_quote)
+        buffered_add(session, other_quote)
+
+        # Nothing was attached to the session
+        assert len(session.new) == 0
+        assert len(session.row_buffers[0]) == 9
+
+        session.bulk_commit()
+
+        with bulk_engine.connect() as conn:
+            assert conn.execute(text('SELECT count(*) FROM author')).scalar() == 1
+            assert conn.execute(text('SELECT count(*) FROM tag')).scalar() == 2
+            assert set(conn.execute(text('SELECT * FROM quote'))) == {
+                (1, 1, 'If not us, who? If not now, when?'),
+                (2, 1, 'Another one')
+            }
+            assert set(conn.execute(text('SELECT * FROM quote_tag'))) == {
+                (1, 1), (1, 2), (2, 1), (2, 2)
+            }
+
+        assert session.row_buffers == []
+
+    def test_writer_batch(self, transient_quote, bulk_engine):
+        session = ScrapyBulkSession(bind=bulk_engine, feed_options=feed_options)
+        buffered_add(session, transient_quote)
+
+        batch = SQLAlchemyWriter.take_batch(session)
+        assert session.row_buffers == []
+
+        writer_session = ScrapyBulkSession(
+            bind=bulk_engine,
+            feed_options=feed_options
+        )
+        SQLAlchemyWriter.attach_batch(writer_session, batch)
+        writer_session.bulk_commit()
+
+        with bulk_engine.connect() as conn:
+            assert set(conn.execute(text('SELECT * FROM quote_tag'))) == {
+                (1, 1), (1, 2)
+            }
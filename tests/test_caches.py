@@ -0,0 +1,102 @@
+
+import pytest
+
+from integration_test_project.quotes.items.models import QuotesBase, Author, Tag
+
+from scrapy_sql.caches import *
+
+from sqlalchemy import create_engine, insert
+
+
+class TestLRUCache:
+
+    def test_max_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.put(('a', ), {'id': 1})
+        cache.put(('b', ), {'id': 2})
+        assert cache.get(('a', )) == {'id': 1}  # "b" is now least recent
+
+        cache.put(('c', ), {'id': 3})
+        assert ('b', ) not in cache
+        assert len(cache) == 2
+
+    def test_max_bytes(self):
+        size = LRUCache.entry_size(('a', ), {'id': 1})
+        cache = LRUCache(max_bytes=2 * size)
+        for i, key in enumerate('abc'):
+            cache.put((key, ), {'id': i})
+
+        assert list(cache.entries) == [('b', ), ('c', )]
+        assert cache.size == 2 * size
+
+
+class TestKeyCache:
+
+    def test_get(self):
+        cache = KeyCache(max_entries=10)
+        cache.update([(Tag.__table__, ('name', ), ('change', ), {'id': 1})])
+
+        assert cache.get(Tag.__table__, ('name', ), ('change', ), 'id') == 1
+        assert cache.get(Tag.__table__, ('name', ), ('life', ), 'id') is None
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    @pytest.mark.parametrize(
+        "max_entries, max_bytes",
+        [
+            ({Tag: 10}, None),
+            ({'integration_test_project.quotes.items.models.Tag': 10}, None),
+            (None, {Tag.__table__: 1024}),
+        ]
+    )
+    def test_per_table_limits(self, max_entries, max_bytes):
+        cache = KeyCache(max_entries=max_entries, max_bytes=max_bytes)
+        cache.update([
+            (Tag.__table__, ('name', ), ('change', ), {'id': 1}),
+            (Author.__table__, ('name', ), ('John F. Kennedy', ), {'id': 1}),
+        ])
+
+        assert cache.caches(Tag.__table__)
+        assert not cache.caches(Author.__table__)
+        assert cache.get(Author.__table__, ('name', ), ('John F. Kennedy', ), 'id') is None
+        assert cache.misses == 0  # Tables that aren't cached aren't counted
+
+
+class TestBloomFilter:
+
+    def test_contains(self):
+        bloom_filter = BloomFilter(capacity=1000, error_rate=0.01)
+        keys = [(('name', ), (str(i), )) for i in range(1000)]
+        bloom_filter.update(keys)
+
+        assert all(key in bloom_filter for key in keys)
+        false_positives = sum(
+            (('name', ), (str(i), )) in bloom_filter for i in range(1000, 11000)
+        )
+        assert false_positives < 200
+
+    def test_save_load(self, tmp_path):
+        bloom_filter = BloomFilter(capacity=100)
+        bloom_filter.add((('name', ), ('change', )))
+        bloom_filter.save(tmp_path / 'tag.bloom')
+
+        loaded = BloomFilter(capacity=100)
+        assert loaded.load(tmp_path / 'tag.bloom')
+        assert (('name', ), ('change', )) in loaded
+
+        # Filters of another size are seeded again
+        assert not BloomFilter(capacity=1000).load(tmp_path / 'tag.bloom')
+        assert not BloomFilter(capacity=100).load(tmp_path / 'missing.bloom')
+
+    def test_seed_bloom_filter(self, tmp_path):
+        engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+        QuotesBase.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(insert(Tag), [{'name': 'change'}, {'name': 'life'}])
+
+        bloom_filter = BloomFilter(capacity=100)
+        with engine.connect() as conn:
+            seed_bloom_filter(bloom_filter, conn, Tag.__table__)
+        engine.dispose()
+
+        assert (('id', ), (2, )) in bloom_filter
+        assert (('name', ), ('life', )) in bloom_filter
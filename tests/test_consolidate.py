@@ -0,0 +1,100 @@
+
+import argparse
+
+import pytest
+
+import _test_feedexport_helpers
+from test_spool import get_storage, kennedy_quotes
+
+from integration_test_project.quotes.items.models import (
+    QuotesBase, Author, Tag, Quote, t_quote_tag
+)
+
+from scrapy_sql.commands.consolidate import Command
+from scrapy_sql.spool import segment_paths
+from scrapy_sql.stmts import insert_ignore
+
+from scrapy.exceptions import UsageError
+from scrapy.settings import Settings
+from scrapy.spiders import Spider
+
+from sqlalchemy import create_engine, select
+
+
+def run_command(argv, settings):
+    command = Command()
+    command.settings = Settings(_test_feedexport_helpers.default_settings_dict)
+    command.settings.setdict(command.default_settings, priority='command')
+    command.settings.setdict(settings, priority='project')
+
+    parser = argparse.ArgumentParser()
+    command.add_options(parser)
+    opts, args = parser.parse_known_args(argv)
+    command.process_options(args, opts)
+    command.run(args, opts)
+
+
+def stage(uri, staging_dir):
+    """Each quote is staged by a spider of its own"""
+    for quote in kennedy_quotes():
+        storage = get_storage(uri, staging_dir=staging_dir)
+        session = storage.open(Spider('test'))
+        exporter = _test_feedexport_helpers.get_exporter(storage)
+        exporter.export_item(quote)
+        storage.store(session)
+        storage.close_spider(None)
+
+
+class TestConsolidateCommand:
+
+    def test_run(self, tmp_path):
+        staging_dir = str(tmp_path / 'staging')
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+        stage(uri, staging_dir)
+        assert len(segment_paths(staging_dir)) == 2
+
+        run_command(
+            ['--staging-dir', staging_dir, '--segments-per-batch', '1', uri],
+            {
+                'FEEDS': {uri: {
+                    'declarative_base': QuotesBase,
+                    'orm_stmts': {Author: insert_ignore, Tag: insert_ignore}
+                }}
+            }
+        )
+        assert segment_paths(staging_dir) == []
+
+        engine = create_engine(uri)
+        with engine.connect() as conn:
+            assert conn.execute(select(Author.name)).all() == [
+                ('John F. Kennedy', )
+            ]
+            assert conn.execute(select(Tag.name)).all() == [
+                ('change', ), ('deep-thoughts', ), ('life', )
+            ]
+            assert conn.execute(select(Quote.id, Quote.author_id)).all() == [
+                (1, 1), (2, 1)
+            ]
+            assert len(conn.execute(select(t_quote_tag)).all()) == 4
+        engine.dispose()
+
+    def test_staging_dir_from_feed_options(self, tmp_path):
+        staging_dir = str(tmp_path / 'staging')
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+        stage(uri, staging_dir)
+
+        run_command([uri], {
+            'SQLALCHEMY_DECLARATIVE_BASE': QuotesBase,
+            'FEEDS': {uri: {
+                'staging_dir': staging_dir,
+                'orm_stmts': {Author: insert_ignore, Tag: insert_ignore}
+            }}
+        })
+        assert segment_paths(staging_dir) == []
+
+    def test_usage(self, tmp_path):
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+        with pytest.raises(UsageError):
+            run_command([], {})
+        with pytest.raises(UsageError, match='--staging-dir'):
+            run_command([uri], {'SQLALCHEMY_DECLARATIVE_BASE': QuotesBase})
@@ -0,0 +1,133 @@
+
+import pytest
+
+from scrapy_sql.ddl import *
+
+from sqlalchemy import (
+    Column, ForeignKey, Index, Integer, MetaData, String, Table, create_engine,
+    event, inspect
+)
+from sqlalchemy.exc import NoSuchTableError
+
+
+@pytest.fixture
+def tables():
+    metadata = MetaData()
+    author = Table(
+        'author',
+        metadata,
+        Column('id', Integer, primary_key=True),
+        Column('name', String(50), unique=True),
+        Column('born', String(50), index=True)
+    )
+    quote = Table(
+        'quote',
+        metadata,
+        Column('id', Integer, primary_key=True),
+        Column('author_id', ForeignKey('author.id')),
+        Column('text', String(200)),
+        Index('ix_quote_text', 'text', unique=True)
+    )
+    return [author, quote]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    yield engine
+    engine.dispose()
+
+
+def count_statements(engine):
+    statements = []
+    event.listen(
+        engine,
+        'before_cursor_execute',
+        lambda conn, cursor, statement, *args: statements.append(statement)
+    )
+    return statements
+
+
+class TestEnsureTables:
+
+    def test_create(self, engine, tables):
+        statements = count_statements(engine)
+        assert ensure_tables(engine, tables) == []
+        assert set(inspect(engine).get_table_names()) == {'author', 'quote'}
+        assert {index['name'] for index in inspect(engine).get_indexes('author')} \
+            == {'ix_author_born'}
+
+        # Cached for the engine, no catalog query the second time
+        statements.clear()
+        assert ensure_tables(engine, tables) == []
+        assert statements == []
+
+    def test_create_missing(self, engine, tables):
+        tables[0].create(engine)
+        statements = count_statements(engine)
+        ensure_tables(engine, tables)
+        assert [s.split('(')[0].strip() for s in statements if 'CREATE TABLE' in s] \
+            == ['CREATE TABLE quote']
+
+    def test_verify_once(self, engine, tables):
+        with pytest.raises(NoSuchTableError, match='author, quote'):
+            ensure_tables(engine, tables, mode='verify_once')
+        assert inspect(engine).get_table_names() == []
+
+        ensure_tables(engine, tables)
+        statements = count_statements(engine)
+        assert ensure_tables(engine, tables, mode='verify_once') == []
+        assert statements == []
+
+    def test_skip(self, engine, tables):
+        statements = count_statements(engine)
+        assert ensure_tables(engine, tables, mode='skip') == []
+        assert statements == []
+        assert inspect(engine).get_table_names() == []
+
+    def test_invalid_mode(self, engine, tables):
+        with pytest.raises(ValueError, match='schema_mode'):
+            ensure_tables(engine, tables, mode='drop')
+
+    def test_defer_indexes(self, engine, tables):
+        indexes = ensure_tables(engine, tables, defer_indexes=True)
+        assert [index.name for index in indexes] == ['ix_author_born']
+        # The unique ones are created with the tables
+        assert inspect(engine).get_indexes('author') == []
+        assert [index['name'] for index in inspect(engine).get_indexes('quote')] \
+            == ['ix_quote_text']
+        assert inspect(engine).get_foreign_keys('quote')[0]['referred_table'] \
+            == 'author'
+        # The tables keep their indexes
+        assert len(tables[0].indexes) == 1
+
+        with engine.begin() as connection:
+            create_indexes(connection, indexes)
+        assert [index['name'] for index in inspect(engine).get_indexes('author')] \
+            == ['ix_author_born']
+
+    def test_failure_not_cached(self, engine, tables):
+        with pytest.raises(NoSuchTableError):
+            ensure_tables(engine, tables, mode='verify_once')
+        # The failed check isn't cached, the tables are still created
+        ensure_tables(engine, tables)
+        assert set(inspect(engine).get_table_names()) == {'author', 'quote'}
+
+    def test_created_concurrently(self, engine, tables, tmp_path):
+        # Another process creates `quote` after create_all checked for it,
+        # right before its CREATE TABLE
+        other = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+
+        created = []
+
+        def create_quote(target, connection, **kwargs):
+            if not created:
+                created.append(target)
+                with other.begin() as other_connection:
+                    target.create(other_connection)
+
+        event.listen(tables[1], 'before_create', create_quote)
+        ensure_tables(engine, tables)
+        assert created
+        assert set(inspect(engine).get_table_names()) == {'author', 'quote'}
+        other.dispose()
@@ -0,0 +1,55 @@
+
+import pytest
+
+from scrapy_sql.engines import *
+
+from sqlalchemy import create_engine, text
+
+
+class TestFreeze:
+
+    def test_freeze(self):
+        assert freeze({'b': [1, 2], 'a': {'ssl': True}}) == (
+            ('a', (('ssl', True), )), ('b', (1, 2))
+        )
+        assert freeze({'a': 1, 'b': 2}) == freeze({'b': 2, 'a': 1})
+        hash(freeze({'connect_args': {'options': ['-c', 'timezone=utc']}}))
+
+
+class TestEngineRegistry:
+
+    def test_acquire(self, tmp_path):
+        registry = EngineRegistry()
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+
+        engine = registry.acquire(uri, create_engine, pool_size=2)
+        assert registry.acquire(uri, create_engine, pool_size=2) is engine
+        assert registry.acquire(uri, create_engine, pool_size=3) is not engine
+        assert registry.acquire(uri, create_engine, pool_pre_ping=True) is not engine
+        assert len(registry) == 3
+        assert engine.pool.size() == 2
+
+    def test_release_and_dispose(self, tmp_path):
+        registry = EngineRegistry()
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+
+        engine = registry.acquire(uri, create_engine)
+        registry.acquire(uri, create_engine)
+        with engine.connect() as conn:
+            conn.execute(text('SELECT 1'))
+        assert engine.pool.checkedin() == 1
+
+        # Still used by one storage
+        registry.release(engine)
+        registry.dispose()
+        assert len(registry) == 1
+
+        # Released engines keep their connections until disposed of
+        registry.release(engine)
+        assert engine.pool.checkedin() == 1
+        assert registry.acquire(uri, create_engine) is engine
+        registry.release(engine)
+
+        registry.dispose()
+        assert len(registry) == 0
+        assert engine.pool.checkedin() == 0
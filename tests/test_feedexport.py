@@ -1,18 +1,34 @@
 
+import asyncio
+
 import pytest
 
 import _test_feedexport_helpers
+from _test_feedexport_helpers import get_exporter, get_storage
+from test_writer import FakeReactor
 
 from integration_test_project.quotes.items.models import (
     QuotesBase, Author, Tag, Quote, t_quote_tag
 )
 
+from scrapy_sql.caches import BloomFilter
+from scrapy_sql.engines import engines
 from scrapy_sql.feedexport import *
+from scrapy_sql.session import ScrapyBulkSession
+from scrapy_sql.stmts import insert_ignore
 
 from scrapy.crawler import Crawler
 from scrapy.spiders import Spider
+from scrapy.statscollectors import MemoryStatsCollector
+
+from twisted.internet import defer, task
+
+from sqlalchemy import Engine, event, insert, inspect, select
+from sqlalchemy.exc import NoSuchTableError
 
-from sqlalchemy import Engine
+from datetime import date
+import logging
+import threading
 
 
 class TestSQLAlchemyInstanceFilter:
@@ -106,6 +122,438 @@ class TestSQLAlchemyFeedStorage:
 
         assert feed_options == expected_feed_options
 
+    @pytest.mark.parametrize(
+        "flush_options",
+        [
+            {'flush_every_items': 2},
+            {'flush_every_bytes': 1},
+        ]
+    )
+    def test_flush(self, flush_options, tmp_path):
+        storage = get_storage(
+            f'sqlite:///{tmp_path / "test.db"}',
+            writer_threads=0,
+            **flush_options
+        )
+        session = storage.open(Spider('test'))
+        exporter = get_exporter(storage)
+
+        def tag_names():
+            with storage.engine.connect() as conn:
+                return [row[0] for row in conn.execute(select(Tag.name))]
+
+        exporter.export_item(Tag(name='change'))
+        expected = ['change'] if 'flush_every_bytes' in flush_options else []
+        assert tag_names() == expected
+
+        exporter.export_item(Tag(name='deep-thoughts'))
+        assert tag_names() == ['change', 'deep-thoughts']
+        assert len(session.new) == 0
+        assert storage.buffered_items == 0
+
+        storage.store(session)
+        storage.close_spider(None)
+
+    def test_flush_interval_survives_errors(self, tmp_path, monkeypatch, caplog):
+        clock = task.Clock()
+
+        class LoopingCall(task.LoopingCall):
+            def __init__(self, *args):
+                super().__init__(*args)
+                self.clock = clock
+
+        monkeypatch.setattr('scrapy_sql.feedexport.task.LoopingCall', LoopingCall)
+        storage = get_storage(
+            f'sqlite:///{tmp_path / "test.db"}',
+            writer_threads=0,
+            flush_interval_seconds=10
+        )
+        flushes = []
+
+        def flush():
+            flushes.append(clock.seconds())
+            if len(flushes) == 1:
+                raise ConnectionError('database is down')
+
+        storage.flush = flush
+        session = storage.open(Spider('test'))
+
+        with caplog.at_level(logging.ERROR, logger='scrapy_sql.feedexport'):
+            clock.advance(10)
+        assert 'Periodic flush of sqlite:///' in caplog.text
+        assert 'database is down' in caplog.text
+
+        # The loop was started again
+        clock.advance(10)
+        assert flushes == [10, 20]
+
+        storage.store(session)
+        clock.advance(10)
+        assert flushes == [10, 20]
+        assert not clock.getDelayedCalls()
+        storage.close_spider(None)
+
+    def test_store_sqlite_with_writer(self, tmp_path):
+        storage = get_storage(
+            f'sqlite:///{tmp_path / "test.db"}',
+            flush_every_items=1
+        )
+        reactor = FakeReactor()
+        storage.writer.reactor = reactor
+
+        session = storage.open(Spider('test'))
+        exporter = get_exporter(storage)
+        exporter.export_item(Tag(name='change'))
+        exporter.export_item(Tag(name='deep-thoughts'))
+
+        assert len(storage.writes) == 2
+        reactor.pump_until(storage.store(session))
+
+        with storage.engine.connect() as conn:
+            assert conn.exec_driver_sql('PRAGMA journal_mode').scalar() == 'wal'
+            assert conn.exec_driver_sql('PRAGMA synchronous').scalar() == 1  # NORMAL
+            assert [row[0] for row in conn.execute(select(Tag.name))] == [
+                'change', 'deep-thoughts'
+            ]
+        storage.close_spider(None)
+
+    def test_writer_shared_parent(self, tmp_path):
+        storage = get_storage(
+            f'sqlite:///{tmp_path / "test.db"}',
+            flush_every_items=1,
+            orm_stmts={Author: insert_ignore, Tag: insert_ignore}
+        )
+        reactor = storage.writer.reactor = FakeReactor()
+
+        # The first batch is held on the writer thread while the next item,
+        # by the same author, is exported
+        committing, release = threading.Event(), threading.Event()
+        commit = storage.writer.commit
+
+        def held_commit(session):
+            committing.set()
+            release.wait(10)
+            commit(session)
+
+        storage.writer.commit = held_commit
+
+        session = storage.open(Spider('test'))
+        exporter = get_exporter(storage)
+        kennedy = Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio='35th president')
+        exporter.export_item(Quote(quote='If not us, who?', author=kennedy))
+        assert committing.wait(10)
+        exporter.export_item(Quote(quote='Change is the law of life.', author=kennedy))
+        release.set()
+        reactor.pump_until(storage.store(session))
+
+        with storage.engine.connect() as conn:
+            assert conn.execute(select(Author.id, Author.name)).all() == [
+                (1, 'John F. Kennedy')
+            ]
+            assert conn.execute(select(Quote.author_id)).all() == [(1, ), (1, )]
+        storage.close_spider(None)
+
+    def test_sqlite_begins_transactions(self, tmp_path):
+        storage = get_storage(
+            f'sqlite:///{tmp_path / "test.db"}'
+        )
+        # Savepoints are nested in the transaction instead of opening it
+        with storage.engine.begin() as conn:
+            assert conn.connection.driver_connection.in_transaction
+            conn.exec_driver_sql('SAVEPOINT sp')
+            conn.execute(insert(Tag), [{'name': 'change'}])
+            conn.exec_driver_sql('RELEASE SAVEPOINT sp')
+            conn.rollback()
+        with storage.engine.connect() as conn:
+            assert conn.execute(select(Tag.name)).all() == []
+        storage.close_spider(None)
+
+    def test_in_memory_sqlite_has_no_writer(self):
+        storage = get_storage('sqlite://')
+        assert storage.writer is None
+
+    def test_shared_engine(self, tmp_path):
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+        storage = get_storage(uri, pool_size=3, connect_args={'timeout': 30})
+        assert storage.shared_engine
+        assert storage.engine.pool.size() == 3
+
+        # e.g. the next batch of a feed
+        storage.close_spider(None)
+        assert get_storage(uri, pool_size=3, connect_args={'timeout': 30}).engine \
+            is storage.engine
+        assert get_storage(uri, pool_size=5).engine is not storage.engine
+        assert get_storage(uri, pool_size=3, connect_args={'timeout': 30}, share_engine=False) \
+            .engine is not storage.engine
+
+        # In-memory SQLite databases aren't shared
+        storage = get_storage('sqlite://')
+        assert not storage.shared_engine
+        assert get_storage('sqlite://').engine is not storage.engine
+
+    @pytest.mark.parametrize('branch', ['staging', 'sqlite', 'writer', 'thread'])
+    def test_store_releases_engine(self, tmp_path, monkeypatch, branch):
+        # close_spider isn't connected to a signal, `store` is the last call
+        feed_options = {}
+        if branch == 'staging':
+            feed_options['staging_dir'] = str(tmp_path / 'staging')
+        elif branch != 'writer':
+            feed_options['writer_threads'] = 0
+
+        storage = get_storage(
+            f'sqlite:///{tmp_path / "test.db"}',
+            **feed_options
+        )
+        reactor = FakeReactor()
+        if branch == 'writer':
+            storage.writer.reactor = reactor
+        elif branch == 'thread':
+            # e.g. PostgreSQL without writer threads, committed in a thread
+            storage.is_sqlite = False
+            monkeypatch.setattr(
+                'scrapy_sql.feedexport.threads.deferToThread',
+                lambda f, *args: defer.maybeDeferred(f, *args)
+            )
+
+        def references():
+            return sum(
+                engines.references[key]
+                for key, engine in engines.engines.items()
+                if engine is storage.engine
+            )
+
+        assert references() == 1
+        session = storage.open(Spider('test'))
+        get_exporter(storage).export_item(Tag(name='change'))
+
+        d = storage.store(session)
+        if branch == 'writer':
+            reactor.pump_until(d)
+        elif d is not None:
+            assert d.called
+        assert references() == 0
+
+    def test_schema_mode(self, tmp_path):
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+        storage = get_storage(uri, schema_mode='skip')
+        assert inspect(storage.engine).get_table_names() == []
+        with pytest.raises(NoSuchTableError):
+            get_storage(uri, schema_mode='verify_once')
+
+        storage = get_storage(uri)
+        assert set(inspect(storage.engine).get_table_names()) \
+            >= set(QuotesBase.metadata.tables)
+        # Already checked for this engine, the next batch runs no query
+        storage.close_spider(None)
+        statements = []
+        event.listen(
+            storage.engine,
+            'before_cursor_execute',
+            lambda conn, cursor, statement, *args: statements.append(statement)
+        )
+        get_storage(uri, schema_mode='verify_once')
+        assert statements == []
+
+    def test_sessions_share_orm_stmt_cache(self):
+        storage = get_storage('sqlite://')
+        assert storage.session.orm_stmt_cache is storage.Session().orm_stmt_cache
+        assert storage.session.orm_stmt_cache.orm_stmts is storage.feed_options['orm_stmts']
+
+    def test_publish_stats(self, tmp_path):
+        crawler = Crawler(Spider, _test_feedexport_helpers.default_settings_dict)
+        crawler.stats = MemoryStatsCollector(crawler)
+        storage = get_storage(
+            f'sqlite:///{tmp_path / "test.db"}',
+            crawler,
+            writer_threads=0,
+            key_cache_size=100
+        )
+        assert storage.session.key_cache is storage.key_cache
+        session = storage.open(Spider('test'))
+        exporter = get_exporter(storage)
+        for name in ('change', 'change', 'life', 'change'):
+            exporter.export_item(Tag(name=name))
+
+        storage.store(session)
+        storage.close_spider(None)
+
+        assert crawler.stats.get_value('scrapy_sql/dedup/duplicates') == 2
+        assert crawler.stats.get_value('scrapy_sql/dedup/duplicates/tag') == 2
+        assert crawler.stats.get_value('scrapy_sql/key_cache/hits') == 0
+        assert session.stats == {}
+
+    def test_bloom_filters(self, tmp_path):
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+
+        def crawl(*names):
+            storage = get_storage(
+                uri,
+                writer_threads=0,
+                orm_stmts={Tag: insert_ignore},
+                bloom_filters={Tag: 1000},
+                bloom_filter_dir=str(tmp_path / 'bloom')
+            )
+            session = storage.open(Spider('test'))
+            exporter = get_exporter(storage)
+            for name in names:
+                exporter.export_item(Tag(name=name))
+            storage.store(session)
+            storage.close_spider(None)
+            return storage
+
+        crawl('change')
+        assert (tmp_path / 'bloom' / 'tag.bloom').exists()
+
+        # The filter is loaded from disk rather than seeded
+        storage = crawl('change', 'life')
+        assert (('name', ), ('life', )) in storage.bloom_filters[Tag.__table__]
+        assert storage.session.stats == {}
+        with storage.engine.connect() as conn:
+            assert [row[0] for row in conn.execute(select(Tag.name))] == ['change', 'life']
+
+    def test_bloom_filters_seeded_in_thread(self, tmp_path, monkeypatch):
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+        seeding = []
+        monkeypatch.setattr(
+            'scrapy_sql.feedexport.threads.deferToThread',
+            lambda f, *args: seeding.append((f, *args)) or defer.Deferred()
+        )
+        storage = get_storage(
+            uri,
+            orm_stmts={Tag: insert_ignore},
+            bloom_filters={Tag: 1000}
+        )
+        reactor = storage.writer.reactor = FakeReactor()
+        storage.open(Spider('test'))
+
+        assert seeding == [(storage.load_bloom_filters, )]
+        assert storage.bloom_filters == {}
+        storage.load_bloom_filters()
+        # Each row adds its primary key & its name
+        assert storage.bloom_filters[Tag.__table__].num_bits \
+            == BloomFilter(2000).num_bits
+        reactor.pump_until(storage.writer.close())
+        storage._dispose(None)
+
+    @pytest.mark.parametrize('stmt', [
+        'scrapy_sql.stmts.insert',
+        'scrapy_sql.stmts.replace',
+        'scrapy_sql.stmts.copy_replace',
+    ])
+    def test_bloom_filters_require_insert_ignore(self, tmp_path, stmt):
+        with pytest.raises(ValueError, match='author is written with'):
+            get_storage(
+                f'sqlite:///{tmp_path / "test.db"}',
+                orm_stmts={Author: stmt},
+                bloom_filters={Author: 1000}
+            )
+
+    def test_async_engine(self, tmp_path):
+        pytest.importorskip('aiosqlite')
+
+        storage = get_storage(
+            f'sqlite+aiosqlite:///{tmp_path / "test.db"}'
+        )
+        assert storage.is_async and storage.writer is None
+        assert isinstance(storage.session, ScrapyBulkSession)
+
+        # Without the asyncio reactor there's no event loop to write on
+        with pytest.raises(NotConfigured):
+            storage.open(Spider('test'))
+
+        exporter = get_exporter(storage)
+        exporter.export_item(Quote(
+            quote='If not us, who? If not now, when?',
+            author=Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio='35th president'),
+            tags=[Tag(name='change'), Tag(name='deep-thoughts')]
+        ))
+
+        async def write():
+            storage.opening = asyncio.ensure_future(storage.open_async())
+            await storage.commit_async(SQLAlchemyWriter.take_batch(storage.session))
+            async with storage.async_engine.connect() as conn:
+                tag_names = (await conn.execute(select(Tag.name))).scalars().all()
+                quote_tags = (await conn.execute(select(t_quote_tag))).all()
+            await storage.async_engine.dispose()
+            return tag_names, quote_tags
+
+        tag_names, quote_tags = asyncio.run(write())
+        assert tag_names == ['change', 'deep-thoughts']
+        assert set(quote_tags) == {(1, 1), (1, 2)}
+        assert len(storage.session.new) == 0
+
+    @pytest.mark.parametrize('add', [None, 'scrapy_sql.buffers.buffered_add'])
+    def test_spool(self, tmp_path, monkeypatch, add):
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+        spool_dir = tmp_path / 'spool'
+
+        # Parents are spooled by natural key, nothing is compiled per item
+        def compile_subquery(clause):
+            raise AssertionError('subquery compiled')
+
+        monkeypatch.setattr(
+            'scrapy_sql.spool.SpooledSubquery.from_clause',
+            compile_subquery
+        )
+
+        feed_options = {
+            'writer_threads': 0,
+            'spool_dir': str(spool_dir),
+            'orm_stmts': {Author: insert_ignore, Tag: insert_ignore},
+        }
+        if add is not None:
+            feed_options['add'] = add
+
+        def export(storage, *tag_names):
+            session = storage.open(Spider('test'))
+            exporter = get_exporter(storage)
+            kennedy = Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio='35th president')
+            for name in tag_names:
+                exporter.export_item(Quote(
+                    quote=f'A quote about {name}',
+                    author=kennedy,
+                    tags=[Tag(name=name), Tag(name='change')]
+                ))
+            return session
+
+        def database_down(session):
+            raise ConnectionError('database is down')
+
+        # A crawl whose database is down keeps its rows in the spool, one
+        # that's killed before committing as well
+        storage = get_storage(uri, commit=database_down, **feed_options)
+        session = export(storage, 'life')
+        with pytest.raises(ConnectionError):
+            storage.store(session)
+        storage.close_spider(None)
+
+        killed = get_storage(uri, **feed_options)
+        export(killed, 'love')
+        # As if its process had died, its segment is left unsealed
+        killed.spool.file.close()
+        killed.spool.file = None
+        killed.spool.close()
+        assert sorted(path.suffix for path in spool_dir.iterdir()) == ['.part', '.seg']
+
+        # The next crawl commits them with its first batch
+        storage = get_storage(uri, **feed_options)
+        storage.crawler.stats = MemoryStatsCollector(storage.crawler)
+        session = export(storage, 'truth')
+        storage.store(session)
+        storage.close_spider(None)
+        assert list(spool_dir.iterdir()) == []
+        assert storage.crawler.stats.get_value('scrapy_sql/spool/replayed_rows') > 0
+
+        with storage.engine.connect() as conn:
+            assert conn.execute(select(Author.name)).scalars().all() == ['John F. Kennedy']
+            assert set(conn.execute(select(Quote.quote)).scalars()) == {
+                'A quote about life', 'A quote about love', 'A quote about truth'
+            }
+            assert set(conn.execute(select(Tag.name)).scalars()) == {
+                'change', 'life', 'love', 'truth'
+            }
+            assert len(conn.execute(select(t_quote_tag)).all()) == 6
+
     @pytest.mark.skip(reason="wrapper func")
     def test_open(self):
         pass
@@ -0,0 +1,465 @@
+
+import asyncio
+from datetime import date
+from decimal import Decimal
+import os
+
+import pytest
+
+from integration_test_project.quotes.items.models import (
+    QuotesBase, Author, Tag, Quote, t_quote_tag
+)
+
+from scrapy_sql.loaders import *
+from scrapy_sql.session import ScrapyBulkSession
+from scrapy_sql import stmts
+
+from sqlalchemy import create_engine, insert, select, text
+from sqlalchemy.dialects import mysql, postgresql
+from sqlalchemy.engine.interfaces import AdaptedConnection
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import Session
+
+
+postgresql_uri = os.environ.get('SCRAPY_SQL_TEST_POSTGRESQL_URI')
+
+
+def test_group_rows():
+    params = [
+        {'name': 'change'},
+        {'id': 3, 'name': 'deep-thoughts'},
+        {'name': 'life'},
+    ]
+    assert group_rows(('id', 'name'), params) == {
+        ('name', ): [('change', ), ('life', )],
+        ('id', 'name'): [(3, 'deep-thoughts')],
+    }
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, ''),
+        ('', '""'),
+        ('say "hi", bye', '"say ""hi"", bye"'),
+        (3, '3'),
+        (Decimal('1.50'), '1.50'),
+        (True, 'true'),
+        (date(1917, 5, 29), '"1917-05-29"'),
+        (b'\x00\xff', '"\\x00ff"'),
+    ]
+)
+def test_csv_value(value, expected):
+    assert csv_value(value) == expected
+
+
+def test_csv_buffer():
+    assert csv_buffer([(1, None), (2, 'a')]).read() == '1,\n2,"a"\n'
+
+
+class FakeCopy:
+
+    def __init__(self, cursor, sql):
+        cursor.copies.append((sql, self))
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def write_row(self, row):
+        self.rows.append(row)
+
+
+class FakeCursor:
+
+    def __init__(self):
+        self.copies = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def copy(self, sql):  # psycopg 3
+        return FakeCopy(self, sql)
+
+    def copy_expert(self, sql, file):  # psycopg2
+        self.copies.append((sql, file.read()))
+
+
+class FakeConnection:
+    """Stands in for a SQLAlchemy Connection of the given driver"""
+
+    def __init__(self, driver):
+        self.dialect = type('Dialect', (), {'driver': driver})
+        self.cursor = FakeCursor()
+        dbapi_connection = type('DBAPIConnection', (), {
+            'cursor': lambda _: self.cursor
+        })()
+        self.connection = type('PoolProxiedConnection', (), {
+            'dbapi_connection': dbapi_connection
+        })
+
+
+class TestCopyFrom:
+
+    def test_on_conflict_is_validated(self):
+        with pytest.raises(ValueError):
+            CopyFrom(Tag.__table__, on_conflict='update')
+
+    @pytest.mark.parametrize(
+        "on_conflict, column_names, expected",
+        [
+            (None, ('name', ), 'INSERT INTO tag (name) SELECT'),
+            ('ignore', ('name', ), 'ON CONFLICT DO NOTHING'),
+            ('replace', ('name', ), 'ON CONFLICT DO NOTHING'),  # Nothing else to update
+            (
+                'replace',
+                ('name', 'birthday', 'bio'),
+                'ON CONFLICT (name) DO UPDATE SET birthday = excluded.birthday, bio = excluded.bio'
+            ),
+        ]
+    )
+    def test_merge_insert(self, on_conflict, column_names, expected):
+        table = Tag.__table__ if len(column_names) == 1 else Author.__table__
+        copy_from = CopyFrom(table, on_conflict)
+        staging = copy_from.staging_table()
+
+        stmt = copy_from.merge_insert(table, column_names).from_select(
+            column_names,
+            select(*[staging.columns[name] for name in column_names])
+        )
+        sql = ' '.join(str(stmt.compile(dialect=postgresql.dialect())).split())
+
+        assert expected in sql
+        assert staging.name.startswith('scrapy_sql_staging_')
+
+    def test_compile(self):
+        assert CopyFrom(Tag.__table__).compile() == 'COPY tag (id, name) FROM STDIN'
+
+    def test_copy_psycopg(self):
+        connection = FakeConnection('psycopg')
+        CopyFrom(Tag.__table__).copy(
+            connection, Tag.__table__, ('name', ), [('change', ), ('life', )]
+        )
+
+        (sql, copy), = connection.cursor.copies
+        assert sql == 'COPY tag (name) FROM STDIN'
+        assert copy.rows == [('change', ), ('life', )]
+
+    def test_copy_psycopg2(self):
+        connection = FakeConnection('psycopg2')
+        CopyFrom(Tag.__table__).copy(
+            connection, Tag.__table__, ('id', 'name'), [(1, 'change'), (2, None)]
+        )
+
+        assert connection.cursor.copies == [(
+            'COPY tag (id, name) FROM STDIN WITH (FORMAT csv)',
+            '1,"change"\n2,\n'
+        )]
+
+    def test_copy_asyncpg(self):
+        copies = []
+
+        class FakeAsyncpgConnection:
+            in_transaction = False
+
+            def is_in_transaction(self):
+                return self.in_transaction
+
+            async def copy_records_to_table(self, table_name, **kwargs):
+                assert self.in_transaction
+                copies.append((table_name, kwargs))
+
+        driver_connection = FakeAsyncpgConnection()
+        connection = FakeConnection('asyncpg')
+        connection.connection.driver_connection = driver_connection
+        connection.connection.dbapi_connection.run_async = \
+            lambda fn: asyncio.run(fn(driver_connection))
+
+        def exec_driver_sql(sql):
+            driver_connection.in_transaction = True
+        connection.exec_driver_sql = exec_driver_sql
+
+        CopyFrom(Tag.__table__).copy(
+            connection, Tag.__table__, ('name', ), [('change', )]
+        )
+        assert copies == [('tag', {
+            'records': [('change', )],
+            'columns': ('name', ),
+            'schema_name': None
+        })]
+
+    def test_asyncpg_adapter_api(self):
+        # The asyncpg branch of `copy` only uses SQLAlchemy's public
+        # AdaptedConnection API
+        from sqlalchemy.dialects.postgresql.asyncpg import (
+            AsyncAdapt_asyncpg_connection
+        )
+        assert issubclass(AsyncAdapt_asyncpg_connection, AdaptedConnection)
+        assert callable(AdaptedConnection.run_async)
+        assert isinstance(AdaptedConnection.driver_connection, property)
+
+    def test_copy_unsupported_driver(self):
+        with pytest.raises(NotImplementedError):
+            CopyFrom(Tag.__table__).copy(
+                FakeConnection('pg8000'), Tag.__table__, ('name', ), []
+            )
+
+
+@pytest.mark.parametrize(
+    "func, expected",
+    [
+        (stmts.copy, 'INSERT INTO tag (id, name) VALUES (?, ?)'),
+        (stmts.copy_ignore, 'INSERT OR IGNORE INTO tag (id, name) VALUES (?, ?)'),
+    ]
+)
+def test_copy_stmts_fall_back_to_insert(func, expected):
+    session = Session(bind=create_engine('sqlite://'))
+    assert str(func(Tag.__table__, session).compile(session.bind)) == expected
+
+
+class FakeLoader:
+    """A loader recording what bulk_commit hands it"""
+
+    loaded = []
+
+    def __init__(self, table):
+        self.table = table
+
+    @property
+    def insert(self):
+        return insert(self.table)
+
+    def compile(self, dialect=None):
+        return f'LOAD {self.table.name}'
+
+    def load(self, session, params):
+        self.loaded.append((self.table.name, params))
+        session.execute(insert(self.table), params)
+
+
+def test_bulk_commit_with_loader(transient_quote, tmp_path):
+    FakeLoader.loaded.clear()
+    feed_options = {
+        'orm_stmts': {
+            Author.__table__: insert,
+            Tag.__table__:    FakeLoader,
+            Quote.__table__:  FakeLoader,
+            t_quote_tag:      insert,
+        },
+        'declarative_base': QuotesBase
+    }
+
+    engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    QuotesBase.metadata.create_all(engine)
+
+    transient_quote.author_id = Author(name='John F. Kennedy').subquery('id')
+
+    session = ScrapyBulkSession(bind=engine, feed_options=feed_options)
+    session.add(transient_quote)
+    session.bulk_commit()
+
+    # The quote's subquery can't be loaded, it's INSERTed instead
+    assert FakeLoader.loaded == [
+        ('tag', [{'name': 'change'}, {'name': 'deep-thoughts'}])
+    ]
+    with engine.connect() as conn:
+        assert conn.execute(text('SELECT count(*) FROM quote_tag')).scalar() == 2
+
+
+@pytest.mark.skipif(
+    postgresql_uri is None,
+    reason='SCRAPY_SQL_TEST_POSTGRESQL_URI is not set'
+)
+@pytest.mark.parametrize("tag_stmt", [stmts.copy_ignore, stmts.copy_replace])
+def test_copy_postgresql(transient_quote, tag_stmt):
+    feed_options = {
+        'orm_stmts': {
+            Author.__table__: stmts.copy,
+            Tag.__table__:    tag_stmt,
+            Quote.__table__:  stmts.copy,
+            t_quote_tag:      stmts.copy,
+        },
+        'declarative_base': QuotesBase
+    }
+
+    engine = create_engine(postgresql_uri)
+    QuotesBase.metadata.drop_all(engine)
+    QuotesBase.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(insert(Tag), [{'name': 'change'}])
+
+    try:
+        session = ScrapyBulkSession(bind=engine, feed_options=feed_options)
+        session.add(transient_quote)
+        session.bulk_commit()
+
+        with engine.connect() as conn:
+            assert conn.execute(text('SELECT count(*) FROM author')).scalar() == 1
+            assert conn.execute(text('SELECT count(*) FROM tag')).scalar() == 2
+            assert conn.execute(text('SELECT count(*) FROM quote_tag')).scalar() == 2
+    finally:
+        QuotesBase.metadata.drop_all(engine)
+        engine.dispose()
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [
+        (None, '\\N'),
+        ('', ''),
+        ('tab\tnew\nline\\', 'tab\\tnew\\nline\\\\'),
+        (False, '0'),
+        (date(1917, 5, 29), '1917-05-29'),
+    ]
+)
+def test_tsv_value(value, expected):
+    assert tsv_value(value) == expected
+
+
+class FakeMySQLConnection:
+
+    def __init__(self, error=None):
+        self.error = error
+        self.loaded = []
+        self.attempts = 0
+        self.statements = []
+
+    def execute(self, stmt):
+        self.statements.append(
+            ' '.join(str(stmt.compile(dialect=mysql.dialect())).split())
+        )
+
+    def exec_driver_sql(self, sql):
+        if not sql.startswith('LOAD DATA'):
+            self.statements.append(sql)
+            return
+        self.attempts += 1
+        if self.error is not None:
+            raise DBAPIError(sql, None, self.error)
+        path = sql.split("'")[1]
+        with open(path, encoding='utf-8') as file:
+            self.loaded.append((sql, file.read()))
+
+
+class FakeMySQLSession:
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.executed = []
+
+    def connection(self):
+        return self._connection
+
+    def execute(self, stmt, params):
+        self.executed.append((stmt, params))
+
+
+class TestLoadDataInfile:
+
+    @pytest.mark.parametrize(
+        "on_conflict, expected",
+        [
+            (None, 'INSERT INTO author'),
+            ('ignore', 'INSERT IGNORE INTO author'),
+            (
+                'replace',
+                'ON DUPLICATE KEY UPDATE name = VALUES(name), '
+                'birthday = VALUES(birthday), bio = VALUES(bio)'
+            ),
+        ]
+    )
+    def test_insert(self, on_conflict, expected):
+        stmt = LoadDataInfile(Author.__table__, on_conflict).insert
+        assert expected in str(stmt.compile(dialect=mysql.dialect()))
+
+    @pytest.mark.parametrize(
+        "on_conflict, expected",
+        [
+            (None, 'INSERT INTO author (name, bio) SELECT'),
+            ('ignore', 'INSERT IGNORE INTO author (name, bio) SELECT'),
+            ('replace', 'ON DUPLICATE KEY UPDATE name = VALUES(name), bio = VALUES(bio)'),
+        ]
+    )
+    def test_load(self, on_conflict, expected):
+        connection = FakeMySQLConnection()
+        loader = LoadDataInfile(Author.__table__, on_conflict=on_conflict)
+        loader.load(FakeMySQLSession(connection), [
+            {'name': 'John F. Kennedy', 'bio': '35th president'},
+            {'name': 'Albert Einstein', 'bio': 'theoretical\tphysicist'},
+        ])
+
+        # LOAD DATA LOCAL skips duplicates & REPLACE deletes them, so the
+        # rows are staged & merged with the INSERT of `on_conflict`
+        (sql, data), = connection.loaded
+        path = sql.split("'")[1]
+        create, merge, drop = connection.statements
+        staging = create.split()[3]
+        assert create.startswith('CREATE TEMPORARY TABLE scrapy_sql_staging_author_')
+        assert sql == (
+            f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE {staging} "
+            "CHARACTER SET utf8mb4 (name, bio)"
+        )
+        assert data == 'John F. Kennedy\t35th president\nAlbert Einstein\ttheoretical\\tphysicist\n'
+        assert expected in merge
+        assert f'FROM {staging}' in merge
+        assert drop == f'DROP TEMPORARY TABLE {staging}'
+        assert not os.path.exists(path)
+
+    def test_load_falls_back_to_insert(self):
+        error = Exception(3948, 'Loading local data is disabled')
+        session = FakeMySQLSession(FakeMySQLConnection(error))
+        loader = LoadDataInfile(Tag.__table__, on_conflict='ignore')
+
+        params = [{'name': 'change'}]
+        loader.load(session, params)
+        assert loader.local_infile is False
+        assert session.executed[0][1] == params
+
+        # Later batches don't try LOAD DATA again
+        session.connection = None
+        loader.load(session, params)
+        assert len(session.executed) == 2
+
+    def test_load_falls_back_for_remaining_groups(self):
+        error = Exception(3948, 'Loading local data is disabled')
+        connection = FakeMySQLConnection(error)
+        session = FakeMySQLSession(connection)
+        loader = LoadDataInfile(Author.__table__, on_conflict='ignore')
+
+        loader.load(session, [
+            {'name': 'John F. Kennedy'},
+            {'name': 'Albert Einstein', 'bio': 'Physicist'},
+        ])
+        assert connection.attempts == 1
+        assert [params for _, params in session.executed] == [
+            [{'name': 'John F. Kennedy'}],
+            [{'name': 'Albert Einstein', 'bio': 'Physicist'}],
+        ]
+
+    def test_load_raises_other_errors(self):
+        error = Exception(1062, 'Duplicate entry')
+        loader = LoadDataInfile(Tag.__table__)
+        with pytest.raises(DBAPIError):
+            loader.load(
+                FakeMySQLSession(FakeMySQLConnection(error)),
+                [{'name': 'change'}]
+            )
+        assert loader.local_infile is True
+
+
+@pytest.mark.parametrize(
+    "func, expected",
+    [
+        (stmts.load_data, 'INSERT INTO tag (id, name) VALUES (?, ?)'),
+        (stmts.load_data_ignore, 'INSERT OR IGNORE INTO tag (id, name) VALUES (?, ?)'),
+    ]
+)
+def test_load_data_stmts_fall_back_to_insert(func, expected):
+    session = Session(bind=create_engine('sqlite://'))
+    assert str(func(Tag.__table__, session).compile(session.bind)) == expected
@@ -0,0 +1,62 @@
+import pytest
+
+import _test_feedexport_helpers
+
+from integration_test_project.quotes.items.models import QuotesBase, Tag
+
+from scrapy_sql.pipelines import *
+
+from scrapy.crawler import Crawler
+from scrapy.spiders import Spider
+
+from sqlalchemy import select
+
+
+def get_crawler(settings):
+    return Crawler(
+        Spider,
+        {**_test_feedexport_helpers.default_settings_dict, **settings}
+    )
+
+
+class TestSQLAlchemyPipeline:
+
+    def test_from_crawler(self, tmp_path):
+        with pytest.raises(NotConfigured):
+            SQLAlchemyPipeline.from_crawler(get_crawler({}))
+
+        pipeline = SQLAlchemyPipeline.from_crawler(get_crawler({
+            'SQLALCHEMY_PIPELINE_URI': f'sqlite:///{tmp_path / "test.db"}',
+            'SQLALCHEMY_PIPELINE_OPTIONS': {'declarative_base': QuotesBase},
+            'SQLALCHEMY_FLUSH_INTERVAL_SECONDS': 60,
+        }))
+        assert pipeline.feed_options['flush_every_items'] == 1000
+        assert pipeline.feed_options['flush_interval_seconds'] == 60
+        assert Tag.__table__ in pipeline.feed_options['orm_stmts']
+
+    def test_process_item(self, tmp_path):
+        pipeline = SQLAlchemyPipeline.from_crawler(get_crawler({
+            'SQLALCHEMY_PIPELINE_URI': f'sqlite:///{tmp_path / "test.db"}',
+            'SQLALCHEMY_PIPELINE_OPTIONS': {
+                'declarative_base': QuotesBase,
+                'writer_threads': 0,
+                'flush_every_items': 2,
+                'flush_interval_seconds': None,
+            },
+        }))
+        spider = Spider('test')
+        pipeline.open_spider(spider)
+
+        def tag_names():
+            with pipeline.storage.engine.connect() as conn:
+                return [row[0] for row in conn.execute(select(Tag.name))]
+
+        items = [Tag(name='change'), {'name': 'not an instance'}, Tag(name='life')]
+        assert [pipeline.process_item(item, spider) for item in items] == items
+
+        # Written as the spider runs, not only when it's closed
+        assert tag_names() == ['change', 'life']
+
+        pipeline.process_item(Tag(name='love'), spider)
+        pipeline.close_spider(spider)
+        assert tag_names() == ['change', 'life', 'love']
@@ -0,0 +1,82 @@
+import pytest
+
+from integration_test_project.quotes.items.models import (
+    QuotesBase, Author, Tag, Quote, t_quote_tag
+)
+
+from scrapy_sql import ScrapyDeclarativeBase
+from scrapy_sql.schema import *
+
+from sqlalchemy import Column, ForeignKey, Integer, MetaData, Table
+from sqlalchemy.orm import DeclarativeBase, relationship
+
+
+class TestEntitySchema:
+
+    def test_cached(self):
+        assert entity_schema(Quote) is entity_schema(Quote)
+
+    def test_dunder_init(self):
+        schema = entity_schema(Quote)
+
+        assert schema.column_names == ('id', 'author_id', 'quote')
+        assert schema.relationship_names == ('author', 'tags')
+        assert schema.field_names == (
+            'id', 'author_id', 'quote', 'author', 'tags'
+        )
+        assert schema.column_name_to_column_obj_map['quote'] \
+            is Quote.__table__.columns['quote']
+
+    def test_read_only(self):
+        schema = entity_schema(Quote)
+        with pytest.raises(TypeError):
+            schema.column_name_to_column_obj_map['quote'] = None
+
+        # The classproperties return copies, changing them is harmless
+        Quote.column_name_to_column_obj_map.pop('quote')
+        Quote.relationship_name_to_relationship_obj_map.clear()
+        assert 'quote' in entity_schema(Quote).column_name_to_column_obj_map
+        assert Quote.relationship_name_to_relationship_obj_map.keys() \
+            == {'author', 'tags'}
+
+
+class TestMetaDataSchema:
+
+    def test_cached(self):
+        assert metadata_schema(Quote) is metadata_schema(QuotesBase)
+
+    def test_dunder_init(self):
+        schema = metadata_schema(QuotesBase)
+
+        assert schema.sorted_tables == (
+            Author.__table__, Tag.__table__, Quote.__table__, t_quote_tag
+        )
+        assert schema.sorted_entities == (Author, Tag, Quote)
+
+    def test_invalidated_when_metadata_changes(self):
+
+        class _SchemaBase(DeclarativeBase, ScrapyDeclarativeBase):
+            pass
+
+        class Parent(_SchemaBase):
+            __tablename__ = 'parent'
+            id = Column(Integer, primary_key=True)
+
+        assert _SchemaBase.sorted_tables == [Parent.__table__]
+        cached = metadata_schema(_SchemaBase)
+
+        class Child(_SchemaBase):
+            __tablename__ = 'child'
+            id = Column(Integer, primary_key=True)
+            parent_id = Column(ForeignKey('parent.id'))
+            parent = relationship('Parent')
+
+        assert metadata_schema(_SchemaBase) is not cached
+        assert _SchemaBase.sorted_tables == [Parent.__table__, Child.__table__]
+        assert _SchemaBase.sorted_entities == [Parent, Child]
+        assert Child.relationship_names == ('parent', )
+
+    def test_other_metadata_keeps_cache(self):
+        cached = metadata_schema(QuotesBase)
+        Table('unrelated', MetaData(), Column('id', Integer, primary_key=True))
+        assert metadata_schema(QuotesBase) is cached
@@ -1,6 +1,13 @@
 
+from copy import deepcopy
+from datetime import date
 from pprint import pprint
+from types import SimpleNamespace
+import asyncio
+import json
+import logging
 import sqlite3
+import time
 
 import pytest
 
@@ -11,7 +18,19 @@ from integration_test_project.quotes.items.models import (
 from scrapy_sql.session import *
 from scrapy_sql.utils import *
 
-from sqlalchemy import create_engine, insert
+from scrapy_sql import ScrapyDeclarativeBase
+from scrapy_sql.buffers import RowBuffer, buffered_add
+from scrapy_sql.caches import BloomFilter, KeyCache
+from scrapy_sql.deadletter import dead_letter_table
+from scrapy_sql.stmts import insert_ignore, upsert
+
+from sqlalchemy import (
+    Column, Integer, String, Text, create_engine, create_mock_engine, event,
+    insert, text
+)
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import DeclarativeBase, Session
 from sqlalchemy.orm.attributes import instance_state
 from sqlalchemy.orm.collections import InstrumentedList
 
@@ -27,6 +46,97 @@ tag_id_column = [c for c in Tag.columns if c.name == 'id'][0]
 join_quote_id_column, join_tag_id_column = t_quote_tag.columns
 
 
+class HashBase(DeclarativeBase, ScrapyDeclarativeBase):
+    pass
+
+
+class HashedAuthor(HashBase):
+    __tablename__ = 'hashed_author'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(50), unique=True, nullable=False)
+    bio = Column(Text)
+    content_hash = Column(String(32))
+
+
+def quotes_feed_options(ignored=(), **overrides):
+    """
+    Feed options of a ScrapyBulkSession writing the quotes tables with
+    plain INSERTs, insert_ignore for the entities in `ignored`
+    """
+    orm_stmts = {
+        Author.__table__: insert,
+        Tag.__table__:    insert,
+        Quote.__table__:  insert,
+        t_quote_tag:      insert,
+    }
+    for entity in ignored:
+        orm_stmts[entity.__table__] = insert_ignore
+    return {
+        'orm_stmts': orm_stmts,
+        'declarative_base': QuotesBase,
+        **overrides
+    }
+
+
+def insert_kennedy(engine):
+    with engine.begin() as conn:
+        conn.execute(insert(Author), [{
+            'name': 'John F. Kennedy',
+            'birthday': date(1917, 5, 29),
+            'bio': '35th president of the United States.'
+        }])
+
+
+def replayed_add(session, instance):
+    """Add a HashBase instance's row as params, as a spool replay does"""
+    session.row_buffers.append(RowBuffer.from_params(
+        HashBase.sorted_tables,
+        HashBase.sorted_entities,
+        session.new_resolver(),
+        {instance.__table__: [instance.params]}
+    ))
+
+
+def fail_statements(engine, prefix, times=None):
+    """
+    Statements starting with `prefix` fail as if the database was locked,
+    `times` times or every time. Returns the list of failed statements.
+    """
+    failed = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def receive(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith(prefix) and (times is None or len(failed) < times):
+            failed.append(statement)
+            raise OperationalError(
+                statement, parameters, sqlite3.OperationalError('database is locked')
+            )
+
+    return failed
+
+
+@pytest.fixture
+def quotes_engine(tmp_path):
+    """A SQLite database file with the quotes tables"""
+    engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    QuotesBase.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def captured_statements(quotes_engine):
+    """(statement, [parameters of each row]) of every statement executed"""
+    statements = []
+
+    @event.listens_for(quotes_engine, 'before_cursor_execute')
+    def receive(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters if executemany else [parameters]))
+
+    return statements
+
+
 def return_subquery_string_or_arg(arg):
     if column_value_is_subquery(arg):
         return subquery_to_string(arg)
@@ -63,6 +173,19 @@ class TestManyToOneBulkDP:
 
         assert equal_column_values(quote.author_id, author_id)
 
+    def test_prepare_with_resolver(self, simple_quote_with_simple_kennedy_without_id):
+        quote = simple_quote_with_simple_kennedy_without_id
+        resolver = NaturalKeyResolver()
+
+        ManyToOneBulkDP(quote, quote_author_relationship).prepare(resolver)
+
+        # Deferred instead of a subquery
+        assert quote.author_id is None
+        assert list(resolver.pending[Author.__table__]) == [('name', )]
+        assert list(resolver.pending[Author.__table__][('name', )]) == [
+            ('John F. Kennedy', )
+        ]
+
 
 class TestManyToManyBulkDP:
 
@@ -140,6 +263,69 @@ class TestManyToManyBulkDP:
         )
 
 
+class TestNaturalKeyResolver:
+
+    @pytest.mark.parametrize(
+        "instance, expected",
+        [
+            (Author(name='John F. Kennedy'), (('name', ), ('John F. Kennedy', ))),
+            (Author(id=1, name='John F. Kennedy'), (('id', ), (1, ))),
+            (Tag(name='change'), (('name', ), ('change', ))),
+            (Quote(author_id=1), None),
+        ]
+    )
+    def test_natural_key(self, instance, expected):
+        assert NaturalKeyResolver.natural_key(instance) == expected
+
+    def test_resolve(self, session, transient_instances):
+        kennedy, change, deep_thoughts, quote = transient_instances
+        session.execute(insert(Tag), [{'name': 'change'}, {'name': 'deep-thoughts'}])
+
+        resolver = NaturalKeyResolver(chunk_size=1)
+        params = [{'tag_id': None}, {'tag_id': None}, {'tag_id': None}]
+        resolver.defer(params[0], 'tag_id', change, tag_id_column)
+        resolver.defer(params[1], 'tag_id', deep_thoughts, tag_id_column)
+        resolver.defer(params[2], 'tag_id', deepcopy(change), tag_id_column)
+
+        resolver.resolve(session, Tag.__table__)
+
+        assert params == [{'tag_id': 1}, {'tag_id': 2}, {'tag_id': 1}]
+        assert resolver.pending == {}
+
+
+class TestORMStatementCache:
+
+    def test_get(self, tmp_path):
+        calls = []
+
+        def table_only(table):
+            calls.append(table)
+            return insert(table)
+
+        def with_session(table, session):
+            calls.append(session)
+            return insert(table).prefix_with('OR IGNORE')
+
+        cache = ORMStatementCache({
+            Author.__table__: table_only,
+            Tag.__table__: with_session,
+        })
+        assert cache.takes_session == {
+            Author.__table__: False,
+            Tag.__table__: True,
+        }
+
+        session = Session(bind=create_engine(f'sqlite:///{tmp_path / "test.db"}'))
+        for _ in range(3):
+            author_stmt = cache.get(Author.__table__, session)
+            tag_stmt = cache.get(Tag.__table__, session)
+
+        assert calls == [Author.__table__, session]
+        assert cache.get(Author.__table__, session) is author_stmt
+        assert cache.compiled(Tag.__table__, session) == \
+            'INSERT OR IGNORE INTO tag (id, name) VALUES (?, ?)'
+
+
 class TestScrapyBulkSession:
 
     def test_bulk_commit(self, transient_quote, tmp_path):
@@ -202,3 +388,570 @@ class TestScrapyBulkSession:
             (1, 1),
             (1, 2)
         }
+
+    def test_bulk_commit_without_subqueries(
+        self, transient_quote, quotes_engine, captured_statements
+    ):
+        session = ScrapyBulkSession(bind=quotes_engine, feed_options=quotes_feed_options())
+        session.add(transient_quote)
+        session.bulk_commit()
+
+        # Foreign keys are looked up by natural key, not with subqueries
+        inserts = [s for s, _ in captured_statements if s.startswith('INSERT')]
+        assert not any('SELECT' in s for s in inserts)
+        assert 'INSERT INTO quote_tag (quote_id, tag_id) VALUES (?, ?)' in inserts
+
+        with quotes_engine.connect() as conn:
+            assert set(conn.execute(text('SELECT * FROM quote_tag'))) == {
+                (1, 1),
+                (1, 2)
+            }
+
+    @pytest.mark.parametrize("tag_stmt", [insert, lambda table: insert(table).prefix_with('OR IGNORE')])
+    def test_bulk_commit_returning(
+        self, transient_quote, quotes_engine, captured_statements, tag_stmt
+    ):
+        feed_options = quotes_feed_options(returning=True)
+        feed_options['orm_stmts'][Tag.__table__] = tag_stmt
+
+        with quotes_engine.begin() as conn:
+            # Tag "change" already exists, so INSERT OR IGNORE skips it
+            conn.execute(insert(Tag), [{'name': 'other'}, {'name': 'change'}])
+        captured_statements.clear()
+
+        if tag_stmt is insert:
+            transient_quote.tags[0].name = 'new'
+
+        session = ScrapyBulkSession(bind=quotes_engine, feed_options=feed_options)
+        session.add(transient_quote)
+        session.bulk_commit()
+
+        # Keys come back from RETURNING. Only the ignored tag is looked up
+        statements = [s for s, _ in captured_statements]
+        lookups = [s for s in statements if s.startswith('SELECT')]
+        assert len(lookups) == (0 if tag_stmt is insert else 1)
+        assert not any('SELECT' in s for s in statements if s.startswith('INSERT'))
+        assert all('RETURNING' in s for s in statements if 'INTO tag' in s)
+        assert transient_quote.id == 1
+        assert transient_quote.author_id == transient_quote.author.id == 1
+
+        with quotes_engine.connect() as conn:
+            tag_ids = dict(conn.execute(text('SELECT name, id FROM tag')).all())
+            assert set(conn.execute(text('SELECT * FROM quote_tag'))) == {
+                (1, tag_ids[transient_quote.tags[0].name]),
+                (1, tag_ids['deep-thoughts'])
+            }
+
+    def test_bulk_commit_subquery_value(self, quotes_engine):
+        insert_kennedy(quotes_engine)
+
+        # A subquery assigned by the item loader rather than by a DP
+        quote = Quote(
+            quote='If not us, who? If not now, when?',
+            author_id=Author(name='John F. Kennedy').subquery('id')
+        )
+        tag = Tag(name='change')
+
+        session = ScrapyBulkSession(bind=quotes_engine, feed_options=quotes_feed_options())
+        session.add_all([quote, tag])
+        assert session.subquery_tables == {Quote.__table__}
+
+        session.bulk_commit()
+        assert session.subquery_tables == set()
+
+        with quotes_engine.connect() as conn:
+            assert conn.execute(text('SELECT author_id FROM quote')).all() == [(1, )]
+
+    @pytest.mark.parametrize(
+        "options, inserts",
+        [
+            ({}, 1),
+            ({'max_rows_per_statement': 2}, 3),
+            ({'max_params_per_statement': 3}, 5),  # 2 bound parameters per row
+        ]
+    )
+    def test_bulk_commit_chunked_values(
+        self, quotes_engine, captured_statements, options, inserts
+    ):
+        insert_kennedy(quotes_engine)
+        captured_statements.clear()
+
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(**options)
+        )
+        session.add_all([
+            Quote(
+                quote=f'quote {i}',
+                author_id=Author(name='John F. Kennedy').subquery('id')
+            )
+            for i in range(5)
+        ])
+        session.bulk_commit()
+
+        assert len([s for s, _ in captured_statements if s.startswith('INSERT')]) == inserts
+        with quotes_engine.connect() as conn:
+            assert conn.execute(text('SELECT count(*) FROM quote')).scalar() == 5
+
+    def test_bulk_commit_executemany_pages(
+        self, transient_quote, quotes_engine, captured_statements
+    ):
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(executemany_page_size=1)
+        )
+        session.add(transient_quote)
+        session.bulk_commit()
+
+        assert [
+            rows for statement, rows in captured_statements
+            if 'INTO tag' in statement
+        ] == [[('change', )], [('deep-thoughts', )]]
+
+    @pytest.mark.parametrize(
+        "transaction_scope, authors, quotes",
+        [
+            ('per_batch', [], []),
+            ('per_table', ['John F. Kennedy'], []),
+            ('savepoint_per_table', ['John F. Kennedy'], [1]),
+        ]
+    )
+    def test_bulk_commit_transaction_scope(
+        self, transient_quote, quotes_engine,
+        transaction_scope, authors, quotes
+    ):
+        with quotes_engine.begin() as conn:
+            # Tag "change" already exists, failing the tag table
+            conn.execute(insert(Tag), [{'name': 'change'}])
+
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(transaction_scope=transaction_scope)
+        )
+        session.add(transient_quote)
+
+        if transaction_scope == 'savepoint_per_table':
+            session.bulk_commit()
+        else:
+            with pytest.raises(IntegrityError):
+                session.bulk_commit()
+
+        with quotes_engine.connect() as conn:
+            assert conn.execute(select(Author.name)).scalars().all() == authors
+            assert conn.execute(select(Tag.name)).scalars().all() == ['change']
+            # The quote of the savepoint_per_table batch made it, its tags didn't
+            assert conn.execute(select(Quote.author_id)).scalars().all() == quotes
+            assert conn.execute(text('SELECT count(*) FROM quote_tag')).scalar() == 0
+
+    @pytest.mark.parametrize(
+        "transaction_scope, bisect",
+        [
+            ('per_batch', True),
+            ('savepoint_per_table', False),
+        ]
+    )
+    def test_bulk_commit_savepoints_atomic(
+        self, transient_quote, quotes_engine, transaction_scope, bisect
+    ):
+        # The quote table fails once the author & tags were written, each
+        # in a savepoint of the batch's transaction
+        fail_statements(quotes_engine, 'INSERT INTO quote ')
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(
+                transaction_scope=transaction_scope,
+                bisect=bisect,
+                max_retries=0
+            )
+        )
+        session.add(transient_quote)
+        with pytest.raises(OperationalError):
+            session.bulk_commit()
+
+        # pysqlite doesn't BEGIN before a SAVEPOINT, whose RELEASE would
+        # have committed the first table on its own
+        with quotes_engine.connect() as conn:
+            assert conn.execute(text('SELECT count(*) FROM author')).scalar() == 0
+            assert conn.execute(text('SELECT count(*) FROM tag')).scalar() == 0
+
+    @pytest.mark.parametrize(
+        "dedup, bio",
+        [
+            ('last', 'Last'),
+            ('first', 'First'),
+        ]
+    )
+    def test_bulk_commit_dedup(self, quotes_engine, captured_statements, dedup, bio):
+
+        # Distinct instances sharing a unique key
+        quotes = [
+            Quote(
+                quote=f'Quote {i}',
+                author=Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio=bio),
+                tags=[Tag(name='change'), Tag(name='change')]
+            )
+            for i, bio in enumerate(('First', 'Middle', 'Last'))
+        ]
+
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(dedup=dedup)
+        )
+        session.add_all(quotes)
+        session.bulk_commit()
+
+        # Every duplicate tag is dropped before the tag table is INSERTed
+        assert [
+            rows for statement, rows in captured_statements
+            if statement.startswith('INSERT INTO tag')
+        ] == [[('change', )]]
+        assert session.stats == {
+            'dedup/duplicates': 10,
+            'dedup/duplicates/author': 2,
+            'dedup/duplicates/tag': 5,
+            'dedup/duplicates/quote_tag': 3,
+        }
+
+        with quotes_engine.connect() as conn:
+            assert conn.execute(text('SELECT bio FROM author')).all() == [(bio, )]
+            assert conn.execute(text('SELECT count(*) FROM quote')).scalar() == 3
+            # Each quote's two "change" tags collapse into one quote_tag row
+            assert set(conn.execute(text('SELECT * FROM quote_tag'))) == {
+                (1, 1), (2, 1), (3, 1)
+            }
+
+    def test_bulk_commit_without_dedup(self, transient_quote, quotes_engine):
+        transient_quote.tags.append(Tag(name='change'))
+
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(dedup=None)
+        )
+        session.add(transient_quote)
+        with pytest.raises(IntegrityError):
+            session.bulk_commit()
+        assert session.stats == {}
+
+    @pytest.mark.parametrize("add", [Session.add, buffered_add])
+    def test_bulk_commit_key_cache(self, quotes_engine, captured_statements, add):
+        key_cache = KeyCache(max_entries=100)
+
+        def commit(quote):
+            session = ScrapyBulkSession(
+                bind=quotes_engine,
+                feed_options=quotes_feed_options(ignored=(Author, Tag)),
+                info={'key_cache': key_cache}
+            )
+            add(session, Quote(
+                quote=quote,
+                author=Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio='35th president'),
+                tags=[Tag(name='change')]
+            ))
+            session.bulk_commit()
+
+        def lookups():
+            return [s for s, _ in captured_statements if s.startswith('SELECT')]
+
+        commit('If not us, who? If not now, when?')
+        assert len(lookups()) == 3  # author, quote & tag
+        assert key_cache.misses == 3
+
+        # The author & tag ids come from the cache, only the quote is looked up
+        captured_statements.clear()
+        commit('Another one')
+        assert len(lookups()) == 1 and 'FROM quote' in lookups()[0]
+        assert (key_cache.hits, key_cache.misses) == (2, 4)
+
+        with quotes_engine.connect() as conn:
+            assert set(conn.execute(text('SELECT * FROM quote_tag'))) == {
+                (1, 1), (2, 1)
+            }
+
+    @pytest.mark.parametrize("add", [Session.add, buffered_add])
+    def test_bulk_commit_bloom_filter(self, quotes_engine, captured_statements, add):
+        with quotes_engine.begin() as conn:
+            conn.execute(insert(Tag), [{'name': 'change'}, {'name': 'life'}])
+
+        bloom_filter = BloomFilter(capacity=100)
+        bloom_filter.update([(('name', ), ('change', )), (('name', ), ('life', ))])
+
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(ignored=(Author, Tag)),
+            info={'bloom_filters': {Tag.__table__: bloom_filter}}
+        )
+        add(session, Quote(
+            quote='If not us, who? If not now, when?',
+            author=Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio='35th president'),
+            tags=[Tag(name='change'), Tag(name='deep-thoughts')]
+        ))
+        session.bulk_commit()
+
+        # The stored tag isn't sent to the database
+        assert [
+            row for statement, rows in captured_statements
+            if statement.startswith('INSERT OR IGNORE INTO tag')
+            for row in rows
+        ] == [('deep-thoughts', )]
+        assert session.stats['bloom_filter/stored'] == 1
+        assert (('name', ), ('deep-thoughts', )) in bloom_filter
+        assert session.bloom_filter_keys == []
+
+        with quotes_engine.connect() as conn:
+            assert conn.execute(text('SELECT count(*) FROM quote_tag')).scalar() == 2
+
+    def test_transaction_scope_is_validated(self):
+        with pytest.raises(ValueError):
+            ScrapyBulkSession(feed_options=quotes_feed_options(transaction_scope='per_item'))
+
+    @pytest.mark.parametrize(
+        "level, log_rows_sample, rows_logged",
+        [
+            (logging.WARNING, None, 0),
+            (logging.INFO, None, 0),
+            (logging.DEBUG, None, 2),
+            (logging.DEBUG, 1, 1),
+            (logging.DEBUG, 0, 0),  # The default
+        ]
+    )
+    def test_log_table(
+        self, transient_quote, quotes_engine, caplog,
+        level, log_rows_sample, rows_logged
+    ):
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(log_rows_sample=log_rows_sample)
+        )
+        session.add(transient_quote)
+
+        with caplog.at_level(level, logger='scrapy_sql.session'):
+            session.bulk_commit()
+
+        summaries = [r.getMessage() for r in caplog.records if r.levelno == logging.INFO]
+        dumps = [r.getMessage() for r in caplog.records if r.levelno == logging.DEBUG]
+
+        if level > logging.INFO:
+            assert summaries == []
+        else:
+            assert len(summaries) == 4
+            assert summaries[1].startswith('tag: 2 rows, ')
+
+        tag_dumps = [d for d in dumps if d.startswith('INSERT INTO tag')]
+        assert len(tag_dumps) == (1 if rows_logged else 0)
+        if tag_dumps:
+            assert len(tag_dumps[0].splitlines()) == 1 + rows_logged
+
+    @pytest.mark.parametrize("add", [Session.add, buffered_add, replayed_add])
+    def test_bulk_commit_change_detection(self, tmp_path, caplog, add):
+        feed_options = {
+            'orm_stmts': {HashedAuthor.__table__: upsert},
+            'declarative_base': HashBase,
+            'change_detection': {HashedAuthor: 'content_hash'}
+        }
+
+        engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+        HashBase.metadata.create_all(engine)
+
+        written = []
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def receive(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT'):
+                written.append(parameters)
+
+        def commit(bios):
+            session = ScrapyBulkSession(bind=engine, feed_options=feed_options)
+            for name, bio in bios.items():
+                add(session, HashedAuthor(name=name, bio=bio))
+            session.bulk_commit()
+
+        commit({'Kennedy': '35th president', 'Einstein': 'Physicist'})
+        assert len(written) == 1
+
+        written.clear()
+        with caplog.at_level(logging.INFO, logger='scrapy_sql.session'):
+            commit({'Kennedy': '35th president', 'Einstein': 'Theoretical physicist'})
+
+        # Only the changed row is written
+        assert len(written) == 1 and 'Theoretical physicist' in written[0]
+        assert 'hashed_author: 1 unchanged rows skipped' in caplog.messages
+
+        written.clear()
+        commit({'Kennedy': '35th president'})
+        assert written == []
+
+        with engine.connect() as conn:
+            rows = conn.execute(
+                text('SELECT name, bio, content_hash FROM hashed_author')
+            ).all()
+        assert {name: bio for name, bio, _ in rows} == {
+            'Kennedy': '35th president',
+            'Einstein': 'Theoretical physicist'
+        }
+        assert all(content_hash is not None for *_, content_hash in rows)
+
+    @pytest.mark.parametrize("add", [Session.add, buffered_add])
+    def test_bulk_commit_bisect(self, quotes_engine, tmp_path, add):
+
+        dead_letter_path = tmp_path / 'dead_letters.jsonl'
+        feed_options = quotes_feed_options(
+            dead_letter_path=str(dead_letter_path),
+            dead_letter_table='dead_letter'
+        )
+
+        dead_letter_table('dead_letter').create(quotes_engine)
+        with quotes_engine.begin() as conn:
+            conn.execute(insert(Tag), [{'name': 'change'}])
+
+        session = ScrapyBulkSession(bind=quotes_engine, feed_options=feed_options)
+        assert session.bisect
+        add(session, Quote(
+            quote='If not us, who? If not now, when?',
+            author=Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio='35th president'),
+            tags=[Tag(name='change'), Tag(name='life')]
+        ))
+        # An author without a bio, whose quote can't be inserted in turn
+        add(session, Quote(
+            quote='Imagination is more important than knowledge.',
+            author=Author(name='Albert Einstein', birthday=date(1879, 3, 14)),
+        ))
+        session.bulk_commit()
+
+        with quotes_engine.connect() as conn:
+            assert conn.execute(text('SELECT name FROM author')).scalars().all() == [
+                'John F. Kennedy'
+            ]
+            assert conn.execute(text('SELECT quote FROM quote')).scalars().all() == [
+                'If not us, who? If not now, when?'
+            ]
+            assert conn.execute(text('SELECT * FROM quote_tag')).all() == [(1, 1), (1, 2)]
+            dead_letters = conn.execute(
+                text('SELECT table_name, "row" FROM dead_letter')
+            ).all()
+
+        assert [table_name for table_name, _ in dead_letters] == ['author', 'tag', 'quote']
+        assert json.loads(dead_letters[0][1])['name'] == 'Albert Einstein'
+        assert json.loads(dead_letters[1][1])['name'] == 'change'
+
+        lines = [json.loads(line) for line in dead_letter_path.read_text().splitlines()]
+        assert [line['table_name'] for line in lines] == ['author', 'tag', 'quote']
+        assert 'NOT NULL' in lines[0]['error']
+        assert 'UNIQUE' in lines[1]['error']
+
+        assert session.stats == {
+            'failures/bisections': 3,
+            'failures/rejected': 3,
+            'failures/rejected/author': 1,
+            'failures/rejected/tag': 1,
+            'failures/rejected/quote': 1,
+        }
+
+    @pytest.mark.parametrize("returning", [False, True])
+    def test_bulk_commit_retry(self, transient_quote, quotes_engine, returning):
+        # The last table fails once, as if the database was locked
+        failures = fail_statements(quotes_engine, 'INSERT INTO quote_tag', times=1)
+
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(returning=returning, retry_backoff=0)
+        )
+        session.add(transient_quote)
+        session.bulk_commit()
+
+        assert len(failures) == 1
+        assert session.stats == {'failures/retries': 1}
+        with quotes_engine.connect() as conn:
+            assert conn.execute(text('SELECT count(*) FROM author')).scalar() == 1
+            assert conn.execute(text('SELECT count(*) FROM quote')).scalar() == 1
+            assert conn.execute(text('SELECT * FROM quote_tag')).all() == [(1, 1), (1, 2)]
+
+    def test_bulk_commit_retries_exhausted(self, transient_quote, quotes_engine):
+        attempts = fail_statements(quotes_engine, 'INSERT INTO author')
+
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(max_retries=2, retry_backoff=0)
+        )
+        session.add(transient_quote)
+        with pytest.raises(OperationalError):
+            session.bulk_commit()
+        assert len(attempts) == 3
+        assert session.stats == {'failures/retries': 2}
+
+    def test_bulk_commit_schema_error_not_retried(
+        self, transient_quote, quotes_engine, captured_statements
+    ):
+        with quotes_engine.begin() as conn:
+            conn.execute(text('DROP TABLE tag'))
+        captured_statements.clear()
+
+        session = ScrapyBulkSession(
+            bind=quotes_engine,
+            feed_options=quotes_feed_options(retry_backoff=60)
+        )
+        session.add(transient_quote)
+        with pytest.raises(OperationalError, match='no such table: tag'):
+            session.bulk_commit()
+
+        assert len([
+            s for s, _ in captured_statements if s.startswith('INSERT INTO tag')
+        ]) == 1
+        assert session.stats == {}
+
+    @pytest.mark.parametrize(
+        "uri, orig, transient",
+        [
+            ('sqlite://', sqlite3.OperationalError('database is locked'), True),
+            ('sqlite://', sqlite3.OperationalError('no such table: tag'), False),
+            ('postgresql://', type('Error', (Exception, ), {'pgcode': '40P01'})(), True),
+            ('postgresql://', type('Error', (Exception, ), {'sqlstate': '08006'})(), True),
+            ('postgresql://', type('Error', (Exception, ), {'sqlstate': '42P01'})(), False),
+            ('mysql+pymysql://', Exception(1213, 'Deadlock found'), True),
+            ('mysql+pymysql://', Exception(2006, 'MySQL server has gone away'), True),
+            ('mysql+pymysql://', Exception(1146, "Table 'tag' doesn't exist"), False),
+        ]
+    )
+    def test_is_transient(self, uri, orig, transient):
+        session = ScrapyBulkSession(
+            bind=create_mock_engine(uri, executor=None),
+            feed_options=quotes_feed_options()
+        )
+        assert session.is_transient(OperationalError('INSERT', {}, orig)) is transient
+        assert session.is_transient(
+            IntegrityError('INSERT', {}, orig, connection_invalidated=True)
+        )
+        assert not session.is_transient(ValueError())
+
+    def test_bulk_commit_async_backoff(self, transient_quote, tmp_path, monkeypatch):
+        pytest.importorskip('aiosqlite')
+
+        def sleep(delay):
+            raise AssertionError('time.sleep blocks the event loop')
+
+        monkeypatch.setattr(
+            'scrapy_sql.session.time',
+            SimpleNamespace(sleep=sleep, perf_counter=time.perf_counter)
+        )
+        engine = create_async_engine(f'sqlite+aiosqlite:///{tmp_path / "test.db"}')
+        failures = fail_statements(engine.sync_engine, 'INSERT INTO quote_tag', times=1)
+
+        async def commit():
+            async with engine.begin() as conn:
+                await conn.run_sync(QuotesBase.metadata.create_all)
+            async with AsyncSession(
+                engine,
+                sync_session_class=ScrapyBulkSession,
+                feed_options=quotes_feed_options(retry_backoff=0.01)
+            ) as session:
+                session.sync_session.add(transient_quote)
+                await session.run_sync(lambda session: session.bulk_commit())
+                stats = session.sync_session.stats
+            async with engine.connect() as conn:
+                quote_tags = (await conn.execute(text('SELECT * FROM quote_tag'))).all()
+            await engine.dispose()
+            return stats, quote_tags
+
+        stats, quote_tags = asyncio.run(commit())
+        assert len(failures) == 1
+        assert stats == {'failures/retries': 1}
+        assert quote_tags == [(1, 1), (1, 2)]
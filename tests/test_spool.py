@@ -0,0 +1,188 @@
+
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+import _test_feedexport_helpers
+
+from integration_test_project.quotes.items.models import (
+    QuotesBase, Author, Tag, Quote, t_quote_tag
+)
+
+from scrapy_sql.buffers import buffered_add
+from scrapy_sql.spool import *
+from scrapy_sql.stmts import insert_ignore
+
+from scrapy.spiders import Spider
+
+from sqlalchemy import select
+
+from datetime import date
+
+
+def get_storage(uri, **feed_options):
+    return _test_feedexport_helpers.get_storage(
+        uri,
+        writer_threads=0,
+        orm_stmts={Author: insert_ignore, Tag: insert_ignore},
+        **feed_options
+    )
+
+
+def kennedy_quotes():
+    kennedy = Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio='35th president')
+    yield Quote(
+        quote='If not us, who? If not now, when?',
+        author=kennedy,
+        tags=[Tag(name='change'), Tag(name='deep-thoughts')]
+    )
+    yield Quote(
+        quote='Change is the law of life.',
+        author=Author(name='John F. Kennedy', birthday=date(1917, 5, 29), bio='35th president'),
+        tags=[Tag(name='change'), Tag(name='life')]
+    )
+
+
+class TestSpooledSubquery:
+
+    def test_round_trip(self):
+        clause = select(Tag.id).where(Tag.name == 'change').scalar_subquery()
+        spooled = SpooledSubquery.from_clause(clause)
+        assert list(spooled.params.values()) == ['change']
+
+        # Two rows binding the same name keep their own values
+        first = spooled.to_clause()
+        second = SpooledSubquery(
+            spooled.sql, {k: 'life' for k in spooled.params}
+        ).to_clause()
+        params = Tag.__table__.insert().values(
+            [{'name': first}, {'name': second}]
+        ).compile().params
+        assert sorted(params.values()) == ['change', 'life']
+
+
+class TestSpooledKey:
+
+    def test_round_trip(self, tmp_path):
+        spool = Spool(str(tmp_path), prefix='test')
+        spool.append({Quote.__table__: [{
+            'quote': 'If not us, who? If not now, when?',
+            'author_id': SpooledKey('author', ('name', ), ('John F. Kennedy', ), 'id')
+        }]})
+        path = spool.close()
+
+        table_params = load_segments([path], QuotesBase.sorted_tables)
+        author_id = table_params[Quote.__table__][0]['author_id']
+        assert str(author_id.compile()) == (
+            '(SELECT author.id \nFROM author \nWHERE author.name = :name_1)'
+        )
+        assert author_id.compile().params == {'name_1': 'John F. Kennedy'}
+
+
+class TestSpool:
+
+    def test_append_and_seal(self, tmp_path):
+        spool = Spool(str(tmp_path), prefix='test', fsync_every=1)
+        assert spool.seal() is None
+
+        rows = spool.append({Tag.__table__: [{'name': 'change'}, {'name': 'life'}]})
+        assert rows == 2
+        assert segment_paths(str(tmp_path)) == []
+        assert segment_paths(str(tmp_path), unsealed=True) == [
+            str(tmp_path / 'test-000001.part')
+        ]
+
+        sealed = spool.seal()
+        assert sealed == str(tmp_path / 'test-000001.seg')
+        assert segment_paths(str(tmp_path)) == [sealed]
+        assert list(read_segment(sealed)) == [
+            ('tag', [{'name': 'change'}, {'name': 'life'}])
+        ]
+
+    def test_truncated_segment(self, tmp_path):
+        spool = Spool(str(tmp_path), prefix='test')
+        spool.append({Tag.__table__: [{'name': 'change'}]})
+        spool.append({Tag.__table__: [{'name': 'life'}]})
+        path = spool.seal()
+
+        with open(path, 'r+b') as file:
+            file.truncate(os.path.getsize(path) - 3)
+        assert list(read_segment(path)) == [('tag', [{'name': 'change'}])]
+
+
+def test_orphaned_segments(tmp_path):
+    directory = str(tmp_path)
+    host = socket.gethostname()
+    finished = subprocess.Popen([sys.executable, '-c', ''])
+    finished.wait()
+    running = subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(30)'])
+
+    try:
+        spools = {
+            name: Spool(directory, prefix=prefix)
+            for name, prefix in [
+                ('open', None),
+                ('closed', None),
+                ('running', f'{host}-{running.pid}-0a1b2c3d'),
+                ('finished', f'{host}-{finished.pid}-0a1b2c3d'),
+                ('other host', f'{host}.other-{finished.pid}-0a1b2c3d'),
+            ]
+        }
+        for spool in spools.values():
+            spool.append({Tag.__table__: [{'name': 'change'}]})
+        # Only the open spool is known to this process, the others are
+        # told apart by the process id of their prefix
+        sealed = {
+            name: spool.close() for name, spool in spools.items()
+            if name != 'open'
+        }
+
+        assert set(orphaned_segments(directory)) == {
+            sealed['closed'], sealed['finished']
+        }
+    finally:
+        running.kill()
+        running.wait()
+        spools['open'].close()
+
+
+class TestConsolidate:
+
+    @pytest.mark.parametrize('add', [None, buffered_add])
+    def test_consolidate(self, tmp_path, add):
+        staging_dir = str(tmp_path / 'staging')
+        uri = f'sqlite:///{tmp_path / "test.db"}'
+        feed_options = {} if add is None else {'add': add}
+
+        # Two spiders stage a batch each, without touching the database
+        for quote in kennedy_quotes():
+            storage = get_storage(uri, staging_dir=staging_dir, **feed_options)
+            session = storage.open(Spider('test'))
+            exporter = _test_feedexport_helpers.get_exporter(storage)
+            exporter.export_item(quote)
+            storage.store(session)
+            storage.close_spider(None)
+        assert not (tmp_path / 'test.db').exists()
+        assert len(segment_paths(staging_dir)) == 2
+
+        storage = get_storage(uri, **feed_options)
+        assert consolidate(storage, staging_dir, segments_per_batch=1) == 2
+        assert segment_paths(staging_dir) == []
+
+        with storage.engine.connect() as conn:
+            assert conn.execute(select(Author.id, Author.name)).all() == [
+                (1, 'John F. Kennedy')
+            ]
+            assert conn.execute(select(Tag.id, Tag.name)).all() == [
+                (1, 'change'), (2, 'deep-thoughts'), (3, 'life')
+            ]
+            assert conn.execute(select(Quote.id, Quote.author_id)).all() == [
+                (1, 1), (2, 1)
+            ]
+            assert set(conn.execute(select(t_quote_tag)).all()) == {
+                (1, 1), (1, 2), (2, 1), (2, 3)
+            }
+        storage.close_spider(None)
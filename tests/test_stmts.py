@@ -0,0 +1,164 @@
+
+from datetime import date
+from functools import partial
+
+import pytest
+
+from integration_test_project.quotes.items.models import (
+    QuotesBase, Author, Tag, Quote, t_quote_tag
+)
+
+from scrapy_sql.stmts import *
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.orm import Session
+
+
+class FakeSession:
+    """Only the dialect of the bind is used by the stmts"""
+
+    def __init__(self, dialect):
+        self.bind = type('Bind', (), {'dialect': dialect})
+
+
+def compile(stmt, session):
+    return ' '.join(str(stmt.compile(dialect=session.bind.dialect)).split())
+
+
+sqlite_session = FakeSession(sqlite.dialect())
+mysql_session = FakeSession(mysql.dialect())
+postgresql_session = FakeSession(postgresql.dialect())
+
+
+@pytest.mark.parametrize(
+    "table, expected",
+    [
+        (Author.__table__, ('name', )),
+        (Tag.__table__, ('name', )),
+        (t_quote_tag, ('quote_id', 'tag_id')),  # Only a primary key
+    ]
+)
+def test_default_conflict_columns(table, expected):
+    assert tuple(c.name for c in default_conflict_columns(table)) == expected
+
+
+@pytest.mark.parametrize(
+    "session, expected",
+    [
+        (sqlite_session, 'INSERT OR IGNORE INTO tag'),
+        (mysql_session, 'INSERT IGNORE INTO tag'),
+        (postgresql_session, 'ON CONFLICT DO NOTHING'),
+    ]
+)
+def test_insert_ignore(session, expected):
+    assert expected in compile(insert_ignore(Tag.__table__, session), session)
+
+
+@pytest.mark.parametrize(
+    "session, expected",
+    [
+        (
+            sqlite_session,
+            'ON CONFLICT (name) DO UPDATE SET birthday = excluded.birthday, bio = excluded.bio'
+        ),
+        (
+            postgresql_session,
+            'ON CONFLICT (name) DO UPDATE SET birthday = excluded.birthday, bio = excluded.bio'
+        ),
+        (
+            mysql_session,
+            'ON DUPLICATE KEY UPDATE birthday = VALUES(birthday), bio = VALUES(bio)'
+        ),
+    ]
+)
+def test_upsert(session, expected):
+    sql = compile(upsert(Author.__table__, session), session)
+    assert sql.startswith('INSERT INTO author')
+    assert sql.endswith(expected)
+    assert compile(replace(Author.__table__, session), session) == sql
+
+
+@pytest.mark.parametrize(
+    "session, expected",
+    [
+        (
+            postgresql_session,
+            'ON CONFLICT (name) DO UPDATE SET bio = excluded.bio '
+            'WHERE excluded.bio IS NOT NULL'
+        ),
+        (
+            mysql_session,
+            'ON DUPLICATE KEY UPDATE bio = CASE WHEN (VALUES(bio) IS NOT NULL) '
+            'THEN VALUES(bio) ELSE author.bio END'
+        ),
+    ]
+)
+def test_upsert_update_where(session, expected):
+    stmt = upsert(
+        Author.__table__,
+        session,
+        conflict=('name', ),
+        update=(Author.__table__.c.bio, ),
+        where=lambda proposed: proposed.bio.isnot(None)
+    )
+    assert compile(stmt, session).endswith(expected)
+
+
+def test_upsert_mysql_where_references_updated_column():
+    # `bio` is assigned last, so every CASE sees the current row's bio
+    table = Author.__table__
+    stmt = upsert(
+        table,
+        mysql_session,
+        conflict=('name', ),
+        update=('bio', 'birthday'),
+        where=lambda proposed: table.c.bio.is_(None)
+    )
+    assert compile(stmt, mysql_session).endswith(
+        'ON DUPLICATE KEY UPDATE '
+        'birthday = CASE WHEN (author.bio IS NULL) THEN VALUES(birthday) ELSE author.birthday END, '
+        'bio = CASE WHEN (author.bio IS NULL) THEN VALUES(bio) ELSE author.bio END'
+    )
+
+    with pytest.raises(ValueError, match='bio, birthday'):
+        upsert(
+            table,
+            mysql_session,
+            conflict=('name', ),
+            update=('bio', 'birthday'),
+            where=lambda proposed: table.c.bio.is_(None) | (
+                table.c.birthday < proposed.birthday
+            )
+        )
+
+
+@pytest.mark.parametrize(
+    "session, expected",
+    [
+        (sqlite_session, 'ON CONFLICT (name) DO NOTHING'),
+        (mysql_session, 'INSERT IGNORE INTO tag'),
+    ]
+)
+def test_upsert_nothing_to_update(session, expected):
+    assert expected in compile(upsert(Tag.__table__, session), session)
+
+
+def test_upsert_updates_in_place(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    QuotesBase.metadata.create_all(engine)
+    session = Session(bind=engine)
+
+    kennedy = {
+        'name': 'John F. Kennedy',
+        'birthday': date(1917, 5, 29),
+        'bio': '35th president of the United States.'
+    }
+    stmt = partial(upsert, conflict=('name', ))(Author.__table__, session)
+
+    session.execute(stmt, [kennedy])
+    session.execute(stmt, [{**kennedy, 'bio': 'Updated'}])
+
+    assert session.execute(select(Author.id, Author.bio)).all() == [(1, 'Updated')]
+    session.close()
+    engine.dispose()
@@ -1,7 +1,8 @@
 
 import pytest
 
-from sqlalchemy import insert, select, Column, Numeric, Integer, Text, Date
+from sqlalchemy import create_engine, insert, select, Column, Numeric, Integer, Text, Date
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import DeclarativeBase
 
 from integration_test_project.quotes.items.models import (
@@ -118,4 +119,52 @@ def test_load_table(obj, table):
     ]
 )
 def test_load_stmt(stmt, expected):
-    assert load_stmt(stmt) == expected
\ No newline at end of file
+    assert load_stmt(stmt) == expected
+
+@pytest.mark.parametrize(
+    "table, expected",
+    [
+        (Author.__table__, (('id', ), ('name', ))),
+        (Tag.__table__, (('id', ), ('name', ))),
+        (Quote.__table__, (('id', ), ('quote', ))),
+        (t_quote_tag, (('quote_id', 'tag_id'), )),
+    ]
+)
+def test_unique_key_columns(table, expected):
+    assert tuple(
+        tuple(column.name for column in columns)
+        for columns in unique_key_columns(table)
+    ) == expected
+
+
+def test_count_bind_params():
+    subquery = Author(name='John F. Kennedy', bio='35th').subquery('id')
+    assert count_bind_params(subquery) == 2
+    assert count_bind_params('change') == 1
+    assert count_bind_params(None) == 1
+
+
+@pytest.mark.parametrize(
+    "max_rows, max_params, expected",
+    [
+        (None, None, [5]),
+        (2, None, [2, 2, 1]),
+        (None, 4, [2, 2, 1]),
+        (None, 5, [2, 2, 1]),
+        (3, 4, [2, 2, 1]),
+        (None, 1, [1, 1, 1, 1, 1]),  # Rows larger than max_params go alone
+    ]
+)
+def test_chunk_rows(max_rows, max_params, expected):
+    rows = [{'quote_id': i, 'tag_id': i} for i in range(5)]
+    chunks = list(chunk_rows(rows, max_rows, max_params))
+
+    assert [len(chunk) for chunk in chunks] == expected
+    assert [row for chunk in chunks for row in chunk] == rows
+    assert list(chunk_rows([], 2)) == []
+
+
+def test_max_bind_params():
+    sqlite = create_engine('sqlite://').dialect
+    assert max_bind_params(sqlite) in (999, 32766)
+    assert max_bind_params(postgresql.dialect()) == 32767
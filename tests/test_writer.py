@@ -0,0 +1,134 @@
+import pytest
+
+from queue import Queue
+import sqlite3
+
+from integration_test_project.quotes.items.models import (
+    QuotesBase, Author, Tag, Quote, t_quote_tag
+)
+
+from scrapy_sql._defaults import _default_commit
+from scrapy_sql.buffers import RowBuffer
+from scrapy_sql.session import ScrapyBulkSession
+from scrapy_sql.writer import SQLAlchemyWriter
+
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import sessionmaker
+
+
+class FakeReactor:
+    """Runs the calls made from writer threads when pumped by the test"""
+
+    def __init__(self):
+        self.calls = Queue()
+
+    def callFromThread(self, f, *args):
+        self.calls.put((f, args))
+
+    def pump_until(self, d):
+        fired = []
+        d.addBoth(fired.append)
+        while not fired:
+            f, args = self.calls.get(timeout=10)
+            f(*args)
+        return fired[0]
+
+
+class FakeEngine:
+
+    def __init__(self):
+        self.calls = []
+
+    def pause(self):
+        self.calls.append('pause')
+
+    def unpause(self):
+        self.calls.append('unpause')
+
+
+class FakeCrawler:
+
+    def __init__(self):
+        self.engine = FakeEngine()
+
+
+@pytest.fixture
+def Session(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    QuotesBase.metadata.create_all(engine)
+
+    feed_options = {
+        'declarative_base': QuotesBase,
+        'orm_stmts': {
+            table: insert for table in QuotesBase.sorted_tables
+        }
+    }
+    try:
+        yield sessionmaker(
+            class_=ScrapyBulkSession,
+            bind=engine,
+            feed_options=feed_options
+        )
+    finally:
+        engine.dispose()
+
+
+class TestSQLAlchemyWriter:
+
+    def test_take_batch(self, Session):
+        session = Session()
+        session.add(Tag(name='change'))
+
+        batch = SQLAlchemyWriter.take_batch(session)
+
+        # Rows rather than the instances of the session
+        assert [type(obj) for obj in batch] == [RowBuffer]
+        assert [
+            ref.params for ref in batch[0].tables[Tag.__table__].rows()
+        ] == [{'name': 'change'}]
+        assert len(batch[0].refs) == 0
+        assert len(session.new) == 0
+
+    def test_write_with_backpressure(self, Session):
+        reactor = FakeReactor()
+        crawler = FakeCrawler()
+        writer = SQLAlchemyWriter(
+            Session,
+            _default_commit,
+            queue_size=1,
+            crawler=crawler,
+            reactor=reactor
+        )
+
+        # Submitted before the writer runs, so the queue overflows
+        writes = [
+            writer.submit([Tag(name=name)])
+            for name in ('change', 'deep-thoughts', 'inspirational')
+        ]
+        assert writer.paused
+        assert crawler.engine.calls == ['pause']
+
+        writer.start()
+        reactor.pump_until(writer.close())
+
+        assert not writer.paused
+        assert crawler.engine.calls == ['pause', 'unpause']
+        assert all(d.called for d in writes)
+
+        conn = sqlite3.connect(Session.kw['bind'].url.database)
+        assert conn.execute('SELECT name FROM tag').fetchall() == [
+            ('change', ), ('deep-thoughts', ), ('inspirational', )
+        ]
+
+    def test_failed_batch(self, Session):
+        reactor = FakeReactor()
+        writer = SQLAlchemyWriter(Session, _default_commit, reactor=reactor)
+        writer.start()
+
+        failed = writer.submit([Tag()])  # NOT NULL constraint on name
+        written = writer.submit([Tag(name='change')])
+        reactor.pump_until(writer.close())
+
+        assert reactor.pump_until(written) is None
+        with pytest.raises(Exception):
+            reactor.pump_until(failed).raiseException()